@@ -73,9 +73,10 @@ def pose_spherical(theta, phi, radius, coord_trans=None):
 
 
 class BlenderDataset(Dataset):
-    def __init__(self, datadir, split='train', downsample=1.0, is_stack=False, N_vis=-1,spheric_poses=False):
+    def __init__(self, datadir, split='train', downsample=1.0, is_stack=False, N_vis=-1,spheric_poses=False, lazy_rays=False):
 
         self.N_vis = N_vis
+        self.lazy_rays = lazy_rays
         self.root_dir = datadir
         self.split = split
         self.is_stack = is_stack
@@ -138,6 +139,9 @@ class BlenderDataset(Dataset):
             img = img.view(4, -1).permute(1, 0)  # (h*w, 4) RGBA
             img = img[:, :3] * img[:, -1:] + (1 - img[:, -1:])  # blend A to RGB
             self.all_rgbs += [img]
+            if self.lazy_rays:
+                self.all_rgbs[-1] = lazy_rgbs(img)
+                continue
 
             rays_o, rays_d = get_rays(self.directions, c2w)  # both (h*w, 3)
             self.all_rays += [torch.cat([rays_o, rays_d], 1)]  # (h*w, 6)
@@ -147,7 +151,11 @@ class BlenderDataset(Dataset):
         # build render path
         self.render_path = torch.stack([pose_spherical(angle, -30.0, 4.0, self.blender2opencv) for angle in np.linspace(-180,180,40+1)[:-1]], 0)
 
-        if not self.is_stack:
+        if self.lazy_rays:
+            self.all_rgbs = torch.stack(self.all_rgbs, 0)  # (len(self.meta['frames]),h*w, 3) uint8
+            self.all_rays = None
+            self.image_poses = self.poses
+        elif not self.is_stack:
             self.all_rays = torch.cat(self.all_rays, 0)  # (len(self.meta['frames])*h*w, 3)
             self.all_rgbs = torch.cat(self.all_rgbs, 0)  # (len(self.meta['frames])*h*w, 3)
             # self.all_depth = torch.cat(self.all_depth, 0)  # (len(self.meta['frames])*h*w, 3)
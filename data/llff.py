@@ -121,11 +121,12 @@ def get_spiral(c2ws_all, near_fars, rads_scale=1.0, N_views=120):
 
 
 class LLFFDataset(Dataset):
-    def __init__(self, datadir, split='train', downsample=4, is_stack=False, hold_every=8 ,spheric_poses=True):
+    def __init__(self, datadir, split='train', downsample=4, is_stack=False, hold_every=8 ,spheric_poses=True, lazy_rays=False):
         """
         spheric_poses: whether the images are taken in a spheric inward-facing manner
                        default: False (forward-facing)
         val_num: number of val images (used for multigpu training, validate same image for all gpus)
+        lazy_rays: keep uint8 images and poses only, rays are generated per batch by the sampler
         """
 
         self.root_dir = datadir
@@ -135,6 +136,7 @@ class LLFFDataset(Dataset):
         self.downsample = downsample
         self.define_transforms()
         self.spheric_poses = spheric_poses
+        self.lazy_rays = lazy_rays
         self.blender2opencv = np.eye(4)#np.array([[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]])
         self.read_meta()
         self.white_bg = False
@@ -236,6 +238,9 @@ class LLFFDataset(Dataset):
 
             img = img.view(3, -1).permute(1, 0)  # (h*w, 3) RGB
             self.all_rgbs += [img]
+            if self.lazy_rays:
+                self.all_rgbs[-1] = lazy_rgbs(img)
+                continue
             rays_o, rays_d = get_rays(self.directions, c2w)  # both (h*w, 3)
             if not self.spheric_poses:
                 rays_o_original, rays_d_original = rays_o.clone(),rays_d.clone()
@@ -245,7 +250,13 @@ class LLFFDataset(Dataset):
             # viewdir = rays_d / torch.norm(rays_d, dim=-1, keepdim=True)
             self.all_rays += [torch.cat([rays_o, rays_d], 1)]  # (h*w, 6)
 
-        if not self.is_stack:
+        if self.lazy_rays:
+            self.all_rgbs = torch.stack(self.all_rgbs, 0)  # (len(self.img_list),h*w, 3) uint8
+            self.all_rays = None
+            self.image_poses = torch.FloatTensor(self.poses[self.img_list])
+            # forward-facing scenes are trained on ndc rays: (H, W, focal, near) for ndc_rays_blender
+            self.ndc_params = None if self.spheric_poses else (H, W, self.focal[0], 1.0)
+        elif not self.is_stack:
             self.all_rays = torch.cat(self.all_rays, 0) # (len(self.meta['frames])*h*w, 3)
             self.all_rgbs = torch.cat(self.all_rgbs, 0) # (len(self.meta['frames])*h*w,3)
             if not self.spheric_poses:
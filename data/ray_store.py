@@ -0,0 +1,112 @@
+import os
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+
+'''
+训练光线的磁盘存储: 一次性打包, 之后通过 np.memmap 读取, 不再把 all_rays/all_rgbs 全部放进内存
+'''
+
+RAY_STORE_VERSION = 2
+
+
+def gather_rows(arr, ids):
+    """
+    Fetch rows of a torch tensor or a (memory-mapped) numpy array.
+    ids: LongTensor / int ndarray / slice
+    Only the requested rows are read from a memmap.
+    """
+    if not isinstance(arr, np.ndarray):
+        return arr[ids]
+
+    if torch.is_tensor(ids):
+        ids = ids.numpy()
+    return torch.from_numpy(np.array(arr[ids]))
+
+
+def _write_rows(path, src, dtype, chunk):
+    n = src.shape[0]
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(n, *src.shape[1:]))
+    for start in range(0, n, chunk):
+        rows = src[start:start + chunk]
+        out[start:start + chunk] = rows.numpy() if torch.is_tensor(rows) else rows
+    out.flush()
+    del out
+
+
+def pack_ray_store(store_dir, dataset, depth_dataset=None, chunk=1 << 20, **key):
+    """
+    One-time conversion of a loaded (is_stack=False) training set into .npy files that can be memory-mapped:
+        rays.npy   (N, 6) float32
+        rgbs.npy   (N, 3) float32
+        depth.npy  (N, 1) float32  only with depth_dataset
+        mask.npy   (N,)   bool     only with depth_dataset
+        meta.pt    scene attributes the trainer reads from the dataset
+    key: values identifying the source (datadir, downsample, ...), checked by ray_store_matches
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    print(f'[pack_ray_store] packing {dataset.all_rays.shape[0]} rays to {store_dir}')
+
+    files = [('rays.npy', dataset.all_rays, np.float32), ('rgbs.npy', dataset.all_rgbs, np.float32)]
+    if depth_dataset is not None:
+        files += [('depth.npy', depth_dataset.all_depth, np.float32), ('mask.npy', depth_dataset.final_mask, bool)]
+    for fname, src, dtype in tqdm(files, desc='pack ray store'):
+        _write_rows(os.path.join(store_dir, fname), src, dtype, chunk)
+
+    meta = {
+        'version': RAY_STORE_VERSION,
+        'key': key,
+        'num_rays': int(dataset.all_rays.shape[0]),
+        'has_depth': depth_dataset is not None,
+        'img_wh': [int(x) for x in dataset.img_wh],
+        'white_bg': dataset.white_bg,
+        'near_far': [float(x) for x in dataset.near_far],
+        'scene_bbox': dataset.scene_bbox,
+        'poses': torch.as_tensor(np.asarray(dataset.poses)),
+    }
+    # meta.pt is written last, a store without it is incomplete
+    torch.save(meta, os.path.join(store_dir, 'meta.pt'))
+
+
+def ray_store_matches(store_dir, with_depth=False, **key):
+    meta_path = os.path.join(store_dir, 'meta.pt')
+    if not os.path.exists(meta_path):
+        return False
+    meta = torch.load(meta_path)
+    if meta['version'] != RAY_STORE_VERSION or meta['key'] != key:
+        print(f'[ray_store_matches] {store_dir} was packed from {meta["key"]}, repacking')
+        return False
+    return meta['has_depth'] or not with_depth
+
+
+class RayStore:
+    '''
+    Read-only view of a packed training set. Exposes the dataset attributes used for training,
+    with all_rays / all_rgbs (and all_depth / final_mask) as numpy memmaps.
+    '''
+    def __init__(self, store_dir):
+        self.root_dir = store_dir
+        meta = torch.load(os.path.join(store_dir, 'meta.pt'))
+
+        self.img_wh = meta['img_wh']
+        self.white_bg = meta['white_bg']
+        self.near_far = meta['near_far']
+        self.scene_bbox = meta['scene_bbox']
+        self.poses = meta['poses']
+
+        self.all_rays = np.load(os.path.join(store_dir, 'rays.npy'), mmap_mode='r')
+        self.all_rgbs = np.load(os.path.join(store_dir, 'rgbs.npy'), mmap_mode='r')
+        if meta['has_depth']:
+            self.all_depth = np.load(os.path.join(store_dir, 'depth.npy'), mmap_mode='r')
+            self.final_mask = np.load(os.path.join(store_dir, 'mask.npy'), mmap_mode='r')
+        assert self.all_rays.shape[0] == meta['num_rays']
+        print(f'[RayStore] {meta["num_rays"]} rays mapped from {store_dir}')
+
+    def __len__(self):
+        return self.all_rays.shape[0]
+
+    def __getitem__(self, idx):
+        return {'rays': gather_rows(self.all_rays, idx),
+                'rgbs': gather_rows(self.all_rgbs, idx)}
@@ -86,8 +86,9 @@ def gen_path(pos_gen, at=(0, 0, 0), up=(0, -1, 0), frames=180):
 
 class TanksTempleDataset(Dataset):
     """NSVF Generic Dataset."""
-    def __init__(self, datadir, split='train', downsample=1.0, wh=[1920,1080], is_stack=False):
+    def __init__(self, datadir, split='train', downsample=1.0, wh=[1920,1080], is_stack=False, lazy_rays=False):
         self.root_dir = datadir
+        self.lazy_rays = lazy_rays
         self.split = split
         self.is_stack = is_stack
         self.downsample = downsample
@@ -160,6 +161,9 @@ class TanksTempleDataset(Dataset):
             c2w = np.loadtxt(os.path.join(self.root_dir, 'pose', pose_fname))# @ cam_trans
             c2w = torch.FloatTensor(c2w)
             self.poses.append(c2w)  # C2W
+            if self.lazy_rays:
+                self.all_rgbs[-1] = lazy_rgbs(img)
+                continue
             rays_o, rays_d = get_rays(self.directions, c2w)  # both (h*w, 3)
             self.all_rays += [torch.cat([rays_o, rays_d], 1)]  # (h*w, 8)
 
@@ -174,7 +178,11 @@ class TanksTempleDataset(Dataset):
 
 
 
-        if 'train' == self.split:
+        if self.lazy_rays:
+            self.all_rgbs = torch.stack(self.all_rgbs, 0)  # (len(self.meta['frames]),h*w, 3) uint8
+            self.all_rays = None
+            self.image_poses = self.poses
+        elif 'train' == self.split:
             if self.is_stack:
                 self.all_rays = torch.stack(self.all_rays, 0).reshape(-1,*self.img_wh[::-1], 6)  # (len(self.meta['frames])*h*w, 3)
                 self.all_rgbs = torch.stack(self.all_rgbs, 0).reshape(-1,*self.img_wh[::-1], 3)  # (len(self.meta['frames])*h*w, 3) 
@@ -11,9 +11,10 @@ from utils.ray import *
 
 
 class YourOwnDataset(Dataset):
-    def __init__(self, datadir, split='train', downsample=1.0, is_stack=False, N_vis=-1):
+    def __init__(self, datadir, split='train', downsample=1.0, is_stack=False, N_vis=-1, lazy_rays=False):
 
         self.N_vis = N_vis
+        self.lazy_rays = lazy_rays
         self.root_dir = datadir
         self.split = split
         self.is_stack = is_stack
@@ -81,14 +82,20 @@ class YourOwnDataset(Dataset):
             if img.shape[-1]==4:
                 img = img[:, :3] * img[:, -1:] + (1 - img[:, -1:])  # blend A to RGB
             self.all_rgbs += [img]
-
+            if self.lazy_rays:
+                self.all_rgbs[-1] = lazy_rgbs(img)
+                continue
 
             rays_o, rays_d = get_rays(self.directions, c2w)  # both (h*w, 3)
             self.all_rays += [torch.cat([rays_o, rays_d], 1)]  # (h*w, 6)
 
 
         self.poses = torch.stack(self.poses)
-        if not self.is_stack:
+        if self.lazy_rays:
+            self.all_rgbs = torch.stack(self.all_rgbs, 0)  # (len(self.meta['frames]),h*w, 3) uint8
+            self.all_rays = None
+            self.image_poses = self.poses
+        elif not self.is_stack:
             self.all_rays = torch.cat(self.all_rays, 0)  # (len(self.meta['frames])*h*w, 3)
             self.all_rgbs = torch.cat(self.all_rgbs, 0)  # (len(self.meta['frames])*h*w, 3)
 
@@ -0,0 +1,65 @@
+import hashlib
+import os
+
+import numpy as np
+import torch
+
+
+'''
+调色板分解缓存: 每个相机只渲染一次 opaque / color_correction / acc, 之后换调色板只需要一次逐像素矩阵乘法
+'''
+
+DECOMP_KEYS = ('opaque_map', 'color_correction_map', 'acc_map')
+
+
+def model_fingerprint(tensorf):
+    # hash of the weights and the alpha mask, a retrained or edited checkpoint gets a new cache
+    h = hashlib.sha1()
+    for k, v in sorted(tensorf.state_dict().items()):
+        h.update(k.encode())
+        h.update(v.detach().cpu().numpy().tobytes())
+    # a BakedPaletteGrid has neither an alpha mask nor early termination, its state_dict holds the whole grid
+    if getattr(tensorf, 'alphaMask', None) is not None:
+        h.update(tensorf.alphaMask.occupancy.cpu().numpy().tobytes())
+        h.update(tensorf.alphaMask.aabb.cpu().numpy().tobytes())
+    return h.hexdigest()[:16]
+
+
+class DecompCache:
+    '''
+    Per-camera palette decomposition of one model, stored as float16 npz files:
+        opaque_map (h*w, n_palette), color_correction_map (h*w, 3), acc_map (h*w,)
+    File name = render settings + hash of the camera pose, directory = model fingerprint.
+    '''
+    def __init__(self, cache_dir, tensorf, img_wh, N_samples=-1, ndc_ray=False):
+        self.cache_dir = os.path.join(cache_dir, model_fingerprint(tensorf))
+        os.makedirs(self.cache_dir, exist_ok=True)
+        W, H = img_wh
+        self.render_key = f'{int(W)}x{int(H)}_n{N_samples}_ndc{int(ndc_ray)}_term{getattr(tensorf, "ray_term_thres", 0.):g}'
+        print(f'[DecompCache] {self.cache_dir} ({self.render_key})')
+
+    def view_path(self, c2w):
+        c2w = np.ascontiguousarray(np.asarray(c2w, dtype=np.float32))
+        return os.path.join(self.cache_dir, f'{self.render_key}_{hashlib.sha1(c2w.tobytes()).hexdigest()[:16]}.npz')
+
+    def load(self, c2w):
+        path = self.view_path(c2w)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as f:
+            return {k: torch.from_numpy(f[k]).float() for k in f.files}
+
+    def save(self, c2w, res):
+        maps = {k: res[k].detach().cpu().numpy().astype(np.float16) for k in DECOMP_KEYS if k in res}
+        path = self.view_path(c2w)
+        tmp_path = path[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_path, **maps)
+        os.replace(tmp_path, path)
+        return {k: torch.from_numpy(v).float() for k, v in maps.items()}
+
+    def fetch(self, c2w, render_fn):
+        # render_fn() -> renderer output with the decomposition maps, only called on a miss
+        res = self.load(c2w)
+        if res is None:
+            res = self.save(c2w, render_fn())
+        return res
@@ -0,0 +1,144 @@
+import os
+
+import torch
+import torch.distributed as dist
+
+
+'''
+多卡数据并行训练: 每个进程在自己那一份互不相交的光线上采样, 反向传播后把梯度展平分桶做 all-reduce 取平均,
+参数和 alpha mask 在网格更新后从 rank 0 广播, 日志和保存只在 rank 0 上做
+'''
+
+def init_distributed(backend=''):
+    '''
+    Process group from the torchrun environment (RANK, WORLD_SIZE, LOCAL_RANK, MASTER_ADDR, MASTER_PORT).
+    backend: nccl on GPU and gloo on CPU by default. Returns (rank, world_size), a plain run is rank 0 of 1.
+    '''
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1 or dist.is_initialized():
+        return get_rank(), get_world_size()
+    if torch.cuda.is_available():
+        torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)))
+    dist.init_process_group(backend or ('nccl' if torch.cuda.is_available() else 'gloo'))
+    print(f'[init_distributed] rank {get_rank()} of {get_world_size()}, backend {dist.get_backend()}')
+    return get_rank(), get_world_size()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def default_device():
+    # the GPU of this rank (set by init_distributed), 'cuda' for a single process
+    if not torch.cuda.is_available():
+        return torch.device('cpu')
+    return torch.device('cuda', torch.cuda.current_device()) if is_distributed() else torch.device('cuda')
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+@torch.no_grad()
+def broadcast_module(module, src=0):
+    # parameters and buffers of module take the values of rank src
+    if not is_distributed():
+        return
+    for t in list(module.parameters()) + list(module.buffers()):
+        dist.broadcast(t.data, src)
+
+
+@torch.no_grad()
+def allreduce_gradients(params, bucket_mb=32):
+    '''
+    Average the gradients of params over the ranks. The gradients are flattened into buckets of at most bucket_mb
+    per dtype, one all_reduce per bucket. A parameter without gradient on every rank keeps grad None (the optimizer
+    skips it, as in a single process run); one with a gradient on some ranks only counts as zero on the others.
+    '''
+    if not is_distributed() or get_world_size() == 1:
+        return
+    params = [p for p in params if p.requires_grad]
+    if not params:
+        return
+    has_grad = torch.tensor([p.grad is not None for p in params], dtype=torch.int32, device=params[0].device)
+    dist.all_reduce(has_grad)
+    params = [p for p, n in zip(params, has_grad.tolist()) if n > 0]
+    for p in params:
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+    bucket_bytes = bucket_mb * 2 ** 20
+    for dtype in sorted({p.grad.dtype for p in params}, key=str):
+        bucket, n_bytes = [], 0
+        for p in (p for p in params if p.grad.dtype == dtype):
+            bucket.append(p.grad)
+            n_bytes += p.grad.numel() * p.grad.element_size()
+            if n_bytes >= bucket_bytes:
+                _allreduce_bucket(bucket)
+                bucket, n_bytes = [], 0
+        if bucket:
+            _allreduce_bucket(bucket)
+
+
+def _allreduce_bucket(grads):
+    flat = torch.cat([g.reshape(-1) for g in grads])
+    dist.all_reduce(flat)
+    flat /= get_world_size()
+    start = 0
+    for g in grads:
+        g.copy_(flat[start:start + g.numel()].view_as(g))
+        start += g.numel()
+
+
+@torch.no_grad()
+def sync_alpha_mask(tensorf, new_aabb, src=0):
+    # occupancy bits and the shrunk bbox of rank src, ray filtering and shrinking then agree on every rank
+    if not is_distributed():
+        return new_aabb
+    alpha_mask = tensorf.alphaMask
+    if alpha_mask is not None:
+        dist.broadcast(alpha_mask.occupancy, src)
+        alpha_mask.build_cells()
+    new_aabb = new_aabb.contiguous()
+    dist.broadcast(new_aabb, src)
+    return new_aabb
+
+
+def shard_sampler(sampler, rank, world_size):
+    '''
+    Keep every world_size-th ray of SimpleSampler / SimpleSampler_2 / LazyRaySampler (after the filters so far),
+    starting at rank. The shards are disjoint and cover all rays; later filters only test the rays of the shard.
+    '''
+    if world_size == 1:
+        return sampler
+    ray_ids = sampler.ray_ids if sampler.ray_ids is not None else torch.arange(sampler.total)
+    sampler.ray_ids = ray_ids[rank::world_size].clone()
+    sampler.total = sampler.ray_ids.shape[0]
+    sampler.curr = sampler.total
+    sampler.ids = None
+    print(f'[shard_sampler] rank {rank}: {sampler.total} of {ray_ids.shape[0]} rays')
+    return sampler
+
+
+class NullWriter:
+    # stands in for the SummaryWriter on ranks other than 0
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
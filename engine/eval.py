@@ -1,5 +1,6 @@
 import os
 import sys
+from contextlib import nullcontext
 from pathlib import Path
 
 import imageio
@@ -112,11 +113,40 @@ def evaluation(test_dataset, tensorf, args, renderer, savePath=None, N_vis=5, N_
             l_v = np.mean(np.asarray(l_vgg))
             metrics += [psnr, ssim, l_a, l_v]
         
-        np.savetxt(f'{savePath}/mean.txt', np.asarray(metrics))
+        if savePath is not None:
+            np.savetxt(f'{savePath}/mean.txt', np.asarray(metrics))
 
     return PSNRs
 
 
+@torch.no_grad()
+def check_precision(test_dataset, tensorf, args, renderer, N_vis=5, white_bg=False, ndc_ray=False, device='cuda',
+                    amp_dtype=None, half=True):
+    '''
+    PSNR of N_vis test views rendered in fp32, under autocast with amp_dtype (--amp) and with the float16 grids of
+    half_inference (--half_inference), on the same views. The half render runs last and converts tensorf in place,
+    no second copy of the model is made: with half, tensorf is left in float16.
+    Returns {mode: mean psnr}.
+    '''
+    def mean_psnr(ctx):
+        with ctx:
+            PSNRs = evaluation(test_dataset, tensorf, args, renderer, None, N_vis=N_vis, N_samples=-1, white_bg=white_bg,
+                               ndc_ray=ndc_ray, compute_extra_metrics=False, device=device)
+        return float(np.mean(PSNRs)) if PSNRs else float('nan')
+
+    psnrs = {'fp32': mean_psnr(nullcontext())}
+    if amp_dtype is not None:
+        device_type = device.type if isinstance(device, torch.device) else torch.device(device).type
+        psnrs[f'amp {str(amp_dtype).split(".")[-1]}'] = mean_psnr(torch.autocast(device_type=device_type, dtype=amp_dtype))
+    if half and hasattr(tensorf, 'half_inference'):
+        tensorf.half_inference()
+        psnrs['half'] = mean_psnr(nullcontext())
+
+    print('[check_precision] psnr ' + ', '.join(
+        f'{k} {v:.3f}' + ('' if k == 'fp32' else f' ({v - psnrs["fp32"]:+.3f})') for k, v in psnrs.items()))
+    return psnrs
+
+
 @torch.no_grad()
 def evaluation_path(test_dataset, tensorf, c2ws, renderer, savePath=None, N_samples=-1,
                     white_bg=False, ndc_ray=False, save_video=False, palette=None,new_palette=None, device='cuda',is_choose=False,net1=None,net2=None,probability=0.,**kwargs):
@@ -180,3 +210,89 @@ def evaluation_path(test_dataset, tensorf, c2ws, renderer, savePath=None, N_samp
         imageio.mimwrite(os.path.join(savePath, 'video_depth.mp4'), np.stack(depth_maps), fps=fps, quality=8)
         if len(plt_decomp_maps) > 0:
             imageio.mimwrite(os.path.join(savePath, 'video_palette_decomp.mp4'), np.stack(plt_decomp_maps), fps=fps, quality=8)
+
+
+def recolor_maps(res, palettes, white_bg=False):
+    """
+    Recolor rendered palette weights with a stack of palettes.
+    rgb_map = sum_i w_i * (bary_i @ palette) = opaque_map @ palette, so every palette only costs a matmul.
+    res: renderer output with opaque_map, acc_map and (optionally) color_correction_map
+    palettes: (K, n_palette, 3)
+    Returns (K, N_rays, 3) rgb maps, color correction included as in evaluation
+    """
+    opaque_map = res['opaque_map']
+    rgb_maps = opaque_map[None] @ palettes.to(opaque_map)  # (K, N_rays, 3)
+    if white_bg:
+        rgb_maps = rgb_maps + (1. - res['acc_map'])[None, :, None]
+    rgb_maps = rgb_maps.clamp(0, 1)
+    if 'color_correction_map' in res:
+        rgb_maps = rgb_maps + res['color_correction_map'][None]
+    return rgb_maps
+
+
+@torch.no_grad()
+def render_decomposition(rays, tensorf, renderer, chunk=4096, N_samples=-1, ndc_ray=False, white_bg=False, device='cuda', **kwargs):
+    # renderer output with everything recolor_maps needs
+    return renderer(rays, tensorf, chunk=chunk, N_samples=N_samples, ndc_ray=ndc_ray, white_bg=white_bg, device=device,
+                    ret_opaque_map=True, ret_acc_map=True, ret_color_correction_map=True, **kwargs)
+
+
+@torch.no_grad()
+def render_palettes(rays, tensorf, renderer, palettes, chunk=4096, N_samples=-1, ndc_ray=False, white_bg=False, device='cuda', **kwargs):
+    """
+    Render K recolorings of the same rays with one geometry and MLP pass.
+    palettes: (K, n_palette, 3)
+    Returns (K, N_rays, 3) rgb maps and the renderer output the maps were blended from
+    """
+    res = render_decomposition(rays, tensorf, renderer, chunk=chunk, N_samples=N_samples, ndc_ray=ndc_ray,
+                               white_bg=white_bg, device=device, **kwargs)
+    return recolor_maps(res, palettes, white_bg), res
+
+
+@torch.no_grad()
+def evaluation_path_palettes(test_dataset, tensorf, c2ws, renderer, palettes, savePath=None, N_samples=-1,
+                             white_bg=False, ndc_ray=False, save_video=False, device='cuda', decomp_cache=None, **kwargs):
+    """
+    evaluation_path for a stack of palettes (K, n_palette, 3): every camera is rendered once and recolored K times.
+    Frames of palette k are written to savePath/palette_{k:02d}/
+    decomp_cache: optional DecompCache, cameras already in the cache are recolored without any rendering
+    """
+    palettes = torch.as_tensor(palettes, dtype=torch.float32)
+    rgb_maps = [[] for _ in range(palettes.shape[0])]
+
+    if savePath is not None:
+        for k in range(palettes.shape[0]):
+            os.makedirs(os.path.join(savePath, f'palette_{k:02d}'), exist_ok=True)
+
+    W, H = test_dataset.img_wh
+
+    def render_view(c2w):
+        rays_o, rays_d = get_rays(test_dataset.directions, c2w)  # both (h*w, 3)
+        if ndc_ray:
+            rays_o, rays_d = ndc_rays_blender(H, W, test_dataset.focal[0], 1.0, rays_o, rays_d)
+        rays = torch.cat([rays_o, rays_d], 1)  # (h*w, 6)
+        return render_decomposition(rays, tensorf, renderer, N_samples=N_samples, ndc_ray=ndc_ray,
+                                    white_bg=white_bg, device=device, **kwargs)
+
+    pbar = trange(len(c2ws), file=sys.stdout)
+    for idx in pbar:
+        c2w = torch.FloatTensor(c2ws[idx])
+
+        if decomp_cache is not None:
+            res = decomp_cache.fetch(c2w, lambda: render_view(c2w))
+        else:
+            res = render_view(c2w)
+        recolored = recolor_maps(res, palettes, white_bg)
+        recolored = (recolored.reshape(-1, H, W, 3).clamp(0., 1.).cpu().numpy() * 255).astype('uint8')
+
+        for k, rgb_map in enumerate(recolored):
+            rgb_maps[k].append(rgb_map)
+            if savePath is not None:
+                imageio.imwrite(os.path.join(savePath, f'palette_{k:02d}', f'rgb_{idx:03d}.png'), rgb_map)
+
+    if save_video and savePath is not None:
+        fps = min(len(c2ws) / 5, 30)
+        for k in range(palettes.shape[0]):
+            imageio.mimwrite(os.path.join(savePath, f'palette_{k:02d}', 'video_rgb.mp4'), np.stack(rgb_maps[k]), fps=fps, quality=8)
+
+    return rgb_maps
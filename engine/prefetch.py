@@ -0,0 +1,99 @@
+import queue
+import threading
+
+import torch
+
+
+'''
+训练批次的异步预取: 后台线程在 pinned memory 里准备好后面几个 batch, 用单独的 CUDA stream 非阻塞上传,
+和 train_one_batch 的计算重叠
+'''
+
+def fits_on_device(tensors, device, budget=0.5, n_rows=None):
+    # n_rows of the tensors (all rows by default) take less than budget * free device memory, counting the shuffle
+    # peak: the int64 permutation and one extra copy of the largest (a resident sampler permutes its buffers one at a
+    # time and frees each old one before the next)
+    device = torch.device(device)
+    if device.type != 'cuda' or not all(torch.is_tensor(t) for t in tensors):
+        return False
+    free, _ = torch.cuda.mem_get_info(device)
+    rows = [t.shape[0] if n_rows is None else n_rows for t in tensors]
+    sizes = [t.numel() // max(t.shape[0], 1) * n * t.element_size() for t, n in zip(tensors, rows)]
+    n_bytes = sum(sizes) + max(sizes, default=0) + max(rows, default=0) * 8
+    return n_bytes < free * budget
+
+
+class BatchPrefetcher:
+    '''
+    Wraps SimpleSampler / SimpleSampler_2. A daemon thread draws ids from the sampler, gathers the rows on the host,
+    pins them and copies them to the device on a side stream; up to n_batches batches wait in the queue.
+    getbatch() makes the current stream wait for the copy of the batch it returns.
+    The sampler is only touched by the worker thread, apply_filter stops it while the sampler changes.
+    '''
+    def __init__(self, sampler, device, n_batches=2):
+        self.sampler = sampler
+        self.device = torch.device(device)
+        self.n_batches = n_batches
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        self.queue = None
+        self.thread = None
+        self.stop_event = None
+        self.start()
+
+    def start(self):
+        self.queue = queue.Queue(maxsize=self.n_batches)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        while self.thread.is_alive():
+            # a worker blocked on the full queue needs a free slot to see the stop flag
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.thread.join(timeout=0.01)
+
+    def _put(self, item):
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _worker(self):
+        try:
+            while not self.stop_event.is_set():
+                batch = self.sampler.gather(self.sampler.nextids())
+                ready = None
+                if self.stream is not None:
+                    batch = tuple(x.pin_memory() for x in batch)
+                    with torch.cuda.stream(self.stream):
+                        batch = tuple(x.to(self.device, non_blocking=True) for x in batch)
+                        ready = torch.cuda.Event()
+                        ready.record(self.stream)
+                self._put((batch, ready))
+        except Exception as e:
+            self._put(e)
+
+    def getbatch(self, device=None):
+        item = self.queue.get()
+        if isinstance(item, Exception):
+            raise item
+        batch, ready = item
+        if ready is not None:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(ready)
+            for x in batch:
+                # allocated on the side stream, used on the current one
+                x.record_stream(stream)
+        return batch
+
+    def apply_filter(self, func, *args, **kwargs):
+        # queued batches were drawn before the filter, they are dropped
+        self.stop()
+        self.sampler.apply_filter(func, *args, **kwargs)
+        self.start()
@@ -1,10 +1,12 @@
 import os
 import sys
+import time
+from functools import partial
+from contextlib import nullcontext
 from datetime import datetime
 from pathlib import Path
 
 import numpy as np
-from scipy.spatial import ConvexHull
 import torch
 try:
     from torch.utils.tensorboard import SummaryWriter
@@ -14,14 +16,20 @@ from tqdm import trange, tqdm
 
 from data import dataset_dict
 from data.read_depth import depth_dataset
+from data.ray_store import RayStore, gather_rows, pack_ray_store, ray_store_matches
 from models import MODEL_ZOO
+from models.baked_grid import BakedPaletteGrid
 from models.loss import TVLoss, PaletteBoundLoss,color_weight,bilateralFilter,color_correction,palette_loss
-from engine.eval import evaluation, evaluation_path
+from engine.eval import evaluation, evaluation_path, check_precision
+from engine.distributed import (get_rank, get_world_size, is_main_process, default_device, barrier, broadcast_module,
+                                allreduce_gradients, sync_alpha_mask, shard_sampler, NullWriter)
+from engine.prefetch import BatchPrefetcher, fits_on_device
 from utils.recon import convert_sdf_samples_to_ply
 from utils.render import chunkify_render, N_to_reso, cal_n_samples
+from utils.ray import get_rays_batched, get_rays_by_image, ndc_rays_blender
 from utils.fs import seek_checkpoint
-from utils.color import sort_palette
-from utils.palette_utils.Additive_mixing_layers_extraction import DCPPointTriangle, Hull_Simplification_determined_version
+from utils.color import quantized_color_statistics, sort_palette_counts
+from utils.palette_utils.Hull_simplification_fast import Hull_Simplification_fast_version
 
 
 class SimpleSampler:
@@ -34,26 +42,63 @@ class SimpleSampler:
         self.curr = self.total
         self.ids = None
         self.batch = batch
+        # host rays (tensors or memmaps) are never copied, filtering keeps the ids of the surviving rays instead
+        self.ray_ids = None
+        # buffers moved to the device by to_device(), shuffled there once per epoch
+        self.resident = False
 
     def apply_filter(self, func,is_depth=True, *args, **kwargs):
-        if is_depth:
-            self.all_rays, self.all_rgbs,self.final_mask = func(self.all_rays, self.all_rgbs,is_depth=is_depth,final_mask=self.final_mask, *args, **kwargs)
+        # only the rays that survived the previous filters are tested; depth and mask follow through the ids
+        if self.resident:
+            mask = func(self.all_rays, None, *args, return_mask=True, **kwargs)
+            self.all_rays, self.all_rgbs = compact_rows(self.all_rays, mask), compact_rows(self.all_rgbs, mask)
+            self.depth, self.final_mask = compact_rows(self.depth, mask), compact_rows(self.final_mask, mask)
+            self.total = self.all_rays.shape[0]
         else:
-            self.all_rays, self.all_rgbs = func(self.all_rays, self.all_rgbs,is_depth=is_depth, *args, **kwargs)
-        self.total = self.all_rays.shape[0]
+            mask = func(self.all_rays, None, *args, return_mask=True, ray_ids=self.ray_ids, **kwargs)
+            self.ray_ids = filter_ray_ids(mask, self.ray_ids)
+            self.total = self.ray_ids.shape[0]
         self.curr = self.total
         self.ids = None
 
     def nextids(self):
         self.curr += self.batch
         if self.curr + self.batch > self.total:
-            self.ids = torch.LongTensor(np.random.permutation(self.total))
+            if self.resident:
+                self.shuffle()
+            else:
+                self.ids = torch.LongTensor(np.random.permutation(self.total))
             self.curr = 0
-        return self.ids[self.curr:self.curr + self.batch]
+        if self.resident:
+            # the buffers themselves are shuffled, a batch is a view
+            return slice(self.curr, self.curr + self.batch)
+        ids = self.ids[self.curr:self.curr + self.batch]
+        if self.ray_ids is not None:
+            # sorted ids keep the reads from the memmap local
+            ids = torch.sort(self.ray_ids[ids])[0]
+        return ids
+
+    def to_device(self, device):
+        # the surviving rays stay on the device, batches are contiguous slices of them
+        ids = self.ray_ids if self.ray_ids is not None else slice(None)
+        self.all_rays, self.all_rgbs = gather_rows(self.all_rays, ids).to(device), gather_rows(self.all_rgbs, ids).to(device)
+        self.depth, self.final_mask = gather_rows(self.depth, ids).to(device), gather_rows(self.final_mask, ids).to(device)
+        self.ray_ids = None
+        self.resident = True
+        self.curr = self.total
+
+    def shuffle(self):
+        perm = torch.randperm(self.total, device=self.all_rays.device)
+        # one buffer at a time, the old one is freed before the next is permuted
+        for name in ('all_rays', 'all_rgbs', 'depth', 'final_mask'):
+            setattr(self, name, getattr(self, name)[perm])
+
+    def gather(self, ids):
+        return tuple(gather_rows(x, ids.to(x.device) if torch.is_tensor(x) and torch.is_tensor(ids) else ids)
+                     for x in (self.all_rays, self.all_rgbs, self.depth, self.final_mask))
 
     def getbatch(self, device):
-        ids = self.nextids()
-        return self.all_rays[ids].to(device), self.all_rgbs[ids].to(device),self.depth[ids].to(device),self.final_mask[ids].to(device)
+        return tuple(x.to(device) for x in self.gather(self.nextids()))
 
 class SimpleSampler_2:
     def __init__(self, train_dataset, batch):
@@ -63,10 +108,162 @@ class SimpleSampler_2:
         self.curr = self.total
         self.ids = None
         self.batch = batch
+        self.ray_ids = None
+        self.resident = False
 
     def apply_filter(self, func, *args, **kwargs):
-        self.all_rays, self.all_rgbs = func(self.all_rays, self.all_rgbs, *args, **kwargs)
-        self.total = self.all_rays.shape[0]
+        if self.resident:
+            mask = func(self.all_rays, None, *args, return_mask=True, **kwargs)
+            self.all_rays, self.all_rgbs = compact_rows(self.all_rays, mask), compact_rows(self.all_rgbs, mask)
+            self.total = self.all_rays.shape[0]
+        else:
+            mask = func(self.all_rays, None, *args, return_mask=True, ray_ids=self.ray_ids, **kwargs)
+            self.ray_ids = filter_ray_ids(mask, self.ray_ids)
+            self.total = self.ray_ids.shape[0]
+        self.curr = self.total
+        self.ids = None
+
+    def nextids(self):
+        self.curr += self.batch
+        if self.curr + self.batch > self.total:
+            if self.resident:
+                self.shuffle()
+            else:
+                self.ids = torch.LongTensor(np.random.permutation(self.total))
+            self.curr = 0
+        if self.resident:
+            return slice(self.curr, self.curr + self.batch)
+        ids = self.ids[self.curr:self.curr + self.batch]
+        if self.ray_ids is not None:
+            ids = torch.sort(self.ray_ids[ids])[0]
+        return ids
+
+    def to_device(self, device):
+        ids = self.ray_ids if self.ray_ids is not None else slice(None)
+        self.all_rays, self.all_rgbs = gather_rows(self.all_rays, ids).to(device), gather_rows(self.all_rgbs, ids).to(device)
+        self.ray_ids = None
+        self.resident = True
+        self.curr = self.total
+
+    def shuffle(self):
+        perm = torch.randperm(self.total, device=self.all_rays.device)
+        for name in ('all_rays', 'all_rgbs'):
+            setattr(self, name, getattr(self, name)[perm])
+
+    def gather(self, ids):
+        return tuple(gather_rows(x, ids.to(x.device) if torch.is_tensor(x) and torch.is_tensor(ids) else ids)
+                     for x in (self.all_rays, self.all_rgbs))
+
+    def getbatch(self, device):
+        return tuple(x.to(device) for x in self.gather(self.nextids()))
+
+class ImportanceSampler:
+    '''
+    Draws the rays of SimpleSampler / SimpleSampler_2 (host or resident) in proportion to their recent loss.
+    Consecutive rays (pixels of one image row) are grouped in blocks of block_size; every block keeps an EMA of the
+    squared error of its rays (float16, NaN until first visited). A batch picks blocks with
+        p_b = floor / n_blocks + (1 - floor) * e_b / sum(e)
+    and one uniform ray inside each picked block. batch_weight = 1 / (N * p(ray)) makes the weighted mean loss an
+    unbiased estimate of the uniform one.
+    '''
+    def __init__(self, sampler, batch, block_size=64, floor=0.1, momentum=0.1):
+        self.sampler = sampler
+        self.batch = batch
+        self.block_size = block_size
+        self.floor = floor
+        self.momentum = momentum
+        self.batch_weight = None
+        self.block_ids = None
+        self.reset()
+
+    def reset(self):
+        # block ids follow the stored ray order: a resident sampler only shuffles its buffers in its own nextids,
+        # which is never called here, and apply_filter compacts them in order
+        self.device = self.sampler.all_rays.device if torch.is_tensor(self.sampler.all_rays) else torch.device('cpu')
+        n_blocks = (self.sampler.total + self.block_size - 1) // self.block_size
+        self.loss_ema = torch.full((n_blocks,), float('nan'), dtype=torch.float16, device=self.device)
+
+    def apply_filter(self, func, *args, **kwargs):
+        # the surviving rays get new ids, the estimates start over
+        self.sampler.apply_filter(func, *args, **kwargs)
+        self.reset()
+
+    def block_probs(self):
+        ema = self.loss_ema.float()
+        visited = ~torch.isnan(ema)
+        # unvisited blocks count as the mean of the visited ones
+        fill = ema[visited].mean() if visited.any() else torch.ones((), device=ema.device)
+        ema = torch.where(visited, ema, fill).clamp(min=1e-8)
+        return self.floor / ema.shape[0] + (1 - self.floor) * ema / ema.sum()
+
+    def nextids(self):
+        total = self.sampler.total
+        probs = self.block_probs()
+        blocks = torch.multinomial(probs, self.batch, replacement=True)
+        block_len = (total - blocks * self.block_size).clamp(max=self.block_size)
+        ids = blocks * self.block_size + (torch.rand(self.batch, device=self.device) * block_len).long()
+
+        self.block_ids = blocks
+        self.batch_weight = block_len / (total * probs[blocks])
+        if self.sampler.ray_ids is not None:
+            ids = self.sampler.ray_ids[ids.cpu()]
+        return ids
+
+    def getbatch(self, device):
+        ids = self.nextids()
+        self.batch_weight = self.batch_weight.to(device)
+        return tuple(x.to(device) for x in self.sampler.gather(ids))
+
+    @torch.no_grad()
+    def update(self, ray_errors):
+        '''ray_errors: (batch,) squared error of the last batch, in getbatch order'''
+        blocks = self.block_ids
+        ray_errors = ray_errors.detach().float().to(self.device)
+        n_blocks = self.loss_ema.shape[0]
+        err_sum = torch.zeros(n_blocks, device=self.device).index_add_(0, blocks, ray_errors)
+        count = torch.bincount(blocks, minlength=n_blocks)
+        hit = torch.nonzero(count).squeeze(-1)
+        err = err_sum[hit] / count[hit]
+        old = self.loss_ema[hit].float()
+        new = torch.where(torch.isnan(old), err, (1 - self.momentum) * old + self.momentum * err)
+        self.loss_ema[hit] = new.half()
+
+
+class LazyRaySampler:
+    '''
+    Samples (image, pixel) ids over uint8 images and builds the rays of the batch on the device,
+    nothing of size N_rays x 6 is ever kept. Ray id = image index * H*W + pixel index, the same order
+    as the concatenated all_rays, so depth targets can be gathered with the same ids.
+    '''
+    def __init__(self, train_dataset, batch, device, depth_dataset=None):
+        self.all_rgbs = train_dataset.all_rgbs  # (N_images, h*w, 3) uint8
+        self.n_pixels = self.all_rgbs.shape[1]
+        self.directions = train_dataset.directions.view(-1, 3).to(device)
+        self.c2ws = torch.as_tensor(train_dataset.image_poses).float().to(device)
+        self.ndc_params = getattr(train_dataset, 'ndc_params', None)
+        self.depth = depth_dataset.all_depth if depth_dataset is not None else None
+        self.final_mask = depth_dataset.final_mask if depth_dataset is not None else None
+        self.device = device
+        self.total = self.all_rgbs.shape[0] * self.n_pixels
+        self.curr = self.total
+        self.ids = None
+        self.batch = batch
+        self.ray_ids = None
+
+    def build_rays(self, ids, sorted_ids=False):
+        # sorted_ids: ids ascending (runs of pixels of the same image), the rays are built image by image
+        ids = ids.to(self.device)
+        get_rays_fn = get_rays_by_image if sorted_ids else get_rays_batched
+        rays_o, rays_d = get_rays_fn(self.directions, self.c2ws, ids // self.n_pixels, ids % self.n_pixels)
+        if self.ndc_params is not None:
+            rays_o, rays_d = ndc_rays_blender(*self.ndc_params, rays_o, rays_d)
+        return torch.cat([rays_o, rays_d], 1)
+
+    def apply_filter(self, func, *args, **kwargs):
+        # func (filtering_rays) reads the surviving rays in its own chunks from LazyRays, only the mask over them is kept
+        mask = func(LazyRays(self), None, *args, return_mask=True, ray_ids=self.ray_ids, **kwargs)
+        self.ray_ids = filter_ray_ids(mask, self.ray_ids)
+        self.total = self.ray_ids.shape[0]
         self.curr = self.total
         self.ids = None
 
@@ -75,24 +272,67 @@ class SimpleSampler_2:
         if self.curr + self.batch > self.total:
             self.ids = torch.LongTensor(np.random.permutation(self.total))
             self.curr = 0
-        return self.ids[self.curr:self.curr + self.batch]
+        ids = self.ids[self.curr:self.curr + self.batch]
+        if self.ray_ids is not None:
+            ids = self.ray_ids[ids]
+        return ids
 
     def getbatch(self, device):
         ids = self.nextids()
-        return self.all_rays[ids].to(device), self.all_rgbs[ids].to(device)
+        rgbs = self.all_rgbs.view(-1, 3)[ids].to(device).float() / 255.
+        batch = (self.build_rays(ids), rgbs)
+        if self.depth is not None:
+            batch += (self.depth[ids].to(device), self.final_mask[ids].to(device))
+        return batch
+
+
+class LazyRays:
+    '''
+    The stored rays of a LazyRaySampler as an (N_rays, 6) array for filtering_rays: rows (a slice or sorted ids) are
+    built when they are read.
+    '''
+    def __init__(self, sampler):
+        self.sampler = sampler
+        self.shape = (sampler.all_rgbs.shape[0] * sampler.n_pixels, 6)
+
+    def __getitem__(self, ids):
+        if isinstance(ids, slice):
+            ids = torch.arange(*ids.indices(self.shape[0]))
+        return self.sampler.build_rays(ids, sorted_ids=True)
+
+
+def filter_ray_ids(mask, ray_ids=None):
+    # mask is over the ids that survived every filter so far (all stored rays for the first one)
+    if ray_ids is None:
+        return torch.nonzero(mask).squeeze(-1)
+    return ray_ids[mask.to(ray_ids.device)]
+
+def compact_rows(x, mask, chunk=1 << 20):
+    # stable in-place compaction of the rows where mask is set, returns a view of the kept rows
+    mask = mask.to(x.device)
+    n = 0
+    for start in range(0, x.shape[0], chunk):
+        rows = x[start:start + chunk][mask[start:start + chunk]]
+        x[n:n + rows.shape[0]] = rows
+        n += rows.shape[0]
+    return x[:n]
 
 class Trainer:
     def __init__(self, args, run_dir, ckpt_dir, tb_dir):
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.device = default_device()
+        self.rank, self.world_size = get_rank(), get_world_size()
         '''
         渲染位置
         '''
-        self.renderer = chunkify_render
+        self.renderer = partial(chunkify_render, mem_budget=args.render_mem_budget,
+                                out_device='cpu' if args.render_to_host else None)
 
         self.args = args
         self.optimizer = None
         self.summary_writer = None
         self.trainingSampler = None
+        # mixed precision: float16 gradients underflow without loss scaling, bfloat16 has the fp32 exponent range
+        self.amp_dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16}.get(args.amp)
 
         self.run_dir = run_dir
         self.ckpt_dir = ckpt_dir
@@ -100,12 +340,22 @@ class Trainer:
 
         # init dataset
         dataset = dataset_dict[args.dataset_name]  #blenderDataset
-        self.train_dataset = dataset(args.datadir, split='train', downsample=args.downsample_train, is_stack=False,spheric_poses=self.args.spheric_poses)
+        assert not (args.ray_store and args.lazy_rays), '--ray_store and --lazy_rays can not be used together'
+        if args.lazy_rays:
+            self.train_dataset = dataset(args.datadir, split='train', downsample=args.downsample_train, is_stack=False,spheric_poses=self.args.spheric_poses, lazy_rays=True)
+        elif args.ray_store:
+            self.train_dataset = self.load_ray_store(dataset)
+        else:
+            self.train_dataset = dataset(args.datadir, split='train', downsample=args.downsample_train, is_stack=False,spheric_poses=self.args.spheric_poses)
         self.test_dataset = dataset(args.datadir, split='test', downsample=args.downsample_train, is_stack=True,spheric_poses=self.args.spheric_poses)
 
         if args.depth_loss >0:
-            self.depth_train_dataset = depth_dataset(args.datadir,self.train_dataset.poses.shape[0],self.train_dataset.poses,
-                                                 split='train',downsample=args.downsample_train,is_stack=False)
+            if args.ray_store:
+                # depth and mask are packed next to the rays
+                self.depth_train_dataset = self.train_dataset
+            else:
+                self.depth_train_dataset = depth_dataset(args.datadir,self.train_dataset.poses.shape[0],self.train_dataset.poses,
+                                                     split='train',downsample=args.downsample_train,is_stack=False)
         # init parameters
         self.aabb = self.train_dataset.scene_bbox.to(self.device) #init [[-1.5,-1.5,-1.5],[1.5,1.5,1.5]]
         # 计算体素个数
@@ -113,29 +363,46 @@ class Trainer:
         self.nSamples = min(args.nSamples, cal_n_samples(self.reso_cur, args.step_ratio))  #体素个数二范数/0.5
         self.palette_prior, self.plt_bds_convhull_vtx = self.build_palette(args.palette_path)
         
-        np.save(os.path.join(run_dir, 'palette_prior.npy'), self.palette_prior.numpy())
+        if is_main_process():
+            np.save(os.path.join(run_dir, 'palette_prior.npy'), self.palette_prior.numpy())
         print("[trainer init] aabb", self.aabb.tolist())
         print("[trainer init] num of render samples", self.nSamples)
         print("[trainer init] palette shape", self.palette_prior.shape)
 
+    def load_ray_store(self, dataset):
+        args = self.args
+        store_key = {'dataset_name': args.dataset_name, 'datadir': args.datadir,
+                     'downsample': args.downsample_train, 'spheric_poses': args.spheric_poses}
+        if not is_main_process():
+            # rank 0 packs the store, the other ranks only map it
+            barrier()
+        if not ray_store_matches(args.ray_store, with_depth=args.depth_loss > 0, **store_key):
+            # decode the images once, later runs only map the packed files
+            train_dataset = dataset(args.datadir, split='train', downsample=args.downsample_train, is_stack=False,spheric_poses=args.spheric_poses)
+            train_depth = None
+            if args.depth_loss > 0:
+                train_depth = depth_dataset(args.datadir,train_dataset.poses.shape[0],train_dataset.poses,
+                                            split='train',downsample=args.downsample_train,is_stack=False)
+            pack_ray_store(args.ray_store, train_dataset, train_depth, **store_key)
+            del train_dataset, train_depth
+        if is_main_process():
+            barrier()
+        return RayStore(args.ray_store)
+
     def build_palette(self, filepath, is_sort_palette=True):
-        rgbs = self.train_dataset.all_rgbs  # 维数 64000000，3
-        if self.train_dataset.white_bg:
-            #torch.lt 逐元素比较 小于为真
-            fg = torch.lt(rgbs, 1.).any(dim=-1) #维数 64000000， 把白色像素剔除
-            rgbs = rgbs[fg]   #维数  13003178，3
-
-        rgbs = rgbs.to(device='cpu', dtype=torch.double).numpy()
-        hull = ConvexHull(rgbs)
-        hull_vertices = hull.points[hull.vertices]
+        # 逐块统计量化颜色直方图和凸包, 不再把所有像素 (64000000，3) 转成 float64
+        colors, counts, hull_vertices = quantized_color_statistics(self.train_dataset.all_rgbs,
+                                                                   white_bg=self.train_dataset.white_bg)
+        print(f'[build_palette] {int(counts.sum())} pixels, {len(colors)} color bins, {len(hull_vertices)} hull vertices')
         if filepath:
             palette = np.load(filepath)
         else:
             simplify = True
             error_thres = 2. / 256.
-            palette = Hull_Simplification_determined_version(rgbs, "", error_thres=error_thres) if simplify else hull_vertices
+            palette = Hull_Simplification_fast_version(hull_vertices, "", error_thres=error_thres,
+                                                       unique_data=colors, pixel_counts=counts) if simplify else hull_vertices
             if is_sort_palette:
-                palette = sort_palette(rgbs, palette)
+                palette = sort_palette_counts(colors, counts, palette)
         palette = torch.from_numpy(palette).float()
         
         return palette, hull_vertices
@@ -172,6 +439,9 @@ class Trainer:
                 featureC=args.featureC, step_ratio=args.step_ratio, fea2denseAct=args.fea2denseAct,
                 palette=palette, learn_palette=args.learn_palette, palette_init=args.palette_init,
                 soft_l0_sharpness=args.soft_l0_sharpness)
+        tensorf.skip_empty_space = bool(args.skip_empty_space)
+        tensorf.ray_term_thres = args.ray_term_thres
+        tensorf.ray_term_segment = args.ray_term_segment
 
         return tensorf
 
@@ -182,14 +452,27 @@ class Trainer:
         # create model
         tensorf = self.build_network()
         tensorf.train()
+        if self.world_size > 1:
+            # every rank starts from the weights of rank 0, then draws its own jitter and batches
+            broadcast_module(tensorf)
+            torch.manual_seed(torch.initial_seed() + self.rank)
+            np.random.seed(torch.initial_seed() % 2 ** 32)
+            print(f'[trainer train] data parallel over {self.world_size} ranks, {args.batch_size} rays per rank')
 
         # create optimizer
         grad_vars = tensorf.get_optparam_groups(args.lr_init, args.lr_basis)
         self.optimizer = torch.optim.Adam(grad_vars, betas=(0.9, 0.99))
+
+        scaler_enabled = self.amp_dtype == torch.float16 and self.device.type == 'cuda'
+        if hasattr(torch.amp, 'GradScaler'):
+            self.grad_scaler = torch.amp.GradScaler('cuda', enabled=scaler_enabled)
+        else:
+            self.grad_scaler = torch.cuda.amp.GradScaler(enabled=scaler_enabled)
+        print("[trainer train] amp", args.amp or 'off', "grad scaler", scaler_enabled)
         
         # loss function and regularization
         self.tvreg = TVLoss()
-        self.plt_bd_reg = PaletteBoundLoss(self.plt_bds_convhull_vtx)
+        self.plt_bd_reg = PaletteBoundLoss(self.plt_bds_convhull_vtx).to(self.device)
         self.color_weight = color_weight()
         self.color_correction = color_correction()
         self.Plt_loss_sigma_x=args.Plt_loss_sigma_x
@@ -238,10 +521,13 @@ class Trainer:
 
         # recorder
         PSNRs, PSNRs_test = [], [0]
-        self.summary_writer = SummaryWriter(log_dir=self.tb_dir)
+        self.summary_writer = SummaryWriter(log_dir=self.tb_dir) if is_main_process() else NullWriter()
 
         # data sampler
-        if self.depth_loss > 0:
+        if args.lazy_rays:
+            depth_train_dataset = self.depth_train_dataset if self.depth_loss > 0 else None
+            self.trainingSampler = LazyRaySampler(self.train_dataset, args.batch_size, self.device, depth_train_dataset)
+        elif self.depth_loss > 0:
             self.trainingSampler = SimpleSampler(self.train_dataset,self.depth_train_dataset, args.batch_size)
         else:
             self.trainingSampler = SimpleSampler_2(self.train_dataset,args.batch_size)
@@ -249,21 +535,51 @@ class Trainer:
         if not args.ndc_ray:
             is_depth = self.depth_loss > 0
             self.trainingSampler.apply_filter(tensorf.filtering_rays,is_depth=is_depth, bbox_only=True)
+        # disjoint rays per rank, before the rays are moved to the device
+        shard_sampler(self.trainingSampler, self.rank, self.world_size)
+
+        if not args.lazy_rays:
+            sampler = self.trainingSampler
+            buffers = [sampler.all_rays, sampler.all_rgbs] + ([sampler.depth, sampler.final_mask] if self.depth_loss > 0 else [])
+            if args.resident_rays_budget > 0 and fits_on_device(buffers, self.device, args.resident_rays_budget, n_rows=sampler.total):
+                print('[trainer train] training rays kept and shuffled on the device')
+                sampler.to_device(self.device)
+            else:
+                if args.resident_rays_budget > 0:
+                    print('[trainer train] training rays do not fit the device budget, sampling on the host')
+                if args.prefetch_batches > 0 and args.importance_block <= 0:
+                    print(f'[trainer train] prefetching {args.prefetch_batches} batches in the background')
+                    self.trainingSampler = BatchPrefetcher(sampler, self.device, args.prefetch_batches)
+            if args.importance_block > 0:
+                # batches depend on the loss of the previous step, they can not be prefetched
+                print(f'[trainer train] importance sampling over blocks of {args.importance_block} rays')
+                self.trainingSampler = ImportanceSampler(sampler, args.batch_size, args.importance_block, args.importance_floor,
+                                                         args.importance_momentum)
 
         # start training
         print(f'=== training ======> {args.expname}')
         
         torch.cuda.empty_cache()
         
-        pbar = trange(args.n_iters, miniters=args.progress_refresh_every, file=sys.stdout, position=0, leave=True)
+        pbar = trange(args.n_iters, miniters=args.progress_refresh_every, file=sys.stdout, position=0, leave=True,
+                      disable=not is_main_process())
+        rays_per_sec = []
         for iteration in pbar:
             ###### Core optimization ######
+            iter_start = time.time()
             batch_train = self.trainingSampler.getbatch(device=self.device)
-            loss_dict = self.train_one_batch(tensorf, iteration, *batch_train)
+            if isinstance(self.trainingSampler, ImportanceSampler):
+                loss_dict = self.train_one_batch(tensorf, iteration, *batch_train, weight=self.trainingSampler.batch_weight)
+                self.trainingSampler.update(loss_dict.pop('ray_errors'))
+            else:
+                loss_dict = self.train_one_batch(tensorf, iteration, *batch_train)
+            # loss_dict holds python floats, the step has been synchronized already
+            rays_per_sec.append(batch_train[0].shape[0] * self.world_size / (time.time() - iter_start))
             
             ###### Logging ######
             total_loss = loss_dict['total_loss']
             self.summary_writer.add_scalar('train/total_loss', total_loss, global_step=iteration)
+            self.summary_writer.add_scalar('train/rays_per_sec', rays_per_sec[-1], global_step=iteration)
 
             img_loss = loss_dict['img_loss']
             PSNRs.append(-10.0 * np.log(img_loss) / np.log(10.0))
@@ -301,11 +617,13 @@ class Trainer:
                     + f' train_psnr = {float(np.mean(PSNRs)):.2f}'
                     + f' test_psnr = {float(np.mean(PSNRs_test)):.2f}'
                     + f' mse = {img_loss:.6f}'
+                    + f' rays/s = {float(np.mean(rays_per_sec)):.0f}'
                 )
                 PSNRs = []
+                rays_per_sec = []
 
             # Evaluation on testset
-            if iteration % args.vis_every == args.vis_every - 1 and args.N_vis != 0:
+            if iteration % args.vis_every == args.vis_every - 1 and args.N_vis != 0 and is_main_process():
                 try:
                     print(f'== evaluation ======> {args.N_vis} views')
                     savePath = Path(self.run_dir, f'testset_vis_{iteration:06d}')
@@ -321,6 +639,8 @@ class Trainer:
             self.update_grid_resolution(tensorf, iteration)
         print('training finished!')
 
+        if not is_main_process():
+            return
         tensorf.save(f'{self.ckpt_dir}/{args.expname}_last.th')
         # self.render_test(tensorf)
         print('evaluation finished!')
@@ -328,28 +648,38 @@ class Trainer:
         np.save('palette_rgb_11.npy',tensorf.get_palette_array().detach().cpu().numpy())
         print('save palette finished~+!!!!')
 
-    def train_one_batch(self, tensorf, iteration, rays_train, rgb_train,depth=None,final_mask=None):
+    def train_one_batch(self, tensorf, iteration, rays_train, rgb_train,depth=None,final_mask=None,weight=None):
+        '''weight: (N,) per ray weights of the photometric losses (ImportanceSampler), the per ray errors are then returned in loss_dict['ray_errors']'''
         args = self.args
         white_bg = self.train_dataset.white_bg
         ndc_ray = args.ndc_ray
 
         loss_dict = {}
 
-        # render training rays
-        res = self.renderer(
-            rays_train, tensorf, chunk=args.batch_size, N_samples=self.nSamples,
-            white_bg=white_bg, ndc_ray=ndc_ray, device=self.device, is_train=True,
-            ret_sparsity_norm_map=True, ret_convexity_residual_map=True, ret_rgb0_map=True, ret_opaque_map=True,ret_color_correction_map=True)
+        # render training rays, feature queries and MLPs under autocast; the rendered maps are fp32
+        with self.autocast():
+            res = self.renderer(
+                rays_train, tensorf, chunk=args.batch_size, N_samples=self.nSamples,
+                white_bg=white_bg, ndc_ray=ndc_ray, device=self.device, is_train=True,
+                ret_sparsity_norm_map=True, ret_convexity_residual_map=True, ret_rgb0_map=True, ret_opaque_map=True,ret_color_correction_map=True)
 
         # Loss
-        img_loss = torch.mean((res['rgb_map'] - rgb_train) ** 2)
+        if weight is None:
+            img_loss = torch.mean((res['rgb_map'] - rgb_train) ** 2)
+        else:
+            ray_errors = torch.mean((res['rgb_map'] - rgb_train) ** 2, dim=-1)
+            img_loss = torch.mean(weight * ray_errors)
+            loss_dict['ray_errors'] = ray_errors.detach()
 
 
         total_loss = img_loss
         #res rgb_map opaque_map sparsity_norm_map depth_map
 
         if 'rgb0_map' in res:
-            img_loss_0 = torch.mean((res['rgb0_map'] - rgb_train) ** 2)
+            if weight is None:
+                img_loss_0 = torch.mean((res['rgb0_map'] - rgb_train) ** 2)
+            else:
+                img_loss_0 = torch.mean(weight[:, None] * (res['rgb0_map'] - rgb_train) ** 2)
             total_loss = total_loss + img_loss_0
 
         if 'depth_map' in res and self.depth_loss>0:
@@ -359,13 +689,16 @@ class Trainer:
             total_loss = total_loss + depth_loss
 
         if 'color_correction_map' in res and self.color_correction_weight>0:
-            color_correction_loss,img_loss0 = self.color_correction(rgb_train,res['rgb_map'],res['color_correction_map'],self.color_correction_weight)
+            color_correction_loss,img_loss0 = self.color_correction(rgb_train,res['rgb_map'],res['color_correction_map'],self.color_correction_weight,weight=weight)
             assert torch.isfinite(color_correction_loss)
             total_loss = total_loss + color_correction_loss
 
             loss_dict['img_loss'] = img_loss0.clone().detach().item()
-        else:
+        elif weight is None:
             loss_dict['img_loss'] = img_loss.clone().detach().item()
+        else:
+            # train psnr from the unweighted mse, comparable with uniform sampling
+            loss_dict['img_loss'] = ray_errors.mean().item()
 
         if self.palette_loss>0:
             palette_t = tensorf.get_palette_array()
@@ -426,8 +759,12 @@ class Trainer:
         loss_dict['total_loss'] = total_loss.clone().detach().item()
 
         self.optimizer.zero_grad()
-        total_loss.backward()
-        self.optimizer.step()
+        self.grad_scaler.scale(total_loss).backward()
+        if self.world_size > 1:
+            # (scaled) gradients averaged over the ranks, every rank then takes the same step
+            allreduce_gradients([p for group in self.optimizer.param_groups for p in group['params']])
+        self.grad_scaler.step(self.optimizer)
+        self.grad_scaler.update()
 
         # LR shrinkage
         for param_group in self.optimizer.param_groups:
@@ -435,6 +772,11 @@ class Trainer:
 
         return loss_dict
 
+    def autocast(self):
+        if self.amp_dtype is None:
+            return nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=self.amp_dtype)
+
     def update_grid_resolution(self, tensorf, iteration):
         args = self.args
         # init resolution
@@ -445,9 +787,10 @@ class Trainer:
             # if self.reso_cur[0] * self.reso_cur[1] * self.reso_cur[2] < 256 ** 3:
             # update mask volume resolution
             reso_mask = self.reso_cur
-            new_aabb = tensorf.updateAlphaMask(tuple(reso_mask))
+            new_aabb = sync_alpha_mask(tensorf, tensorf.updateAlphaMask(tuple(reso_mask)))
             if iteration == update_AlphaMask_list[0]:
                 tensorf.shrink(new_aabb)
+                broadcast_module(tensorf)
                 self.L1_reg_weight = args.L1_weight_rest
                 print("[update_grid_resolution] set L1_reg_weight to", self.L1_reg_weight)
 
@@ -460,6 +803,7 @@ class Trainer:
             self.reso_cur = N_to_reso(n_voxels, tensorf.aabb)
             self.nSamples = min(args.nSamples, cal_n_samples(self.reso_cur, args.step_ratio))
             tensorf.upsample_volume_grid(self.reso_cur)
+            broadcast_module(tensorf)
 
             if args.lr_upsample_reset:
                 print("[update_grid_resolution] reset lr to initial")
@@ -482,6 +826,30 @@ class Trainer:
         alpha, _ = tensorf.getDenseAlpha()
         convert_sdf_samples_to_ply(alpha.cpu(), f'{args.ckpt[:-3]}.ply', bbox=tensorf.aabb.cpu(), level=0.005)
 
+    @torch.no_grad()
+    def export_baked(self):
+        args = self.args
+        ckpt = torch.load(args.ckpt, map_location=self.device)
+        kwargs = ckpt['kwargs']
+        kwargs.update({'device': self.device})
+        tensorf = MODEL_ZOO[args.model_name](**kwargs)
+        tensorf.load(ckpt)
+        tensorf.eval()
+
+        baked = BakedPaletteGrid.bake(tensorf)
+        baked.save(f'{args.ckpt[:-3]}_baked.th')
+        print(f'[export_baked] saved to {args.ckpt[:-3]}_baked.th')
+
+    def load_baked(self):
+        # the grid written by export_baked for --ckpt, renders without the feature grids and MLPs
+        args = self.args
+        assert args.ckpt, '--render_baked needs --ckpt, the baked grid is read from <ckpt>_baked.th'
+        baked_path = f'{args.ckpt[:-3]}_baked.th'
+        if not os.path.exists(baked_path):
+            raise FileNotFoundError(f'[load_baked] {baked_path} not found, run with --export_baked 1 first')
+        print(f'[load_baked] {baked_path}')
+        return BakedPaletteGrid.load(baked_path, device=self.device)
+
     @torch.no_grad()
     def render_test(self, tensorf):
         args = self.args
@@ -492,6 +860,13 @@ class Trainer:
 
         logfolder = Path(self.run_dir)
 
+        if args.amp or args.half_inference:
+            # fp32 reference against the reduced precision renders on the same test views,
+            # with --half_inference tensorf is converted in place and the renders below use float16
+            print(f'=== precision check ======> {args.N_vis} views')
+            check_precision(self.test_dataset, tensorf, args, self.renderer, N_vis=args.N_vis, white_bg=white_bg,
+                            ndc_ray=ndc_ray, device=self.device, amp_dtype=self.amp_dtype, half=bool(args.half_inference))
+
         PSNRs_test = None
         if args.render_train:
             print(f'=== render train ======> {args.expname}')
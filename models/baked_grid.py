@@ -0,0 +1,191 @@
+import itertools
+
+import torch
+import torch.nn.functional as F
+
+from .tensorBase import RenderBufferProp, raw2alpha, split_render_buffer, pack_bits, lookup_bits
+
+
+'''
+烘焙调色板网格: 在 alpha mask 占据的网格点上预先计算密度, 调色板权重和颜色修正,
+渲染时只做三线性插值和调色板混合, 不再调用 MLP
+'''
+
+class BakedPaletteGrid(torch.nn.Module):
+    '''
+    Sparse voxel grid baked from a PaletteTensorVM. Values live on the nodes of the model grid (align_corners
+    convention), only occupied nodes are stored, sorted by flat index (x * Gy * Gz + y * Gz + z):
+        voxel_ids (M,) int64, sigma (M,) float32, features (M, n_palette + 3) float16 = [palette weights, color correction]
+    forward() follows TensorBase.forward so the grid can be passed to chunkify_render / evaluation in place of the model;
+    palette replaces the baked palette, the per point palettes of PLTRender (new_palette with is_choose) are not supported.
+    '''
+    def __init__(self, aabb, gridSize, voxel_ids, sigma, features, palette, near_far, stepSize, nSamples, distance_scale,
+                 device='cpu'):
+        super(BakedPaletteGrid, self).__init__()
+        self.device = device
+        self.register_buffer('aabb', torch.as_tensor(aabb, dtype=torch.float32).to(device))
+        self.register_buffer('gridSize', torch.as_tensor(gridSize, dtype=torch.long).to(device))
+        self.register_buffer('voxel_ids', voxel_ids.to(device))
+        self.register_buffer('sigma', sigma.to(device))
+        self.register_buffer('features', features.to(device))
+        self.register_buffer('palette', torch.as_tensor(palette, dtype=torch.float32).to(device))
+        self.near_far = near_far
+        self.stepSize = float(stepSize)
+        self.nSamples = int(nSamples)
+        self.distance_scale = distance_scale
+        self.n_palette = self.palette.shape[0]
+        # the maps forward can return, as the render_buf_layout of the model
+        self.render_buf_layout = [RenderBufferProp('rgb', 3, False, 'RGB'),
+                                  RenderBufferProp('opaque', self.n_palette, True),
+                                  RenderBufferProp('color_correction', 3, True)]
+
+        # one bit per grid node, corners of empty nodes are rejected before the binary search
+        node_mask = torch.zeros(int(self.gridSize.prod()), dtype=torch.bool, device=device)
+        node_mask[self.voxel_ids] = True
+        self.node_bits = pack_bits(node_mask)
+
+    @classmethod
+    @torch.no_grad()
+    def bake(cls, tensorf, n_views=8, chunk=65536):
+        '''
+        Evaluate density and the render module at every occupied grid node of tensorf. The palette weights and the
+        color correction depend on the view direction, they are averaged over n_views directions (cube diagonals).
+        '''
+        layout = {p.name: p for p in tensorf.render_buf_layout}
+        if 'opaque' not in layout:
+            raise ValueError('[BakedPaletteGrid] baking needs a palette render module (PLT_AlphaBlend / PLT_Direct)')
+        device = tensorf.device
+        gridSize = tensorf.gridSize.tolist()
+        aabb = tensorf.aabb
+        n_palette = layout['opaque'].len
+
+        view_dirs = F.normalize(torch.tensor(list(itertools.product((-1., 1.), repeat=3)), device=device), dim=-1)
+        view_dirs = view_dirs[:max(1, min(n_views, len(view_dirs)))]
+
+        axes = [torch.linspace(0, 1, n, device=device) for n in gridSize]
+        grid_y, grid_z = torch.meshgrid(axes[1], axes[2], indexing='ij')
+        slab_size = gridSize[1] * gridSize[2]
+
+        voxel_ids, sigma, features = [], [], []
+        for i in range(gridSize[0]):
+            # one x slab at a time, the dense grid is never materialized
+            samples = torch.stack([torch.full_like(grid_y, axes[0][i].item()), grid_y, grid_z], -1).view(-1, 3)
+            xyz = aabb[0] * (1 - samples) + aabb[1] * samples
+            if tensorf.alphaMask is not None:
+                keep = tensorf.alphaMask.occupied(xyz)
+            else:
+                keep = torch.ones_like(xyz[:, 0], dtype=torch.bool)
+            slab_ids = torch.nonzero(keep).squeeze(-1)
+            xyz = xyz[slab_ids]
+
+            for start in range(0, xyz.shape[0], chunk):
+                xyz_chunk = tensorf.normalize_coord(xyz[start:start + chunk])
+                sigma_feature, app_features = tensorf.compute_features(xyz_chunk)
+                sigma.append(tensorf.feature2density(sigma_feature))
+
+                feat = torch.zeros((xyz_chunk.shape[0], n_palette + 3), device=device)
+                for d in view_dirs:
+                    render_bufs = tensorf.renderModule(xyz_chunk, d.expand(xyz_chunk.shape), app_features, False)
+                    rend_dict = split_render_buffer(render_bufs.float(), tensorf.render_buf_layout)
+                    feat[:, :n_palette] += rend_dict['opaque']
+                    if 'color_correction' in rend_dict:
+                        feat[:, n_palette:] += rend_dict['color_correction']
+                features.append((feat / len(view_dirs)).half())
+            voxel_ids.append(slab_ids + i * slab_size)
+
+        voxel_ids = torch.cat(voxel_ids)
+        sigma = torch.cat(sigma) if sigma else torch.zeros(0, device=device)
+        features = torch.cat(features) if features else torch.zeros((0, n_palette + 3), device=device).half()
+        print(f'[BakedPaletteGrid] baked {voxel_ids.shape[0]} of {gridSize[0] * slab_size} grid nodes')
+
+        return cls(aabb, gridSize, voxel_ids, sigma, features, tensorf.get_palette_array().detach().clamp(0, 1),
+                   tensorf.near_far, tensorf.stepSize, tensorf.nSamples, tensorf.distance_scale, device=device)
+
+    def save(self, path):
+        torch.save({'aabb': self.aabb.cpu(), 'gridSize': self.gridSize.cpu(), 'voxel_ids': self.voxel_ids.cpu(),
+                    'sigma': self.sigma.cpu(), 'features': self.features.cpu(), 'palette': self.palette.cpu(),
+                    'near_far': self.near_far, 'stepSize': self.stepSize, 'nSamples': self.nSamples,
+                    'distance_scale': self.distance_scale}, path)
+
+    @classmethod
+    def load(cls, path, device='cpu'):
+        return cls(**torch.load(path, map_location='cpu'), device=device)
+
+    def get_palette_array(self):
+        return self.palette
+
+    def lookup(self, xyz):
+        '''Trilinear interpolation of the sparse node values, missing nodes count as empty'''
+        grid = (xyz - self.aabb[0]) / (self.aabb[1] - self.aabb[0]) * (self.gridSize - 1)
+        base = torch.floor(grid)
+        frac = grid - base
+        base = base.long()
+        Gy, Gz = self.gridSize[1], self.gridSize[2]
+
+        sigma = torch.zeros(xyz.shape[0], device=xyz.device)
+        features = torch.zeros((xyz.shape[0], self.features.shape[-1]), device=xyz.device)
+        if self.voxel_ids.numel() == 0:
+            return sigma, features
+        for corner in itertools.product((0, 1), repeat=3):
+            offset = torch.tensor(corner, device=xyz.device)
+            idx = base + offset
+            inside = ((idx >= 0) & (idx < self.gridSize)).all(-1)
+            flat = (idx[:, 0] * Gy + idx[:, 1]) * Gz + idx[:, 2]
+            hit = torch.nonzero(inside & lookup_bits(self.node_bits, torch.where(inside, flat, 0))).squeeze(-1)
+            if hit.numel() == 0:
+                continue
+            pos = torch.searchsorted(self.voxel_ids, flat[hit])
+            w = torch.where(offset.bool(), frac[hit], 1 - frac[hit]).prod(-1)
+            sigma.index_add_(0, hit, w * self.sigma[pos])
+            features.index_add_(0, hit, w[:, None] * self.features[pos].float())
+        return sigma, features
+
+    @torch.no_grad()
+    def forward(self, rays_chunk, white_bg=True, is_train=False, ndc_ray=False, N_samples=-1, palette=None, **kwargs):
+        if kwargs.get('is_choose', False) or kwargs.get('new_palette') is not None:
+            # PLTRender picks these colors per sample with the point classifiers (net1 / net2), nothing of that is baked
+            raise ValueError('[BakedPaletteGrid] only blends the baked palette weights with one palette (palette=...), '
+                             'new_palette / is_choose need the trained model, render without --render_baked')
+        N_samples = N_samples if N_samples > 0 else self.nSamples
+        rays_o, rays_d = rays_chunk[:, :3], rays_chunk[:, 3:6]
+        near, far = self.near_far
+
+        if ndc_ray:
+            z_vals = torch.linspace(near, far, N_samples, device=rays_o.device)[None].expand(rays_o.shape[0], -1)
+            dists = torch.cat((z_vals[:, 1:] - z_vals[:, :-1], torch.zeros_like(z_vals[:, :1])), dim=-1)
+            dists = dists * torch.norm(rays_d, dim=-1, keepdim=True)
+        else:
+            vec = torch.where(rays_d == 0, torch.full_like(rays_d, 1e-6), rays_d)
+            rate_a = (self.aabb[1] - rays_o) / vec
+            rate_b = (self.aabb[0] - rays_o) / vec
+            t_min = torch.minimum(rate_a, rate_b).amax(-1).clamp(min=near, max=far)
+            z_vals = t_min[:, None] + self.stepSize * torch.arange(N_samples, device=rays_o.device)[None].float()
+            dists = torch.cat((z_vals[:, 1:] - z_vals[:, :-1], torch.zeros_like(z_vals[:, :1])), dim=-1)
+
+        xyz_sampled = rays_o[:, None] + rays_d[:, None] * z_vals[..., None]
+        ray_valid = ((self.aabb[0] <= xyz_sampled) & (xyz_sampled <= self.aabb[1])).all(dim=-1)
+
+        sigma = torch.zeros(z_vals.shape, device=rays_o.device)
+        features = torch.zeros((*z_vals.shape, self.features.shape[-1]), device=rays_o.device)
+        if ray_valid.any():
+            sigma[ray_valid], features[ray_valid] = self.lookup(xyz_sampled[ray_valid])
+
+        alpha, weight, bg_weight = raw2alpha(sigma, dists * self.distance_scale)
+        acc_map = torch.sum(weight, -1)
+        feature_map = torch.sum(weight[..., None] * features, -2)
+        opaque_map = feature_map[:, :self.n_palette]
+
+        palette = self.palette if palette is None else palette.to(opaque_map)
+        rgb_map = opaque_map @ palette
+        if white_bg:
+            rgb_map = rgb_map + (1. - acc_map[..., None])
+        ret = {'rgb_map': rgb_map.clamp(0, 1),
+               'depth_map': torch.sum(weight * z_vals, -1) + (1. - acc_map) * rays_chunk[..., -1]}
+
+        if kwargs.get('ret_opaque_map', False):
+            ret['opaque_map'] = opaque_map
+        if kwargs.get('ret_color_correction_map', False):
+            ret['color_correction_map'] = feature_map[:, self.n_palette:]
+        if kwargs.get('ret_acc_map', False):
+            ret['acc_map'] = acc_map
+        return ret
@@ -2,10 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
-from pytorch3d.ops import knn_points
-from scipy.spatial import ConvexHull, Delaunay
-from operator import itemgetter
-from utils.palette_utils.Additive_mixing_layers_extraction import DCPPointTriangle
+from scipy.spatial import ConvexHull
 
 
 class color_weight(nn.Module):
@@ -20,11 +17,16 @@ class color_correction(nn.Module):
     def __init__(self):
         super(color_correction,self).__init__()
 
-    def forward(self,rgb_original,rgb,x,gama=0.1):
-        img_loss = torch.mean((rgb_original - (rgb+ x @ torch.tensor([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0., 0., 1.]]).to(rgb.device)))**2.)
+    def forward(self,rgb_original,rgb,x,gama=0.1,weight=None):
+        # weight: (N,) per ray weights, e.g. the unbiasing weights of importance sampling
+        if weight is None:
+            weight = torch.ones_like(rgb[..., 0])
+        err = (rgb_original - (rgb+ x @ torch.tensor([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0., 0., 1.]]).to(rgb.device)))**2.
+        img_loss = torch.mean(weight[..., None] * err)
         x = x ** 2
-        color_correction_loss = torch.mean(torch.exp(torch.sum(x,dim=-1)) - 1.)
-        return img_loss + color_correction_loss * gama,img_loss
+        color_correction_loss = torch.mean(weight * (torch.exp(torch.sum(x,dim=-1)) - 1.))
+        # the second value is the unweighted mse, what the train psnr is logged from
+        return img_loss + color_correction_loss * gama,torch.mean(err)
 
 class palette_loss(nn.Module):
     def __init__(self):
@@ -74,30 +76,65 @@ class TVLoss(nn.Module):
         return t.size()[1] * t.size()[2] * t.size()[3]
 
 
+def closest_point_on_triangles(p, tri):
+    '''
+    Batched closest point on triangles (Ericson, Real-Time Collision Detection 5.1.5).
+    p: (..., 3), tri: (..., 3, 3) broadcastable, returns (..., 3)
+    Replaces DCPPointTriangle in PaletteBoundLoss. That one (GteDistPointTriangle.pyx, built by pyximport) works, but
+    takes one float64 numpy point and triangle per call, so every step copied the palette to the host and looped over
+    all (color, face) pairs in Python; here all pairs are evaluated at once on the training device.
+    '''
+    a, b, c = tri[..., 0, :], tri[..., 1, :], tri[..., 2, :]
+    ab, ac = b - a, c - a
+    ap, bp, cp = p - a, p - b, p - c
+    d1, d2 = (ab * ap).sum(-1), (ac * ap).sum(-1)
+    d3, d4 = (ab * bp).sum(-1), (ac * bp).sum(-1)
+    d5, d6 = (ab * cp).sum(-1), (ac * cp).sum(-1)
+    va, vb, vc = d3 * d6 - d5 * d4, d5 * d2 - d1 * d6, d1 * d4 - d3 * d2
+
+    # regions are written from the least to the most specific, later ones take precedence as in the scalar version
+    denom = va + vb + vc
+    closest = a + ab * (vb / denom)[..., None] + ac * (vc / denom)[..., None]  # inside the face
+    w = (d4 - d3) / ((d4 - d3) + (d5 - d6))
+    closest = torch.where(((va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0))[..., None], b + (c - b) * w[..., None], closest)
+    closest = torch.where(((vb <= 0) & (d2 >= 0) & (d6 <= 0))[..., None], a + ac * (d2 / (d2 - d6))[..., None], closest)
+    closest = torch.where(((d6 >= 0) & (d5 <= d6))[..., None], c.expand_as(closest), closest)
+    closest = torch.where(((vc <= 0) & (d1 >= 0) & (d3 <= 0))[..., None], a + ab * (d1 / (d1 - d3))[..., None], closest)
+    closest = torch.where(((d3 >= 0) & (d4 <= d3))[..., None], b.expand_as(closest), closest)
+    closest = torch.where(((d1 <= 0) & (d2 <= 0))[..., None], a.expand_as(closest), closest)
+    return closest
+
+
 class PaletteBoundLoss(nn.Module):
-    def __init__(self, cvh_vtx):
+    '''
+    Keeps the palette inside the convex hull of the training colors, batched on the training device:
+    points inside are pulled (weakly) to the nearest hull vertex, points outside to the closest hull face.
+    '''
+    def __init__(self, cvh_vtx, tol=1e-8):
         super(PaletteBoundLoss, self).__init__()
 
-        self.hull = ConvexHull(cvh_vtx)
-        self.de = Delaunay(cvh_vtx)
-        self.hull_vertices = torch.from_numpy(cvh_vtx)
+        hull = ConvexHull(cvh_vtx)
+        self.tol = tol
+        self.register_buffer('hull_vertices', torch.from_numpy(hull.points[hull.vertices]).float())
+        # outward face planes n.x + d <= 0 inside, and the face triangles
+        self.register_buffer('face_planes', torch.from_numpy(hull.equations).float())
+        self.register_buffer('face_triangles', torch.from_numpy(hull.points[hull.simplices]).float())
 
     def forward(self, inp_points, w_in=1e-3, w_out=1.):
-        points = inp_points.detach().to('cpu', dtype=torch.double).numpy()
-        simplex = self.de.find_simplex(points, tol=1e-8)
-        loss = knn_points(inp_points[simplex >= 0].unsqueeze(0).double(), self.hull_vertices[None].to(inp_points.device, dtype=torch.double),
-                          K=1, return_sorted=False).dists
-        loss = w_in / n_in * loss.sum() if (n_in := loss.nelement()) else loss.sum()
-        ind, = np.nonzero(simplex < 0)
-        # loss = torch.Tensor([0.]).to(inp_points.device)
-        points = [min((DCPPointTriangle(pts, self.hull.points[j]) for j in self.hull.simplices),
-                      key=itemgetter('distance'))['closest'] for pts in points[ind]]
-        if points:
-            poi = np.asarray(points)
-            points = torch.tensor(poi, device=inp_points.device, dtype=inp_points.dtype)
-            loss = loss + w_out * F.mse_loss(inp_points[ind], points, reduction='none').sum(dim=-1).max()
-
-            assert torch.isfinite(loss)
+        points = inp_points.detach()
+        inside = (points @ self.face_planes[:, :3].T + self.face_planes[:, 3] <= self.tol).all(-1)
+
+        # no host synchronisation: empty sets are handled by masking instead of branching
+        # squared distance without the sqrt of cdist, whose backward is NaN for a point on a vertex (masking keeps the NaN)
+        dist_in = (inp_points[:, None] - self.hull_vertices.to(inp_points)[None]).square().sum(-1).amin(-1)
+        n_in = inside.sum().clamp(min=1)
+        loss = w_in / n_in * (dist_in * inside).sum()
+
+        closest = closest_point_on_triangles(points[:, None], self.face_triangles.to(points)[None])  # (N, F, 3)
+        face = (closest - points[:, None]).square().sum(-1).argmin(-1)
+        closest = closest[torch.arange(points.shape[0], device=points.device), face]
+        dist_out = F.mse_loss(inp_points, closest, reduction='none').sum(dim=-1)
+        loss = loss + w_out * (dist_out * ~inside).max()
         return loss
 
 
@@ -77,7 +77,7 @@ class PLTRender(torch.nn.Module):
             self.render_buf_layout.append(RenderBufferProp('color_correction',3,True))
 
     def color_correction(self,logits):
-        correct = torch.tanh(self.mlp3(logits))
+        correct = torch.tanh(self.mlp3(logits).float())
         return correct
 
     def weights_from_alpha_blending(self, logits):
@@ -143,9 +143,9 @@ class PLTRender(torch.nn.Module):
             indata.append(positional_encoding(features, self.feape))
         if self.viewpe > 0:
             indata.append(positional_encoding(viewdirs, self.viewpe))
-        #这里卷积
-        h_tmp = self.mlp(torch.cat(indata, dim=-1))
-        h = self.mlp2(h_tmp)
+        #这里卷积  (half_inference 后 MLP 是 float16, 输出转回 fp32 再和调色板混合)
+        h_tmp = self.mlp(torch.cat(indata, dim=-1).to(self.mlp[0].weight.dtype))
+        h = self.mlp2(h_tmp).float()
 
 
 
@@ -196,9 +196,9 @@ class PLTRender(torch.nn.Module):
             else:
                 rgb = bary_coord @ palette
 
-        #稀疏度
+        #稀疏度  soft L0 在 fp32 下计算 (autocast)
         sparsity_weight = sparsity_weight.unsqueeze(0)
-        sparsity = torch.sum(sparsity_weight * soft_L0_norm(bary_coord, scale=self.soft_l0_sharpness), dim=-1, keepdim=True)
+        sparsity = torch.sum(sparsity_weight * soft_L0_norm(bary_coord.float(), scale=self.soft_l0_sharpness), dim=-1, keepdim=True)
         
         rend_buf = [rgb, bary_coord]
         rend_buf.append(sparsity)
@@ -229,4 +229,11 @@ class PaletteTensorVM(TensorVMSplit):
     
     def get_palette_array(self):
         return self.renderModule.palette.get_palette_array()
+
+    @torch.no_grad()
+    def half_inference(self):
+        super(PaletteTensorVM, self).half_inference()
+        # the palette stays in fp32, edits are applied to it directly
+        for mlp in (self.renderModule.mlp, self.renderModule.mlp2, self.renderModule.mlp3):
+            mlp.half()
     
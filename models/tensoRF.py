@@ -6,9 +6,6 @@ from .tensorBase import TensorBase
 
 
 class TensorVMSplit(TensorBase):
-    def __init__(self, aabb, gridSize, device, **kargs):
-        super(TensorVMSplit, self).__init__(aabb, gridSize, device, **kargs)
-
     def init_svd_volume(self, res, device):
         #density_n_comp 几个vm  gredsize voxel个数
         self.density_plane, self.density_line = self.init_one_svd(self.density_n_comp, self.gridSize, 0.1, device)
@@ -77,8 +74,12 @@ class TensorVMSplit(TensorBase):
             total = total + reg(self.app_plane[idx]) * 1e-2  # + reg(self.app_line[idx]) * 1e-3
         return total
 
-    def compute_densityfeature(self, xyz_sampled):
+    def compute_features(self, xyz_sampled):
+        # density 和 app 在同一批点上查询 (烘焙), 坐标只计算一次
+        coords = self.get_coordinates(xyz_sampled)
+        return self.compute_densityfeature_from_coords(coords), self.compute_appfeature_from_coords(coords)
 
+    def get_coordinates(self, xyz_sampled):
         # plane + line basis
         #归一化坐标值 为-1 到 1 之间
         coordinate_plane = torch.stack((xyz_sampled[..., self.matMode[0]], xyz_sampled[..., self.matMode[1]],
@@ -87,38 +88,61 @@ class TensorVMSplit(TensorBase):
             (xyz_sampled[..., self.vecMode[0]], xyz_sampled[..., self.vecMode[1]], xyz_sampled[..., self.vecMode[2]]))
         coordinate_line = torch.stack((torch.zeros_like(coordinate_line), coordinate_line), dim=-1).detach().view(3, -1,
                                                                                                                   1, 2)
+        # grid_sample needs the grid in the dtype of the planes (float16 after half_inference)
+        dtype = self.density_plane[0].dtype
+        return coordinate_plane.to(dtype), coordinate_line.to(dtype)
+
+    def select_coordinates(self, coords, mask):
+        coordinate_plane, coordinate_line = coords
+        return coordinate_plane[:, mask], coordinate_line[:, mask]
+
+    def compute_densityfeature(self, xyz_sampled):
+        return self.compute_densityfeature_from_coords(self.get_coordinates(xyz_sampled))
+
+    def compute_appfeature(self, xyz_sampled):
+        return self.compute_appfeature_from_coords(self.get_coordinates(xyz_sampled))
 
-        sigma_feature = torch.zeros((xyz_sampled.shape[0],), device=xyz_sampled.device)
+    def compute_densityfeature_from_coords(self, coords):
+        coordinate_plane, coordinate_line = coords
+        n_points = coordinate_plane.shape[1]
+
+        sigma_feature = torch.zeros((n_points,), device=coordinate_plane.device)
         for idx_plane in range(len(self.density_plane)):
             #线性插值
             plane_coef_point = F.grid_sample(self.density_plane[idx_plane], coordinate_plane[[idx_plane]],
-                                             align_corners=True).view(-1, *xyz_sampled.shape[:1])
+                                             align_corners=True).view(-1, n_points).float()
             line_coef_point = F.grid_sample(self.density_line[idx_plane], coordinate_line[[idx_plane]],
-                                            align_corners=True).view(-1, *xyz_sampled.shape[:1])
+                                            align_corners=True).view(-1, n_points).float()
             sigma_feature = sigma_feature + torch.sum(plane_coef_point * line_coef_point, dim=0)
 
         return sigma_feature
 
-    def compute_appfeature(self, xyz_sampled):
-
-        # plane + line basis
-        coordinate_plane = torch.stack((xyz_sampled[..., self.matMode[0]], xyz_sampled[..., self.matMode[1]],
-                                        xyz_sampled[..., self.matMode[2]])).detach().view(3, -1, 1, 2)
-        coordinate_line = torch.stack(
-            (xyz_sampled[..., self.vecMode[0]], xyz_sampled[..., self.vecMode[1]], xyz_sampled[..., self.vecMode[2]]))
-        coordinate_line = torch.stack((torch.zeros_like(coordinate_line), coordinate_line), dim=-1).detach().view(3, -1,
-                                                                                                                  1, 2)
+    def compute_appfeature_from_coords(self, coords):
+        coordinate_plane, coordinate_line = coords
+        n_points = coordinate_plane.shape[1]
 
         plane_coef_point, line_coef_point = [], []
         for idx_plane in range(len(self.app_plane)):
             plane_coef_point.append(F.grid_sample(self.app_plane[idx_plane], coordinate_plane[[idx_plane]],
-                                                  align_corners=True).view(-1, *xyz_sampled.shape[:1]))
+                                                  align_corners=True).view(-1, n_points).float())
             line_coef_point.append(F.grid_sample(self.app_line[idx_plane], coordinate_line[[idx_plane]],
-                                                 align_corners=True).view(-1, *xyz_sampled.shape[:1]))
+                                                 align_corners=True).view(-1, n_points).float())
         plane_coef_point, line_coef_point = torch.cat(plane_coef_point), torch.cat(line_coef_point)
         #乘上b 求和
         return self.basis_mat((plane_coef_point * line_coef_point).T)
 
+    @torch.no_grad()
+    def half_inference(self):
+        '''
+        Inference only: keep the plane / line grids in float16. grid_sample reads half the bytes,
+        the interpolated coefficients are multiplied and summed in fp32.
+        '''
+        for coef in (self.density_plane, self.density_line, self.app_plane, self.app_line):
+            for i in range(len(coef)):
+                coef[i] = torch.nn.Parameter(coef[i].data.half(), requires_grad=False)
+        n_bytes = sum(p.numel() * 2 for coef in (self.density_plane, self.density_line, self.app_plane, self.app_line) for p in coef)
+        print(f'[half_inference] feature grids in float16, {n_bytes / 2 ** 20:.1f} MB')
+
     @torch.no_grad()
     def up_sampling_VM(self, plane_coef, line_coef, res_target):
 
@@ -1,3 +1,4 @@
+import itertools
 import time
 from collections import namedtuple
 
@@ -8,6 +9,8 @@ import torch.nn.functional as F
 from einops import rearrange
 
 from .sh import eval_sh_bases
+from .volume_render import packed_transmittance, volume_render_packed
+from data.ray_store import gather_rows
 
 
 RenderBufferProp = namedtuple(
@@ -28,6 +31,8 @@ def split_render_buffer(rend_buf, layout):
 
 def raw2alpha(sigma, dist):
     # sigma, dist  [N_rays, N_samples]
+    # the transmittance cumprod stays in fp32 under autocast
+    sigma, dist = sigma.float(), dist.float()
     alpha = 1. - torch.exp(-sigma * dist)
 
     T = torch.cumprod(torch.cat([torch.ones(alpha.shape[0], 1).to(alpha.device), 1. - alpha + 1e-10], -1), -1)
@@ -35,6 +40,68 @@ def raw2alpha(sigma, dist):
     weights = alpha * T[:, :-1]  # [N_rays, N_samples]
     return alpha, weights, T[:, -1:]
 
+def raw2alpha_packed(sigma, dist, ray_ids, n_rays):
+    '''
+    raw2alpha over packed samples. sigma, dist: (M,) the valid samples of all rays, sorted by ray; ray_ids: (M,)
+    Returns alpha, weights (M,) and the transmittance left behind every ray (n_rays,)
+    '''
+    sigma, dist = sigma.float(), dist.float()
+    alpha = 1. - torch.exp(-sigma * dist)
+    T, T_last = packed_transmittance(alpha, ray_ids, n_rays)
+    return alpha, alpha * T, T_last
+
+def pack_bits(mask):
+    # torch counterpart of np.packbits on a flat bool tensor (big-endian bit order)
+    mask = F.pad(mask.reshape(-1).to(torch.uint8), (0, (-mask.numel()) % 8)).view(-1, 8)
+    bit_weights = torch.tensor([128, 64, 32, 16, 8, 4, 2, 1], dtype=torch.uint8, device=mask.device)
+    return (mask * bit_weights).sum(-1).to(torch.uint8)
+
+def lookup_bits(packed, idx):
+    # bits of a packbits array at flat indices idx
+    return ((packed[idx >> 3].long() >> (7 - (idx & 7))) & 1).bool()
+
+def unpack_bits(packed, n):
+    # inverse of pack_bits, flat bool tensor of length n
+    shifts = torch.arange(7, -1, -1, dtype=torch.uint8, device=packed.device)
+    return ((packed[:, None] >> shifts) & 1).bool().view(-1)[:n]
+
+def read_bits(packed, start, stop):
+    # bits [start, stop) of a packbits array as a flat bool tensor, only the bytes holding them are unpacked
+    chunk = packed[start >> 3:(stop + 7) >> 3]
+    offset = start & 7
+    return unpack_bits(chunk, chunk.numel() * 8)[offset:offset + stop - start]
+
+def pack_tiles(tiles, device):
+    '''
+    pack_bits of the concatenation of bool tiles, one tile in memory at a time: whole bytes are packed,
+    the leftover bits go with the next tile
+    '''
+    packed, carry = [], torch.zeros(0, dtype=torch.bool, device=device)
+    for bits in tiles:
+        flat = torch.cat((carry, bits.reshape(-1)))
+        n = flat.numel() // 8 * 8
+        packed.append(pack_bits(flat[:n]))
+        carry = flat[n:]
+    if carry.numel() > 0:
+        packed.append(pack_bits(carry))
+    return torch.cat(packed) if packed else torch.zeros(0, dtype=torch.uint8, device=device)
+
+def pad_packed(ray_ids, n_rays, *samples):
+    '''
+    Padded layout of packed samples: the samples of every ray at the front, the sample axis cut to the longest ray.
+    ray_ids: (M,) sorted, samples: tensors of shape (M, ...)
+    Returns the valid mask (n_rays, L) and the padded samples (n_rays, L, ...)
+    '''
+    counts = torch.bincount(ray_ids, minlength=n_rays)
+    L = max(int(counts.max()), 1) if ray_ids.numel() > 0 else 1
+    valid = torch.arange(L, device=ray_ids.device)[None] < counts[:, None]
+    pos = torch.arange(ray_ids.shape[0], device=ray_ids.device) - (torch.cumsum(counts, 0) - counts)[ray_ids]
+
+    padded = []
+    for s in samples:
+        padded.append(torch.zeros((n_rays, L, *s.shape[1:]), dtype=s.dtype, device=s.device).index_put((ray_ids, pos), s))
+    return valid, padded
+
 def positional_encoding(positions, freqs):
     freq_bands = (2 ** torch.arange(freqs).float()).to(positions.device)  # (F,)
     pts = rearrange(positions[..., None] * freq_bands, 'N D F -> N (D F)')  # (..., DF)
@@ -133,22 +200,223 @@ class MLPRender(torch.nn.Module):
 
 
 class AlphaGridMask(torch.nn.Module):
-    def __init__(self, device, aabb, alpha_volume):
+    '''
+    Binary occupancy grid, only kept as packed bits (one bit per node, layout of the 'alphaMask.mask' checkpoint
+    field: D x H x W, x fastest). Either a dense alpha_volume (..., D, H, W) or bits and shape are given.
+    '''
+    def __init__(self, device, aabb, alpha_volume=None, bits=None, shape=None):
         super(AlphaGridMask, self).__init__()
         self.device = device
 
         self.aabb = aabb.to(self.device)
         self.aabbSize = self.aabb[1] - self.aabb[0]
         self.invgridSize = 1.0 / self.aabbSize * 2
-        self.alpha_volume = alpha_volume.view(1, 1, *alpha_volume.shape[-3:])
-        self.gridSize = torch.LongTensor([alpha_volume.shape[-1], alpha_volume.shape[-2], alpha_volume.shape[-3]]).to(
-            self.device)
+        if alpha_volume is not None:
+            shape, bits = alpha_volume.shape, pack_bits(alpha_volume > 0)
+        self.shape = tuple(int(n) for n in shape[-3:])
+        self.gridSize = torch.LongTensor(self.shape[::-1]).to(self.device)
+        self.occupancy = bits.to(self.device)
+        # side (in cells) of the blocks that occupied_segments marches through
+        self.march_block = 8
+        self.build_cells()
+
+    @classmethod
+    def from_packed(cls, device, aabb, bits, shape):
+        # shape: (..., D, H, W) as the 'alphaMask.shape' checkpoint field
+        return cls(device, aabb, bits=bits, shape=shape)
+
+    @property
+    def alpha_volume(self):
+        # dense (1, 1, D, H, W) float volume, unpacked on request
+        return unpack_bits(self.occupancy, int(np.prod(self.shape))).view(1, 1, *self.shape).float()
 
     def sample_alpha(self, xyz_sampled):
-        xyz_sampled = self.normalize_coord(xyz_sampled)
-        alpha_vals = F.grid_sample(self.alpha_volume, xyz_sampled.view(1, -1, 1, 1, 3), align_corners=True).view(-1)
+        # 1 where trilinear sampling of the binary volume would be > 0, 0 elsewhere
+        return self.occupied(xyz_sampled.view(-1, 3)).float()
+
+    def build_cells(self, chunk=1 << 21):
+        '''
+        Occupancy of the cells between the nodes, built once from occupancy (and again whenever it changes).
+        cell_bits: packed bits of the (D + 1) x (H + 1) x (W + 1) cells that have an occupied corner, x fastest;
+        cell i of an axis lies between the nodes i - 1 and i, so the outer cells cover the voxel of trilinear
+        support outside the grid. Built from tiles of z planes read out of the packed nodes, no dense volume is made.
+        The block bits of the march are rebuilt on demand.
+        '''
+        W, H, D = self.gridSize.tolist()
+        depth = max(1, chunk // ((H + 1) * (W + 1)))
+
+        def tiles():
+            for c0 in range(0, D + 1, depth):
+                c1 = min(c0 + depth, D + 1)
+                # node planes c0 - 1 .. c1 - 1 with a false border, the planes outside the grid stay false
+                nodes = torch.zeros((c1 - c0 + 1, H + 2, W + 2), dtype=torch.bool, device=self.device)
+                z0, z1 = max(c0 - 1, 0), min(c1, D)
+                nodes[z0 - c0 + 1:z1 - c0 + 1, 1:-1, 1:-1] = read_bits(self.occupancy, z0 * H * W, z1 * H * W).view(-1, H, W)
+                # cell (z, y, x) = or of the nodes z - 1..z, y - 1..y, x - 1..x
+                nodes = nodes[1:] | nodes[:-1]
+                nodes = nodes[:, 1:] | nodes[:, :-1]
+                yield nodes[:, :, 1:] | nodes[:, :, :-1]
+
+        self.cell_bits = pack_tiles(tiles(), self.device)
+        self._block_bits = None
+
+    def occupied(self, xyz_sampled):
+        '''
+        Integer lookup equivalent to sample_alpha(xyz_sampled) > 0: a point is occupied when one of the grid corners
+        with a non-zero trilinear weight is set. One lookup of the cell that contains the point; only points on a
+        node plane (the upper corners have zero weight there) test their corners one by one.
+        '''
+        grid = (self.normalize_coord(xyz_sampled) + 1) / 2 * (self.gridSize - 1)  # voxel units, x y z
+        base = torch.floor(grid)
+        cell = base.long() + 1
+        W, H = self.gridSize[0] + 1, self.gridSize[1] + 1
+        inside = ((cell >= 0) & (cell <= self.gridSize)).all(-1)
+        flat = (cell[..., 2] * H + cell[..., 1]) * W + cell[..., 0]
+        occupied = inside & lookup_bits(self.cell_bits, torch.where(inside, flat, 0))
+
+        on_node = (grid == base).any(-1)
+        if on_node.any():
+            occupied[on_node] = self.corners_occupied(grid[on_node])
+        return occupied
+
+    def corners_occupied(self, grid):
+        # occupied() of points in voxel units, from the corners with a non-zero trilinear weight
+        base = torch.floor(grid)
+        frac = grid - base
+        base = base.long()
+        W, H = self.gridSize[0], self.gridSize[1]
+
+        occupied = torch.zeros(grid.shape[:-1], dtype=torch.bool, device=grid.device)
+        for corner in itertools.product((0, 1), repeat=3):
+            offset = torch.tensor(corner, device=grid.device)
+            idx = base + offset
+            # corner weight is frac for the upper corner and 1 - frac (always > 0) for the lower one
+            valid = torch.where(offset.bool(), frac > 0, True).all(-1) & ((idx >= 0) & (idx < self.gridSize)).all(-1)
+            flat = (idx[..., 2] * H + idx[..., 1]) * W + idx[..., 0]
+            occupied |= valid & lookup_bits(self.occupancy, torch.where(valid, flat, 0))
+        return occupied
+
+    def block_occupancy(self):
+        '''
+        Packed bits of the blocks of march_block^3 cells (the last ones cut by the grid) that contain or touch an
+        occupied cell of cell_bits, x fastest. The one cell margin keeps the samples that rounding moves across a
+        block face. Every plane of blocks reads its march_block + 2 cell planes out of cell_bits.
+        '''
+        if self._block_bits is None:
+            W, H, D = (self.gridSize + 1).tolist()
+            b = self.march_block
+            n_x, n_y, n_z = -(-W // b), -(-H // b), -(-D // b)
+
+            def dilate(cells, dim):
+                # or with the neighbour on both sides along dim, then pad dim to whole blocks
+                out = cells.clone()
+                out.narrow(dim, 1, cells.shape[dim] - 1).logical_or_(cells.narrow(dim, 0, cells.shape[dim] - 1))
+                out.narrow(dim, 0, cells.shape[dim] - 1).logical_or_(cells.narrow(dim, 1, cells.shape[dim] - 1))
+                shape = list(out.shape)
+                shape[dim] = (-shape[dim]) % b
+                return torch.cat((out, out.new_zeros(shape)), dim)
+
+            def tiles():
+                for bz in range(n_z):
+                    z0, z1 = max(bz * b - 1, 0), min(bz * b + b + 1, D)
+                    cells = read_bits(self.cell_bits, z0 * H * W, z1 * H * W).view(-1, H, W).any(0)
+                    cells = dilate(dilate(cells, 0), 1)
+                    yield cells.view(n_y, b, n_x, b).any(3).any(1)
+
+            self._block_bits = pack_tiles(tiles(), self.device)
+        return self._block_bits
+
+    def cells_span(self, rays_o, rays_d, t_min, t_max):
+        # [t_min, t_max] cut to the box of cell_bits (one voxel around the grid), occupied() is false outside it
+        cell_size = self.aabbSize / (self.gridSize - 1)
+        vec = torch.where(rays_d == 0, torch.full_like(rays_d, 1e-6), rays_d)
+        rate_a = (self.aabb[1] + cell_size - rays_o) / vec
+        rate_b = (self.aabb[0] - cell_size - rays_o) / vec
+        return torch.maximum(t_min, torch.minimum(rate_a, rate_b).amax(-1)), \
+            torch.minimum(t_max, torch.maximum(rate_a, rate_b).amin(-1))
+
+    def dda_start(self, rays_o, rays_d, t_start, origin, n_cells, spacing):
+        # cell (of size spacing, counted from origin) of every ray at t_start, step per axis, t between two faces
+        # and t of the next face
+        vec = torch.where(rays_d == 0, torch.full_like(rays_d, 1e-6), rays_d)
+        cell = torch.floor((rays_o + rays_d * t_start[:, None] - origin) / spacing).long()
+        cell = torch.minimum(cell.clamp(min=0), n_cells - 1)
+        step = torch.where(vec > 0, 1, -1)
+        t_delta = spacing / vec.abs()
+        t_next = (origin + (cell + (vec > 0).long()) * spacing - rays_o) / vec
+        return cell, step, t_delta, t_next
 
-        return alpha_vals
+    @torch.no_grad()
+    def ray_occupied(self, rays_o, rays_d, t_min, t_max):
+        '''
+        Whether the segment [t_min, t_max] of every ray passes through a cell with an occupied corner, i.e. whether
+        occupied() is true somewhere on it. 3D DDA (Amanatides & Woo) over the grid cells, every iteration moves all
+        unresolved rays one cell forward and drops the ones that hit, left the grid or passed t_max.
+        '''
+        n_cells = self.gridSize + 1
+        spacing = self.aabbSize / (self.gridSize - 1)
+        W, H = n_cells[0], n_cells[1]
+
+        t_min, t_max = self.cells_span(rays_o, rays_d, t_min, t_max)
+        cell, step, t_delta, t_next = self.dda_start(rays_o, rays_d, t_min, self.aabb[0] - spacing, n_cells, spacing)
+
+        hit = torch.zeros_like(t_min, dtype=torch.bool)
+        active = torch.nonzero(t_max > t_min).squeeze(-1)
+        cell, step, t_delta, t_next, t_max = cell[active], step[active], t_delta[active], t_next[active], t_max[active]
+        while active.numel() > 0:
+            flat = (cell[:, 2] * H + cell[:, 1]) * W + cell[:, 0]
+            occupied = lookup_bits(self.cell_bits, flat)
+            hit[active] = occupied
+
+            axis = t_next.argmin(-1, keepdim=True)
+            t_cur = t_next.gather(1, axis).squeeze(1)
+            cell = cell.scatter_add(1, axis, step.gather(1, axis))
+            t_next = t_next.scatter_add(1, axis, t_delta.gather(1, axis))
+
+            keep = ~occupied & (t_cur < t_max) & ((cell >= 0) & (cell < n_cells)).all(-1)
+            keep = torch.nonzero(keep).squeeze(-1)
+            active, cell, step, t_delta, t_next, t_max = \
+                active[keep], cell[keep], step[keep], t_delta[keep], t_next[keep], t_max[keep]
+        return hit
+
+    @torch.no_grad()
+    def occupied_segments(self, rays_o, rays_d, t_min, t_max):
+        '''
+        The parts of [t_min, t_max] of every ray that lie in an occupied block of block_occupancy. 3D DDA over the
+        blocks like ray_occupied, but walking on after a hit; the segments of a ray share their end points.
+        Returns the ray index, start and end t of every segment (K,), not sorted.
+        '''
+        blocks = self.block_occupancy()
+        n_blocks = torch.div(self.gridSize + self.march_block, self.march_block, rounding_mode='floor')
+        cell_size = self.aabbSize / (self.gridSize - 1)
+        spacing = cell_size * self.march_block
+        origin = self.aabb[0] - cell_size
+        W, H = n_blocks[0], n_blocks[1]
+
+        t_min, t_max = self.cells_span(rays_o, rays_d, t_min, t_max)
+        active = torch.nonzero(t_max > t_min).squeeze(-1)
+        t_cur, t_max = t_min[active], t_max[active]
+        cell, step, t_delta, t_next = self.dda_start(rays_o[active], rays_d[active], t_cur, origin, n_blocks, spacing)
+        seg_rays, seg_start, seg_end = [active[:0]], [t_cur[:0]], [t_cur[:0]]
+        while active.numel() > 0:
+            occupied = lookup_bits(blocks, (cell[:, 2] * H + cell[:, 1]) * W + cell[:, 0])
+
+            axis = t_next.argmin(-1, keepdim=True)
+            t_exit = t_next.gather(1, axis).squeeze(1)
+            cell = cell.scatter_add(1, axis, step.gather(1, axis))
+            t_next = t_next.scatter_add(1, axis, t_delta.gather(1, axis))
+            inside = ((cell >= 0) & (cell < n_blocks)).all(-1)
+            # the last block of a ray reaches to t_max
+            t_exit = torch.where(inside, torch.minimum(t_exit, t_max), t_max)
+
+            seg_rays.append(active[occupied])
+            seg_start.append(t_cur[occupied])
+            seg_end.append(t_exit[occupied])
+
+            keep = torch.nonzero(inside & (t_exit < t_max)).squeeze(-1)
+            active, cell, step, t_delta, t_next, t_cur, t_max = \
+                active[keep], cell[keep], step[keep], t_delta[keep], t_next[keep], t_exit[keep], t_max[keep]
+        return torch.cat(seg_rays), torch.cat(seg_start), torch.cat(seg_end)
 
     def normalize_coord(self, xyz_sampled):
         return (xyz_sampled - self.aabb[0]) * self.invgridSize - 1
@@ -172,6 +440,11 @@ class TensorBase(torch.nn.Module):
         self.distance_scale = distance_scale
         self.rayMarch_weight_thres = rayMarch_weight_thres
         self.fea2denseAct = fea2denseAct
+        # march the alpha mask and generate only the occupied samples (sample_ray_occupied), set by the trainer
+        self.skip_empty_space = False
+        # inference only: stop marching a ray once its transmittance is below ray_term_thres (0 disables)
+        self.ray_term_thres = 0.
+        self.ray_term_segment = 32
 
         self.near_far = near_far
         self.step_ratio = step_ratio
@@ -233,7 +506,7 @@ class TensorBase(torch.nn.Module):
         pass
 
     def compute_features(self, xyz_sampled):
-        pass
+        return self.compute_densityfeature(xyz_sampled), self.compute_appfeature(xyz_sampled)
 
     def compute_densityfeature(self, xyz_sampled):
         pass
@@ -241,6 +514,19 @@ class TensorBase(torch.nn.Module):
     def compute_appfeature(self, xyz_sampled):
         pass
 
+    # 采样坐标在一次 forward 中只计算一次: density 查询所有有效点, app 查询按 mask 取其中一部分
+    def get_coordinates(self, xyz_sampled):
+        return xyz_sampled
+
+    def select_coordinates(self, coords, mask):
+        return coords[mask]
+
+    def compute_densityfeature_from_coords(self, coords):
+        return self.compute_densityfeature(coords)
+
+    def compute_appfeature_from_coords(self, coords):
+        return self.compute_appfeature(coords)
+
     def normalize_coord(self, xyz_sampled):
         return (xyz_sampled - self.aabb[0]) * self.invaabbSize - 1
 
@@ -271,19 +557,17 @@ class TensorBase(torch.nn.Module):
         kwargs = self.get_kwargs()
         ckpt = {'kwargs': kwargs, 'state_dict': self.state_dict()}
         if self.alphaMask is not None:
-            alpha_volume = self.alphaMask.alpha_volume.bool().cpu().numpy()
-            ckpt.update({'alphaMask.shape': alpha_volume.shape})
-            ckpt.update({'alphaMask.mask': np.packbits(alpha_volume.reshape(-1))})
+            # the packed bits are the np.packbits layout of the checkpoint
+            ckpt.update({'alphaMask.shape': (1, 1) + self.alphaMask.shape})
+            ckpt.update({'alphaMask.mask': self.alphaMask.occupancy.cpu().numpy()})
             ckpt.update({'alphaMask.aabb': self.alphaMask.aabb.cpu()})
         torch.save(ckpt, path)
 
     def load(self, ckpt):
         if 'alphaMask.aabb' in ckpt.keys():
-            length = np.prod(ckpt['alphaMask.shape'])
-            alpha_volume = torch.from_numpy(
-                np.unpackbits(ckpt['alphaMask.mask'])[:length].reshape(ckpt['alphaMask.shape']))
-            self.alphaMask = AlphaGridMask(self.device, ckpt['alphaMask.aabb'].to(self.device),
-                                           alpha_volume.float().to(self.device))
+            self.alphaMask = AlphaGridMask.from_packed(self.device, ckpt['alphaMask.aabb'].to(self.device),
+                                                       torch.from_numpy(np.asarray(ckpt['alphaMask.mask'])),
+                                                       ckpt['alphaMask.shape'])
         self.load_state_dict(ckpt['state_dict'])
 
     def sample_ray_ndc(self, rays_o, rays_d, is_train=True, N_samples=-1):
@@ -322,85 +606,187 @@ class TensorBase(torch.nn.Module):
 
         return rays_pts, interpx, ~mask_outbbox
 
+    @torch.no_grad()
+    def sample_ray_occupied(self, rays_o, rays_d, is_train=True, N_samples=-1):
+        '''
+        The samples of sample_ray that pass the alpha mask, generated only in the occupied blocks that
+        alphaMask.occupied_segments walks through, so the cost follows the occupied volume instead of the bbox
+        diagonal. Packed in ray order: ray_ids, sample_ids (M,) (index along the ray as in sample_ray), xyz (M, 3),
+        z_vals and dists (M,)
+        '''
+        N_samples = N_samples if N_samples > 0 else self.nSamples
+        stepsize = self.stepSize
+        near, far = self.near_far
+        vec = torch.where(rays_d == 0, torch.full_like(rays_d, 1e-6), rays_d)
+        rate_a = (self.aabb[1] - rays_o) / vec
+        rate_b = (self.aabb[0] - rays_o) / vec
+        t_min = torch.minimum(rate_a, rate_b).amax(-1).clamp(min=near, max=far)
+        t_max = torch.maximum(rate_a, rate_b).amin(-1)
+        # sample k of a ray sits at t_min + stepsize * (k + jitter), the jitter is drawn as in sample_ray
+        jitter = torch.rand((rays_d.shape[0],)).to(rays_o.device) if is_train else torch.zeros_like(t_min)
+
+        # half a step of slack at the far end, the bbox test below is the one of sample_ray
+        seg_rays, seg_start, seg_end = self.alphaMask.occupied_segments(rays_o, rays_d, t_min, t_max + stepsize / 2)
+        seg_t, seg_jitter = t_min[seg_rays], jitter[seg_rays]
+        k_start = torch.ceil((seg_start - seg_t) / stepsize - seg_jitter).long().clamp(0, N_samples)
+        k_end = torch.ceil((seg_end - seg_t) / stepsize - seg_jitter).long().clamp(0, N_samples)
+        counts = (k_end - k_start).clamp(min=0)
+
+        # every segment expands to its samples k_start, ..., k_end - 1, then sorted by ray and k
+        ray_ids = torch.repeat_interleave(seg_rays, counts)
+        sample_ids = torch.arange(ray_ids.shape[0], device=rays_o.device) + \
+            torch.repeat_interleave(k_start - (torch.cumsum(counts, 0) - counts), counts)
+        order = torch.argsort(ray_ids * N_samples + sample_ids)
+        ray_ids, sample_ids = ray_ids[order], sample_ids[order]
+
+        rng = sample_ids.float() + jitter[ray_ids]
+        z_vals = t_min[ray_ids] + stepsize * rng
+        xyz = rays_o[ray_ids] + rays_d[ray_ids] * z_vals[:, None]
+        z_next = t_min[ray_ids] + stepsize * ((sample_ids + 1).float() + jitter[ray_ids])
+        dists = torch.where(sample_ids < N_samples - 1, z_next - z_vals, torch.zeros_like(z_vals))
+
+        keep = ((self.aabb[0] <= xyz) & (xyz <= self.aabb[1])).all(-1) & self.alphaMask.occupied(xyz)
+        return ray_ids[keep], sample_ids[keep], xyz[keep], z_vals[keep], dists[keep]
+
     def shrink(self, new_aabb, voxel_size):
         pass
 
+    @torch.no_grad()
+    def grid_axes(self, gridSize):
+        # normalized node positions per axis, linspace on the cpu like the original meshgrid
+        return [torch.linspace(0, 1, int(n)).to(self.device) for n in gridSize]
+
     @torch.no_grad()
     def getDenseAlpha(self, gridSize=None):
+        '''
+        Alpha at every grid node, indexed [x, y, z]. Coordinates are built one x slice at a time, the xyz volume is
+        not kept (the second return value is None).
+        '''
         gridSize = self.gridSize if gridSize is None else gridSize
+        axes = self.grid_axes(gridSize)
+        grid_y, grid_z = torch.meshgrid(axes[1], axes[2], indexing='ij')
 
-        samples = torch.stack(torch.meshgrid(
-            torch.linspace(0, 1, gridSize[0]),
-            torch.linspace(0, 1, gridSize[1]),
-            torch.linspace(0, 1, gridSize[2]),
-        ), -1).to(self.device)
-        dense_xyz = self.aabb[0] * (1 - samples) + self.aabb[1] * samples
-
-        # dense_xyz = dense_xyz
-        # print(self.stepSize, self.distance_scale*self.aabbDiag)
-        alpha = torch.zeros_like(dense_xyz[..., 0])
+        alpha = torch.zeros([int(n) for n in gridSize], device=self.device)
         for i in range(gridSize[0]):
-            alpha[i] = self.compute_alpha(dense_xyz[i].view(-1, 3), self.stepSize).view((gridSize[1], gridSize[2]))
-        return alpha, dense_xyz
+            samples = torch.stack([torch.full_like(grid_y, axes[0][i].item()), grid_y, grid_z], -1)
+            xyz = self.aabb[0] * (1 - samples) + self.aabb[1] * samples
+            alpha[i] = self.compute_alpha(xyz.view(-1, 3), self.stepSize).view((gridSize[1], gridSize[2]))
+        return alpha, None
+
+    @torch.no_grad()
+    def build_alpha_bits(self, gridSize, chunk=1 << 21):
+        '''
+        The alpha mask of updateAlphaMask without any dense volume. Tiles of z planes, with one halo plane on each side,
+        are evaluated a plane at a time, dilated by the 3x3x3 max pool and thresholded; their bits are appended to the
+        packed mask (layout of AlphaGridMask, x fastest). Halo planes are reused by the next tile.
+        Returns the packed bits, the smallest and largest set index per axis (x y z, None when empty) and the count.
+        '''
+        W, H, D = [int(n) for n in gridSize]
+        axes = self.grid_axes(gridSize)
+        grid_y, grid_x = torch.meshgrid(axes[1], axes[0], indexing='ij')
+        depth = max(1, chunk // (W * H))
+
+        def plane(z):
+            samples = torch.stack([grid_x, grid_y, torch.full_like(grid_x, axes[2][z].item())], -1)
+            xyz = self.aabb[0] * (1 - samples) + self.aabb[1] * samples
+            return self.compute_alpha(xyz.view(-1, 3), self.stepSize).view(H, W)
+
+        idx_min, idx_max = [W, H, D], [-1, -1, -1]
+        total = 0
+
+        def tiles():
+            nonlocal total
+            cached = None
+            for z0 in range(0, D, depth):
+                z1 = min(z0 + depth, D)
+                h0, h1 = max(z0 - 1, 0), min(z1 + 1, D)
+                # the previous tile ended with the planes z0 - 1 and z0
+                planes = [] if cached is None else list(cached)
+                planes += [plane(z) for z in range(h0 + len(planes), h1)]
+                alpha = torch.stack(planes)
+                cached = alpha[-2:]
+
+                alpha = F.max_pool3d(alpha.clamp(0, 1)[None, None], kernel_size=3, padding=1, stride=1)[0, 0]
+                bits = alpha[z0 - h0:z1 - h0] >= self.alphaMask_thres
+
+                total += int(bits.sum())
+                for axis, hit in enumerate((bits.any(0).any(0), bits.any(0).any(1), bits.any(1).any(1))):
+                    ids = torch.nonzero(hit).squeeze(-1)
+                    if ids.numel() > 0:
+                        offset = z0 if axis == 2 else 0
+                        idx_min[axis] = min(idx_min[axis], int(ids[0]) + offset)
+                        idx_max[axis] = max(idx_max[axis], int(ids[-1]) + offset)
+                yield bits
+
+        packed = pack_tiles(tiles(), self.device)
+        if total == 0:
+            return packed, None, 0
+        return packed, (idx_min, idx_max), total
 
     #掩码操作，清除sigma比较低的点
     @torch.no_grad()
     def updateAlphaMask(self, gridSize=(200, 200, 200)):
-
-        alpha, dense_xyz = self.getDenseAlpha(gridSize)
-        dense_xyz = dense_xyz.transpose(0, 2).contiguous()
-        alpha = alpha.clamp(0, 1).transpose(0, 2).contiguous()[None, None]
+        gridSize = [int(n) for n in gridSize]
+        bits, extremes, total = self.build_alpha_bits(gridSize)
         total_voxels = gridSize[0] * gridSize[1] * gridSize[2]
 
-        ks = 3
-        alpha = F.max_pool3d(alpha, kernel_size=ks, padding=ks // 2, stride=1).view(gridSize[::-1])
-        alpha[alpha >= self.alphaMask_thres] = 1
-        alpha[alpha < self.alphaMask_thres] = 0
-
-        self.alphaMask = AlphaGridMask(self.device, self.aabb, alpha)
+        self.alphaMask = AlphaGridMask.from_packed(self.device, self.aabb, bits, gridSize[::-1])
 
-        valid_xyz = dense_xyz[alpha > 0.5]
-
-        xyz_min = valid_xyz.amin(0)
-        xyz_max = valid_xyz.amax(0)
+        if extremes is None:
+            print('[updateAlphaMask] the alpha mask is empty, keeping the bbox')
+            return self.aabb.clone()
+        # node positions of the extreme set indices, same expression as the dense xyz grid
+        axes = self.grid_axes(gridSize)
+        s_min = torch.stack([axes[i][extremes[0][i]] for i in range(3)])
+        s_max = torch.stack([axes[i][extremes[1][i]] for i in range(3)])
+        xyz_min = self.aabb[0] * (1 - s_min) + self.aabb[1] * s_min
+        xyz_max = self.aabb[0] * (1 - s_max) + self.aabb[1] * s_max
 
         new_aabb = torch.stack((xyz_min, xyz_max))
 
-        total = torch.sum(alpha)
         print(f"[updateAlphaMask] bbox: {xyz_min, xyz_max} alpha rest %%%f" % (total / total_voxels * 100))
         return new_aabb
 
     @torch.no_grad()
-    def filtering_rays(self, all_rays, all_rgbs, N_samples=256, chunk=10240 * 5,is_depth=False,final_mask=None, bbox_only=False):
+    def filtering_rays(self, all_rays, all_rgbs, chunk=10240 * 5,is_depth=False,final_mask=None, bbox_only=False, return_mask=False, ray_ids=None):
+        '''
+        Keep the rays that cross the bbox (bbox_only) or an occupied cell of the alpha mask.
+        ray_ids: only these rows of all_rays are tested (the survivors of the previous filters), the mask is over them.
+        '''
         print('[filtering_rays]', end=' ')
         tt = time.time()
 
-        N = torch.tensor(all_rays.shape[:-1]).prod()
+        N = all_rays.shape[0] if ray_ids is None else ray_ids.shape[0]
 
         mask_filtered = []
-        idx_chunks = torch.split(torch.arange(N), chunk)
-        for idx_chunk in idx_chunks:
-            rays_chunk = all_rays[idx_chunk].to(self.device)
+        for start in range(0, N, chunk):
+            # slicing also works for memory-mapped numpy rays, only the chunk is read
+            rows = slice(start, start + chunk) if ray_ids is None else ray_ids[start:start + chunk]
+            rays_chunk = gather_rows(all_rays, rows).to(self.device)
 
             rays_o, rays_d = rays_chunk[..., :3], rays_chunk[..., 3:6]
+            vec = torch.where(rays_d == 0, torch.full_like(rays_d, 1e-6), rays_d)
+            rate_a = (self.aabb[1] - rays_o) / vec
+            rate_b = (self.aabb[0] - rays_o) / vec
+            t_min = torch.minimum(rate_a, rate_b).amax(-1)  # .clamp(min=near, max=far)
+            t_max = torch.maximum(rate_a, rate_b).amin(-1)  # .clamp(min=near, max=far)
             if bbox_only:
-                vec = torch.where(rays_d == 0, torch.full_like(rays_d, 1e-6), rays_d)
-                rate_a = (self.aabb[1] - rays_o) / vec
-                rate_b = (self.aabb[0] - rays_o) / vec
-                t_min = torch.minimum(rate_a, rate_b).amax(-1)  # .clamp(min=near, max=far)
-                t_max = torch.maximum(rate_a, rate_b).amin(-1)  # .clamp(min=near, max=far)
                 mask_inbbox = t_max > t_min
-
             else:
-                xyz_sampled, _, _ = self.sample_ray(rays_o, rays_d, N_samples=N_samples, is_train=False)
-                mask_inbbox = (self.alphaMask.sample_alpha(xyz_sampled).view(xyz_sampled.shape[:-1]) > 0).any(-1)
+                # walk the occupancy grid over the part of the ray inside the bbox, from near on like sample_ray
+                mask_inbbox = self.alphaMask.ray_occupied(rays_o, rays_d, t_min.clamp(min=self.near_far[0]), t_max)
 
             mask_filtered.append(mask_inbbox.cpu())
 
-        mask_filtered = torch.cat(mask_filtered).view(all_rays.shape[:-1])
+        mask_filtered = torch.cat(mask_filtered) if mask_filtered else torch.zeros(0, dtype=torch.bool)
 
         print(f'Ray filtering done! takes {time.time() - tt} s. '
               f'ray mask ratio: {torch.count_nonzero(mask_filtered) / N}')
+        if return_mask:
+            return mask_filtered
+        if ray_ids is not None:
+            mask_filtered = torch.zeros(all_rays.shape[0], dtype=torch.bool).index_fill_(0, ray_ids[mask_filtered], True)
+        mask_filtered = mask_filtered.to(all_rays.device)
         all_rays_mask = all_rays[mask_filtered]
         all_rgbs_mask = all_rgbs[mask_filtered]
         if is_depth:
@@ -418,8 +804,7 @@ class TensorBase(torch.nn.Module):
     def compute_alpha(self, xyz_locs, length=1):
 
         if self.alphaMask is not None:
-            alphas = self.alphaMask.sample_alpha(xyz_locs)
-            alpha_mask = alphas > 0
+            alpha_mask = self.alphaMask.occupied(xyz_locs)
         else:
             alpha_mask = torch.ones_like(xyz_locs[:, 0], dtype=bool)
 
@@ -444,95 +829,193 @@ class TensorBase(torch.nn.Module):
 
         # sample points
         viewdirs = rays_chunk[:, 3:6]  #(bs,3)
-        if ndc_ray: #ndc  depth [0,1]
-            xyz_sampled, z_vals, ray_valid = self.sample_ray_ndc(rays_chunk[:, :3], viewdirs, is_train=is_train,
+        N_rays = rays_chunk.shape[0]
+        # per-sample outputs need the dense sample layout, early termination marches a padded (bs, nsample) one
+        dense_only = kwargs.get('ret_weight', False) or kwargs.get('ret_raw_render_buf', False)
+        early_term = not is_train and self.ray_term_thres > 0 and not dense_only
+        if not ndc_ray and self.skip_empty_space and self.alphaMask is not None:
+            # only the samples in occupied space are generated, already packed and alpha masked
+            N_samples = N_samples if N_samples > 0 else self.nSamples
+            ray_ids, sample_ids, xyz_packed, z_packed, dists_packed = self.sample_ray_occupied(
+                rays_chunk[:, :3], viewdirs, is_train=is_train, N_samples=N_samples)
+            if early_term:
+                ray_valid, (xyz_sampled, z_vals, dists) = pad_packed(ray_ids, N_rays, xyz_packed, z_packed, dists_packed)
+                return self.render_early_term(rays_chunk, xyz_sampled, z_vals, dists, viewdirs, ray_valid, white_bg,
+                                              mask_alpha=False, **kwargs)
+        else:
+            if ndc_ray: #ndc  depth [0,1]
+                xyz_sampled, z_vals, ray_valid = self.sample_ray_ndc(rays_chunk[:, :3], viewdirs, is_train=is_train,
+                                                                     N_samples=N_samples)
+                dists = torch.cat((z_vals[:, 1:] - z_vals[:, :-1], torch.zeros_like(z_vals[:, :1])), dim=-1)
+                rays_norm = torch.norm(viewdirs, dim=-1, keepdim=True)
+                dists = dists * rays_norm
+                viewdirs = viewdirs / rays_norm
+                # sample_ray_ndc shares one (1, nsample) z_vals between all rays, the packed samples index it per ray
+                z_vals = z_vals.expand_as(ray_valid)
+            else:   #不是ndc
+                xyz_sampled, z_vals, ray_valid = self.sample_ray(rays_chunk[:, :3], viewdirs, is_train=is_train,
                                                                  N_samples=N_samples)
-            dists = torch.cat((z_vals[:, 1:] - z_vals[:, :-1], torch.zeros_like(z_vals[:, :1])), dim=-1)
-            rays_norm = torch.norm(viewdirs, dim=-1, keepdim=True)
-            dists = dists * rays_norm
-            viewdirs = viewdirs / rays_norm
-        else:   #不是ndc
-            xyz_sampled, z_vals, ray_valid = self.sample_ray(rays_chunk[:, :3], viewdirs, is_train=is_train,
-                                                             N_samples=N_samples)
-            #两个点之间距离
-            dists = torch.cat((z_vals[:, 1:] - z_vals[:, :-1], torch.zeros_like(z_vals[:, :1])), dim=-1)
-        viewdirs = viewdirs.view(-1, 1, 3).expand(xyz_sampled.shape)  #(bs,nsample,3)
-
-        if self.alphaMask is not None:
-            alphas = self.alphaMask.sample_alpha(xyz_sampled[ray_valid])
-            alpha_mask = alphas > 0
-            ray_invalid = ~ray_valid  # (bs,443)  true false composition
-            ray_invalid[ray_valid] |= (~alpha_mask)
-            ray_valid = ~ray_invalid
-        sigma = torch.zeros(xyz_sampled.shape[:-1], device=xyz_sampled.device) #(bs,443)
-        # render buffer for each point: [RGB, component opaque, ...]
-        render_buf = torch.zeros((*xyz_sampled.shape[:2], self.n_dim), device=xyz_sampled.device)
-        #xyz_sampled (bs,sampled,3)
-
-        if ray_valid.any():
+                #两个点之间距离
+                dists = torch.cat((z_vals[:, 1:] - z_vals[:, :-1], torch.zeros_like(z_vals[:, :1])), dim=-1)
+
+            if early_term:
+                return self.render_early_term(rays_chunk, xyz_sampled, z_vals, dists, viewdirs, ray_valid, white_bg,
+                                              **kwargs)
+            if self.alphaMask is not None:
+                alpha_mask = self.alphaMask.occupied(xyz_sampled[ray_valid])
+                ray_invalid = ~ray_valid  # (bs,443)  true false composition
+                ray_invalid[ray_valid] |= (~alpha_mask)
+                ray_valid = ~ray_invalid
+            # packed samples: the valid samples of all rays in ray order, sample i belongs to ray ray_ids[i]
+            N_samples = ray_valid.shape[1]
+            ray_ids, sample_ids = torch.nonzero(ray_valid, as_tuple=True)
+            xyz_packed, z_packed, dists_packed = xyz_sampled[ray_valid], z_vals[ray_valid], dists[ray_valid]
+        sigma = torch.zeros(ray_ids.shape, device=rays_chunk.device)  #(M,)
+
+        if ray_ids.numel() > 0:
             #计算theta
-            xyz_sampled = self.normalize_coord(xyz_sampled)
-            sigma_feature = self.compute_densityfeature(xyz_sampled[ray_valid]) #(bs * nsample,)
+            xyz_valid = self.normalize_coord(xyz_packed)
+            coords = self.get_coordinates(xyz_valid)
+            # density of all valid samples; app is only queried for the samples above the weight threshold
+            # (training and inference), usually a small part of the valid ones
+            sigma_feature = self.compute_densityfeature_from_coords(coords) #(M,)
 
             #激活函数
-            validsigma = self.feature2density(sigma_feature) #(bs-,)
-            #盒子内的坐标
-            sigma[ray_valid] = validsigma    #(bs,nsample)
+            sigma = self.feature2density(sigma_feature) #(M,)
 
-        #一个ray上的采样点 占的权重
-        alpha, weight, bg_weight = raw2alpha(sigma, dists * self.distance_scale)#alpha (bs,nsample,1) weight (bs,nsample,1)
+        #一个ray上的采样点 占的权重, 这里只用来挑选要查询外观的采样点
+        tau = sigma.float() * dists_packed * self.distance_scale  #(M,)
+        with torch.no_grad():
+            _, weight, _ = raw2alpha_packed(sigma, dists_packed * self.distance_scale, ray_ids, N_rays)
 
         #choose sample point
-        app_mask = weight > self.rayMarch_weight_thres  #(bs*nsample,)
+        app_mask = weight > self.rayMarch_weight_thres  #(M,)
+        app_ray_ids = ray_ids[app_mask]
 
+        valid_render_bufs = torch.zeros((0, self.n_dim), device=rays_chunk.device)
         if app_mask.any():
-            app_features = self.compute_appfeature(xyz_sampled[app_mask])  #(bs*nsample-,27)
+            # app_mask 是有效采样点的子集, 直接复用密度查询的坐标
+            app_features = self.compute_appfeature_from_coords(self.select_coordinates(coords, app_mask))  #(M-,27)
             # link PLT_blend
-            valid_render_bufs= self.renderModule(xyz_sampled[app_mask], viewdirs[app_mask], app_features, is_train, **kwargs)  #(bs*nsample-,9) + 颜色修正
-            render_buf[app_mask] = valid_render_bufs.type(torch.float32)
+            valid_render_bufs = self.renderModule(xyz_valid[app_mask], viewdirs[app_ray_ids], app_features, is_train, **kwargs)  #(M-,9) + 颜色修正
+            valid_render_bufs = valid_render_bufs.type(torch.float32)
 
 
         ret = {}
 
-        rend_dict = split_render_buffer(render_buf, self.render_buf_layout) # rgb (bs,nsample,3) opaque (bs,nsample,palette_num) sparsity_norm (bs,nsample,1)
+        rend_dict = split_render_buffer(valid_render_bufs, self.render_buf_layout) # rgb (M-,3) opaque (M-,palette_num) sparsity_norm (M-,1)
         """滤波loss"""
         # self.loss = self.get_color_and_sigma_and_alpha(app_mask,xyz_sampled, viewdirs,sigma,rend_dict)
 
-        acc_map = torch.sum(weight, -1)
-        # rgb_map = torch.sum(weight[..., None] * rend_dict['rgb'], -2)
-
-        for buf_prop in self.render_buf_layout: #rgb opaque sparsity_norm
+        # all requested maps, acc and depth in one pass: the channels are [requested buffers, 1, z],
+        # samples under the weight threshold have zero buffers
+        ret_layout = [p for p in self.render_buf_layout if p.name == 'rgb' or kwargs.get(f'ret_{p.name}_map', False)]
+        app_values = torch.cat([rend_dict[p.name] for p in ret_layout], -1)
+        values = torch.zeros((ray_ids.shape[0], app_values.shape[-1]), device=tau.device).index_put(
+            (torch.nonzero(app_mask).squeeze(-1),), app_values)
+        values = torch.cat((values, torch.ones_like(tau)[:, None], z_packed[:, None]), -1)
+        tau_grad = torch.tensor([not p.detach_weight for p in ret_layout for _ in range(p.len)] + [True, False],
+                                device=tau.device)
+        maps, weight = volume_render_packed(tau, values, ray_ids, N_rays, tau_grad)
+        acc_map = maps[:, -2]
+
+        start = 0
+        for buf_prop in ret_layout: #rgb opaque sparsity_norm
             k = buf_prop.name
-            if k == 'rgb' or kwargs.get(f'ret_{k}_map', False):
-                if buf_prop.detach_weight:
-                    w = weight[..., None].detach()
-                else:
-                    w = weight[..., None]
-
-                rend_map = torch.sum(w * rend_dict[k], -2)
+            rend_map = maps[:, start:start + buf_prop.len]
+            start += buf_prop.len
 
-                if buf_prop.type == 'RGB':
-                    if white_bg or (is_train and torch.rand((1,)) < 0.5):
-                        rend_map[..., :3] += 1. - acc_map[..., None]
+            if buf_prop.type == 'RGB':
+                if white_bg or (is_train and torch.rand((1,)) < 0.5):
+                    rend_map = rend_map + (1. - acc_map[..., None])
 
-                    rend_map = rend_map.clamp(0, 1)
+                rend_map = rend_map.clamp(0, 1)
 
-                ret[f'{k}_map'] = rend_map
+            ret[f'{k}_map'] = rend_map
 
         with torch.no_grad():
-            depth_map = torch.sum(weight * z_vals, -1)  #weight  which is depth location
+            depth_map = maps[:, -1]  #weight  which is depth location
             depth_map = depth_map + (1. - acc_map) * rays_chunk[..., -1]  #accmap which is sum(weight) = 1
 
         ret['depth_map'] = depth_map
 
 
+        # the per-sample outputs are scattered back to the dense (bs, nsample) layout
         if kwargs.get('ret_weight', False):
-            ret['weight'] = weight
+            ret['weight'] = torch.zeros((N_rays, N_samples), device=weight.device).index_put((ray_ids, sample_ids), weight)
         if kwargs.get('ret_acc_map', False):
             ret['acc_map'] = acc_map
         if kwargs.get('ret_raw_render_buf', False):
-            ret['raw_render_buf'] = render_buf
+            render_buf = torch.zeros((N_rays, N_samples, self.n_dim), device=weight.device)
+            ret['raw_render_buf'] = render_buf.index_put((app_ray_ids, sample_ids[app_mask]), valid_render_bufs)
+
+        return ret
+
+    @torch.no_grad()
+    def render_early_term(self, rays_chunk, xyz_sampled, z_vals, dists, viewdirs, ray_valid, white_bg, mask_alpha=True, **kwargs):
+        '''
+        Front-to-back compositing in segments of ray_term_segment samples. Before every segment the rays whose
+        transmittance fell below ray_term_thres are dropped, so nothing behind opaque surfaces is queried.
+        xyz_sampled, z_vals, dists, ray_valid: (bs, nsample, ...) as produced in forward, viewdirs (bs, 3)
+        '''
+        N_rays, N_samples = rays_chunk.shape[0], z_vals.shape[-1]
+        z_vals = z_vals.expand(N_rays, N_samples)  # NDC: one (1, nsample) row shared by all rays
+        device = z_vals.device
+
+        ret_layout = [p for p in self.render_buf_layout if p.name == 'rgb' or kwargs.get(f'ret_{p.name}_map', False)]
+        maps = {p.name: torch.zeros((N_rays, p.len), device=device) for p in ret_layout}
+        acc_map = torch.zeros(N_rays, device=device)
+        depth_map = torch.zeros(N_rays, device=device)
+        T = torch.ones(N_rays, device=device)
+
+        ray_ids = torch.arange(N_rays, device=device)
+        for start in range(0, N_samples, self.ray_term_segment):
+            ray_ids = ray_ids[T[ray_ids] > self.ray_term_thres]
+            if ray_ids.numel() == 0:
+                break
+            seg = slice(start, start + self.ray_term_segment)
+            pts = xyz_sampled[ray_ids, seg]
+            valid = ray_valid[ray_ids, seg]
+            if mask_alpha and self.alphaMask is not None and valid.any():
+                valid[valid.clone()] = self.alphaMask.occupied(pts[valid])
+
+            sigma = torch.zeros(valid.shape, device=device)
+            if valid.any():
+                coords = self.get_coordinates(self.normalize_coord(pts[valid]))
+                sigma[valid] = self.feature2density(self.compute_densityfeature_from_coords(coords))
+
+            # same recursion as raw2alpha, started from the transmittance left by the previous segments
+            alpha = 1. - torch.exp(-sigma * dists[ray_ids, seg] * self.distance_scale)
+            trans = torch.cumprod(torch.cat([T[ray_ids, None], 1. - alpha + 1e-10], -1), -1)
+            weight = alpha * trans[:, :-1]
+            T[ray_ids] = trans[:, -1]
+            acc_map[ray_ids] += weight.sum(-1)
+            depth_map[ray_ids] += (weight * z_vals[ray_ids, seg]).sum(-1)
+
+            app_mask = weight > self.rayMarch_weight_thres
+            if app_mask.any():
+                app_xyz = self.normalize_coord(pts[app_mask])
+                app_dirs = viewdirs[ray_ids, None].expand(pts.shape)[app_mask]
+                app_features = self.compute_appfeature_from_coords(self.select_coordinates(coords, app_mask[valid]))
+                render_bufs = self.renderModule(app_xyz, app_dirs, app_features, False, **kwargs).type(torch.float32)
+                rend_dict = split_render_buffer(render_bufs, self.render_buf_layout)
+                w = weight[app_mask][:, None]
+                app_ray_ids = ray_ids[:, None].expand(app_mask.shape)[app_mask]
+                for k in maps:
+                    maps[k].index_add_(0, app_ray_ids, w * rend_dict[k])
 
+        ret = {}
+        for buf_prop in ret_layout:
+            rend_map = maps[buf_prop.name]
+            if buf_prop.type == 'RGB':
+                if white_bg:
+                    rend_map[..., :3] += 1. - acc_map[..., None]
+                rend_map = rend_map.clamp(0, 1)
+            ret[f'{buf_prop.name}_map'] = rend_map
+
+        ret['depth_map'] = depth_map + (1. - acc_map) * rays_chunk[..., -1]
+        if kwargs.get('ret_acc_map', False):
+            ret['acc_map'] = acc_map
         return ret
 
     def get_color_and_sigma_and_alpha(self, app_mask, xyz_sample, viewdir, sigma_original, rend_dict_original):
@@ -542,12 +1025,11 @@ class TensorBase(torch.nn.Module):
         viewdir = torch.reshape(viewdir[app_mask], (-1, 1, 3)).expand(deta_xyz.shape[0], deta_xyz.shape[1],
                                                                       3)  # (bs*nsample,10,3)
 
-        sigma_feature = self.compute_densityfeature(torch.reshape(deta_xyz, (-1, 3)))  # bs*nsample-,
+        sigma_feature, app_features = self.compute_features(torch.reshape(deta_xyz, (-1, 3)))  # bs*nsample-,
 
         # 激活函数  得到sigma
         validsigma = self.feature2density(sigma_feature)  # bs*nsample-,
 
-        app_features = self.compute_appfeature(torch.reshape(deta_xyz, (-1, 3)))
         # 获得 color 和 opaque
         render_bufs = self.renderModule(torch.reshape(deta_xyz, (-1, 3)), torch.reshape(viewdir, (-1, 3)), app_features,
                                         is_train=False)
@@ -0,0 +1,97 @@
+import torch
+
+
+'''
+压缩采样点的体渲染: 所有光线的有效采样点按光线顺序排成一列, 透射率, 权重和所有渲染图在一次分段累加中得到,
+反向传播用解析梯度, 不保存中间的 autograd 图
+'''
+
+def segment_offsets(ray_ids, n_rays, n_samples):
+    # index of the first and the last sample of every ray (clamped for rays without samples)
+    counts = torch.bincount(ray_ids, minlength=n_rays)
+    ends = torch.cumsum(counts, 0)
+    last = max(n_samples - 1, 0)
+    return (ends - counts).clamp(max=last), (ends - 1).clamp(min=0, max=last)
+
+
+def packed_transmittance(alpha, ray_ids, n_rays):
+    '''
+    Transmittance in front of every sample, T_i = prod_{j<i} (1 - alpha_j + 1e-10) within its ray, and behind
+    every ray. The exclusive cumsum of the logs is accumulated in float64 so the subtraction of the ray start stays
+    exact over long sample lists.
+    '''
+    log_t = torch.log(1. - alpha + 1e-10).double()
+    excl = torch.cumsum(log_t, 0) - log_t
+    if log_t.shape[0] > 0:
+        first, _ = segment_offsets(ray_ids, n_rays, log_t.shape[0])
+        excl = excl - excl[first][ray_ids]
+    T_last = torch.zeros(n_rays, dtype=log_t.dtype, device=log_t.device).index_add(0, ray_ids, log_t)
+    return torch.exp(excl).to(alpha.dtype), torch.exp(T_last).to(alpha.dtype)
+
+
+class PackedVolumeRender(torch.autograd.Function):
+    '''
+    maps[r] = sum_i w_i values_i over the samples i of ray r, w_i = T_i alpha_i, alpha_i = 1 - exp(-tau_i).
+    Backward, with S_i = sum_{k>i} w_k values_k in the same ray and f_i = 1 - alpha_i + 1e-10:
+        dmaps/dtau_i = (1 - alpha_i) (T_i values_i - S_i / f_i)     (= T_{i+1} values_i - S_i without the epsilon)
+        dmaps/dvalues_i = w_i
+    Only the channels set in tau_grad pass gradient to tau (detached weights of the render buffer layout).
+    '''
+    @staticmethod
+    def forward(ctx, tau, values, ray_ids, n_rays, tau_grad):
+        alpha = 1. - torch.exp(-tau)
+        T, _ = packed_transmittance(alpha, ray_ids, n_rays)
+        weights = alpha * T
+        maps = torch.zeros((n_rays, values.shape[-1]), dtype=values.dtype, device=values.device)
+        maps.index_add_(0, ray_ids, weights[:, None] * values)
+
+        ctx.n_rays = n_rays
+        ctx.save_for_backward(alpha, T, weights, values, ray_ids, tau_grad)
+        ctx.mark_non_differentiable(weights)
+        return maps, weights
+
+    @staticmethod
+    def backward(ctx, grad_maps, grad_weights):
+        alpha, T, weights, values, ray_ids, tau_grad = ctx.saved_tensors
+        grad_tau = grad_values = None
+        g = grad_maps[ray_ids]  # (M, C)
+
+        if ctx.needs_input_grad[1]:
+            grad_values = weights[:, None] * g
+        if ctx.needs_input_grad[0] and values.shape[0] == 0:
+            grad_tau = torch.zeros_like(alpha)
+        elif ctx.needs_input_grad[0]:
+            # grad_maps is constant along a ray, so S_i is only needed contracted with it: a scalar per sample,
+            # taken from the inclusive cumsum as cs[last sample of the ray] - cs[i]
+            vg = (values * g * tau_grad.to(g.dtype)).sum(-1)
+            cs = torch.cumsum((weights * vg).double(), 0)
+            _, last = segment_offsets(ray_ids, ctx.n_rays, values.shape[0])
+            behind = (cs[last][ray_ids] - cs).to(values.dtype)
+            keep = 1. - alpha
+            grad_tau = keep * T * vg - keep / (keep + 1e-10) * behind
+        return grad_tau, grad_values, None, None, None
+
+
+def volume_render_packed(tau, values, ray_ids, n_rays, tau_grad=None):
+    '''
+    tau: (M,) sigma * dist of the packed samples (sorted by ray), values: (M, C) per sample buffers,
+    ray_ids: (M,) long, tau_grad: (C,) bool, channels whose weights take gradient (all by default)
+    Returns maps (n_rays, C) and weights (M,) (no gradient).
+    '''
+    if tau_grad is None:
+        tau_grad = torch.ones(values.shape[-1], dtype=torch.bool, device=values.device)
+    return PackedVolumeRender.apply(tau.float(), values.float(), ray_ids, n_rays, tau_grad)
+
+
+def volume_render_packed_reference(tau, values, ray_ids, n_rays, tau_grad=None):
+    # the same maps through plain autograd, for checking PackedVolumeRender
+    alpha = 1. - torch.exp(-tau.float())
+    T, _ = packed_transmittance(alpha, ray_ids, n_rays)
+    weights = alpha * T
+    if tau_grad is not None:
+        w = torch.where(tau_grad[None], weights[:, None], weights[:, None].detach())
+    else:
+        w = weights[:, None]
+    maps = torch.zeros((n_rays, values.shape[-1]), device=values.device).index_add(0, ray_ids, w * values.float())
+    return maps, weights.detach()
+
@@ -13,7 +13,8 @@ from matplotlib import pyplot as plt
 
 # %%
 from engine.trainer import Trainer
-from engine.eval import evaluation_path
+from engine.eval import check_precision, evaluation_path, evaluation_path_palettes
+from engine.decomp_cache import DecompCache
 from data import dataset_dict
 from utils.opt import config_parser
 from utils.vis import plot_palette_colors, visualize_depth_numpy, visualize_palette_components_numpy
@@ -130,8 +131,12 @@ print_divider()
 # 训练器
 trainer = Trainer(args, run_dir, ckpt_dir, tb_dir)
 # 模型
-model = trainer.build_network()
+model = trainer.load_baked() if args.render_baked else trainer.build_network()
 model.eval()
+if args.half_inference and not args.render_baked:
+    # psnr of the fp32 model against its float16 conversion on N_vis test views, the model stays in float16
+    check_precision(trainer.test_dataset, model, args, trainer.renderer, N_vis=args.N_vis,
+                    white_bg=trainer.test_dataset.white_bg, ndc_ray=args.ndc_ray, device=trainer.device)
 print_divider()
 
 # Create downsampled dataset
@@ -144,7 +149,7 @@ print_divider()
 # %%
 def palette_editing():
     palette_prior = np.load('palette_rgb_11.npy')
-    palette = model.renderModule.palette.get_palette_array().detach().cpu().numpy()
+    palette = model.get_palette_array().detach().cpu().numpy()
     palette = palette.clip(0. ,1.)
     palette_prior = palette_prior.clip(0.,1.)
     # %%
@@ -256,6 +261,34 @@ def save(palette,new_palette,N_samples=-1,is_choose=False,net1=None,net2=None,pr
     # %%
 
 
+def save_palettes(palettes, N_samples=-1, use_cache=True, cam_poses='train', **kwargs):
+    '''
+    Render every palette of the stack (K, n_palette, 3) along the cam_poses cameras with a single pass per camera.
+    With use_cache the decomposition of every camera is kept in run_dir/decomp_cache, later edits are only recolored.
+    '''
+    save_dir = os.path.join(out_dir, f'render_palettes_{cam_poses}{"_" + edit_name if edit_name else ""}')
+
+    if os.path.exists(save_dir):
+        print('Error: directory exists. Please specify another `edit_name`.')
+    else:
+        c2ws = trainer.test_dataset.poses if cam_poses == 'test' else trainer.test_dataset.render_path
+        if cam_poses == 'train':
+            c2ws = trainer.train_dataset.poses
+        white_bg = trainer.test_dataset.white_bg
+        ndc_ray = trainer.args.ndc_ray
+
+        print('Save renderings to', save_dir)
+        print('=== render path ======>', c2ws.shape, 'palettes', tuple(palettes.shape))
+        decomp_cache = None
+        if use_cache:
+            decomp_cache = DecompCache(os.path.join(run_dir, 'decomp_cache'), model, trainer.test_dataset.img_wh,
+                                       N_samples=N_samples, ndc_ray=ndc_ray)
+        with torch.no_grad():
+            evaluation_path_palettes(trainer.test_dataset, model, c2ws, trainer.renderer, palettes, save_dir,
+                                     N_samples=N_samples, white_bg=white_bg, ndc_ray=ndc_ray, save_video=True,
+                                     device=trainer.device, decomp_cache=decomp_cache, **kwargs)
+
+
 # %%
 
 """
@@ -264,7 +297,7 @@ read color
 # palette_editing()
 # palette_prior = np.load('palette_rgb_11.npy')
 """ color edit"""
-palette = model.renderModule.palette.get_palette_array().detach()
+palette = model.get_palette_array().detach()
 # palette[...,0,:] = torch.tensor([1.,0.,0.])
 #
 # palette = palette[...,:4,:]
@@ -338,5 +371,8 @@ sole palette
 # print(new_palette)
 # new_palette = np.load("./data_palette/drums/rgb_palette_correct.npy")
 
-palette[...,1,:] = torch.tensor([0,1,0])
-save(palette.cpu(),new_palette=None,N_samples=args.nSamples,ret_color_correction_map=True)
+# stack of edits, every camera is rendered once and recolored with each palette (the original one first)
+# per-point palettes (is_choose) still go through save()
+palettes = palette[None].repeat(2, 1, 1)
+palettes[1, 1, :] = torch.tensor([0, 1, 0])
+save_palettes(palettes.cpu(), N_samples=args.nSamples, use_cache=bool(args.decomp_cache))
@@ -1,6 +1,7 @@
 import numpy as np
 import torch
 
+from engine.distributed import init_distributed, is_main_process, barrier, cleanup
 from engine.trainer import Trainer
 from utils.opt import config_parser
 from utils.fs import setup_wd
@@ -10,17 +11,28 @@ def main(parser):
     args, _ = parser.parse_known_args()
     print('args =', args, end='\n\n')
 
+    init_distributed(args.dist_backend)
+    # rank 0 creates the working directory, the other ranks find it
+    if not is_main_process():
+        barrier()
     run_dir, ckpt_dir, tb_dir = setup_wd(parser, args)
+    if is_main_process():
+        barrier()
 
     trainer = Trainer(args, run_dir, ckpt_dir, tb_dir)
     
-    if args.export_mesh:
+    if args.export_mesh and is_main_process():
         trainer.export_mesh()
 
+    if args.export_baked and is_main_process():
+        trainer.export_baked()
+
     if args.render_only and (args.render_train or args.render_test or args.render_path):
-        trainer.render_test(trainer.build_network())
+        if is_main_process():
+            trainer.render_test(trainer.load_baked() if args.render_baked else trainer.build_network())
     else:
         trainer.train()
+    cleanup()
 
 
 if __name__ == '__main__':
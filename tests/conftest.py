@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the packages (models, utils, engine, data) are imported from the repository root, as in run_recolornerf.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,85 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from models.tensorBase import AlphaGridMask, pack_bits, unpack_bits
+
+
+def random_mask(shape, density=0.05, seed=0):
+    # D x H x W nodes, x fastest, with a few isolated occupied nodes
+    g = torch.Generator().manual_seed(seed)
+    aabb = torch.tensor([[-1.5, -1.2, -1.], [1.5, 1.2, 1.]])
+    return AlphaGridMask.from_packed('cpu', aabb, pack_bits(torch.rand(shape, generator=g) < density), shape)
+
+
+@pytest.mark.parametrize('shape', [(9, 13, 17), (16, 16, 16), (7, 1, 30)])
+def test_cells_and_blocks_match_dense_pooling(shape):
+    mask = random_mask(shape)
+    D, H, W = shape
+    nodes = unpack_bits(mask.occupancy, D * H * W).view(1, 1, D, H, W).float()
+
+    # dense volumes of the first version of build_cells / block_occupancy
+    cells = F.max_pool3d(F.pad(nodes, (1, 1, 1, 1, 1, 1)), 2, stride=1)
+    assert torch.equal(mask.cell_bits, pack_bits(cells > 0))
+
+    b = mask.march_block
+    blocks = F.max_pool3d(cells, 3, stride=1, padding=1)
+    blocks = F.pad(blocks, (0, (-(W + 1)) % b, 0, (-(H + 1)) % b, 0, (-(D + 1)) % b))
+    assert torch.equal(mask.block_occupancy(), pack_bits(F.max_pool3d(blocks, b) > 0))
+
+
+def test_cells_in_small_tiles():
+    shape = (11, 6, 5)
+    mask = random_mask(shape, density=0.1, seed=1)
+    cell_bits = mask.cell_bits
+    # one cell plane per tile, the packed bits cross the tile borders
+    mask.build_cells(chunk=1)
+    assert torch.equal(mask.cell_bits, cell_bits)
+
+
+def small_model(grid=(12, 10, 14), seed=0):
+    from models.tensoRF import TensorVMSplit
+
+    torch.manual_seed(seed)
+    aabb = torch.tensor([[-1.5, -1.2, -1.], [1.5, 1.2, 1.]])
+    tensorf = TensorVMSplit(aabb, list(grid), 'cpu', density_n_comp=[4] * 3, appearance_n_comp=[4] * 3, app_dim=3,
+                            shadingMode='RGB', pos_pe=2, view_pe=2, fea_pe=2, featureC=16, density_shift=-5)
+    with torch.no_grad():
+        for p in tensorf.density_plane:
+            p.normal_(0, 1.)
+    return tensorf
+
+
+def dense_update_alpha_mask(tensorf, gridSize):
+    # updateAlphaMask of the baseline: dense alpha and xyz volumes, one 3x3x3 max pool over the whole grid
+    samples = torch.stack(torch.meshgrid(*[torch.linspace(0, 1, n) for n in gridSize], indexing='ij'), -1)
+    dense_xyz = tensorf.aabb[0] * (1 - samples) + tensorf.aabb[1] * samples
+    alpha = torch.zeros_like(dense_xyz[..., 0])
+    for i in range(gridSize[0]):
+        alpha[i] = tensorf.compute_alpha(dense_xyz[i].view(-1, 3), tensorf.stepSize).view((gridSize[1], gridSize[2]))
+    dense_xyz = dense_xyz.transpose(0, 2).contiguous()
+    alpha = alpha.clamp(0, 1).transpose(0, 2).contiguous()[None, None]
+    alpha = F.max_pool3d(alpha, kernel_size=3, padding=1, stride=1).view(gridSize[::-1])
+    mask = alpha >= tensorf.alphaMask_thres
+    valid_xyz = dense_xyz[mask]
+    return pack_bits(mask), torch.stack((valid_xyz.amin(0), valid_xyz.amax(0)))
+
+
+@pytest.mark.parametrize('chunk', [1 << 21, 37])
+def test_update_alpha_mask_matches_dense(chunk):
+    tensorf = small_model()
+    gridSize = [11, 9, 13]
+    with torch.no_grad():
+        bits_ref, aabb_ref = dense_update_alpha_mask(tensorf, gridSize)
+        bits, _, total = tensorf.build_alpha_bits(gridSize, chunk=chunk)
+        assert total > 0
+        assert torch.equal(bits, bits_ref)
+
+        new_aabb = tensorf.updateAlphaMask(gridSize)
+    assert torch.equal(tensorf.alphaMask.occupancy, bits_ref)
+    torch.testing.assert_close(new_aabb, aabb_ref)
+    assert tensorf.alphaMask.shape == tuple(gridSize[::-1])
+
+    # the cells of the mask are those of the dense volume
+    dense = AlphaGridMask('cpu', tensorf.aabb, unpack_bits(bits_ref, 11 * 9 * 13).view(13, 9, 11).float())
+    assert torch.equal(tensorf.alphaMask.cell_bits, dense.cell_bits)
@@ -0,0 +1,55 @@
+import torch
+
+from utils.render import ChunkOutputs, chunkify_render, render_out_shapes
+
+
+def small_model(seed=0):
+    from models.tensoRF import TensorVMSplit
+
+    torch.manual_seed(seed)
+    aabb = torch.tensor([[-1.5, -1.2, -1.], [1.5, 1.2, 1.]])
+    tensorf = TensorVMSplit(aabb, [12, 10, 14], 'cpu', density_n_comp=[4] * 3, appearance_n_comp=[4] * 3, app_dim=3,
+                            shadingMode='RGB', pos_pe=2, view_pe=2, fea_pe=2, featureC=16, density_shift=-5)
+    with torch.no_grad():
+        for p in tensorf.density_plane:
+            p.normal_(0, 1.)
+    return tensorf
+
+
+def rays_missing_first(n_miss=8, n_hit=40, seed=1):
+    # the first chunk only holds rays that point away from the box, no sample of it survives
+    g = torch.Generator().manual_seed(seed)
+    miss_o = torch.tensor([4., 0., 0.]).expand(n_miss, 3)
+    miss_d = torch.tensor([1., 0., 0.]).expand(n_miss, 3)
+    hit_o = torch.randn((n_hit, 3), generator=g)
+    hit_o = hit_o / hit_o.norm(dim=-1, keepdim=True) * 4.
+    hit_d = torch.nn.functional.normalize(torch.rand((n_hit, 3), generator=g) - 0.5 - hit_o, dim=-1)
+    return torch.cat((torch.cat((miss_o, miss_d), -1), torch.cat((hit_o, hit_d), -1)))
+
+
+@torch.no_grad()
+def test_chunks_match_one_pass_after_an_empty_chunk():
+    tensorf = small_model()
+    rays = rays_missing_first()
+    ref = tensorf(rays, is_train=False, white_bg=True, ndc_ray=False, N_samples=-1, ret_acc_map=True)
+    assert (ref['acc_map'][:8] == 0).all() and (ref['acc_map'][8:] > 0).any()
+
+    res = chunkify_render(rays, tensorf, chunk=8, device='cpu', ret_acc_map=True)
+    assert res.keys() == ref.keys()
+    for k in ref:
+        torch.testing.assert_close(res[k], ref[k], rtol=1e-5, atol=1e-6)
+
+
+def test_outputs_follow_the_layout():
+    tensorf = small_model()
+    shapes = render_out_shapes(tensorf, ret_acc_map=True, ret_weight=True)
+    assert shapes == {'rgb_map': (3,), 'depth_map': (), 'acc_map': (), 'weight': (tensorf.nSamples,)}
+
+    out = ChunkOutputs(6, shapes)
+    # the first chunk returns neither acc_map nor weight, the maps are allocated anyway
+    out.write(0, {'rgb_map': torch.ones(3, 3), 'depth_map': torch.ones(3)})
+    out.write(3, {'rgb_map': torch.ones(3, 3), 'depth_map': torch.ones(3), 'acc_map': torch.ones(3),
+                  'weight': torch.ones(3, tensorf.nSamples)})
+    res = out.result()
+    assert res['weight'].shape == (6, tensorf.nSamples)
+    assert torch.equal(res['acc_map'], torch.tensor([0., 0., 0., 1., 1., 1.]))
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+import torch
+from scipy.spatial import ConvexHull
+
+from utils.color import quantized_color_statistics
+
+
+def sorted_rows(points):
+    points = np.asarray(points)
+    return points[np.lexsort(np.round(points, 9).T[::-1])]
+
+
+def random_colors(n=50000, seed=0):
+    rng = np.random.default_rng(seed)
+    # a blob of colors inside the cube plus some pure white background pixels
+    colors = rng.normal(0.5, 0.1, (n, 3)).clip(0., 1.)
+    colors[rng.random(n) < 0.1] = 1.
+    return colors
+
+
+@pytest.mark.parametrize('chunk', [1 << 20, 777, 64])
+def test_streamed_statistics_match_exact_ones(chunk):
+    colors = random_colors()
+    # small chunks stream the colors in many parts and re-hull the candidate vertices on the way
+    bins, counts, hull_vertices = quantized_color_statistics(colors, chunk=chunk)
+
+    hull = ConvexHull(colors)
+    np.testing.assert_allclose(sorted_rows(hull_vertices), sorted_rows(hull.points[hull.vertices]))
+
+    q = (colors * 255).round().astype(np.uint8) // 8
+    ref_bins, ref_counts = np.unique(q, axis=0, return_counts=True)
+    # both in ascending bin order
+    np.testing.assert_allclose(bins, (ref_bins * 8 + 4) / 255.)
+    assert np.array_equal(counts, ref_counts)
+
+
+def test_inputs_and_white_background():
+    colors = random_colors(seed=1)
+    uint8 = (colors * 255).round().astype(np.uint8)
+    ref = quantized_color_statistics(uint8.astype(np.float64) / 255.)
+    # uint8 images (any leading shape) and torch tensors give the same statistics
+    for rgbs in (uint8.reshape(10, -1, 3), torch.from_numpy(uint8), torch.from_numpy(uint8 / 255.)):
+        res = quantized_color_statistics(rgbs, chunk=4096)
+        np.testing.assert_allclose(res[0], ref[0])
+        assert np.array_equal(res[1], ref[1])
+        np.testing.assert_allclose(sorted_rows(res[2]), sorted_rows(ref[2]))
+
+    bins, counts, hull_vertices = quantized_color_statistics(colors, white_bg=True)
+    foreground = colors[(colors < 1.).any(-1)]
+    assert counts.sum() == foreground.shape[0]
+    hull = ConvexHull(foreground)
+    np.testing.assert_allclose(sorted_rows(hull_vertices), sorted_rows(hull.points[hull.vertices]))
@@ -0,0 +1,82 @@
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+from engine.decomp_cache import DecompCache, model_fingerprint
+from engine.eval import evaluation_path_palettes
+from models.palette_tensoRF import PaletteTensorVM
+from utils.ray import get_ray_directions
+from utils.render import chunkify_render
+
+
+def small_model(n_palette=4, seed=0):
+    torch.manual_seed(seed)
+    aabb = torch.tensor([[-1.5, -1.5, -1.5], [1.5, 1.5, 1.5]])
+    tensorf = PaletteTensorVM(aabb, [24, 24, 24], 'cpu', density_n_comp=[4] * 3, appearance_n_comp=[4] * 3, app_dim=27,
+                              shadingMode='PLT_AlphaBlend', pos_pe=2, view_pe=2, fea_pe=2, featureC=16,
+                              near_far=(2., 6.), density_shift=-5, palette=torch.rand(n_palette, 3))
+    tensorf.eval()
+    return tensorf
+
+
+def small_camera():
+    W, H = 8, 6
+    directions = get_ray_directions(H, W, [8., 8.])
+    dataset = SimpleNamespace(img_wh=(W, H), directions=directions / directions.norm(dim=-1, keepdim=True),
+                              focal=[8., 8.])
+    # two cameras 4 away from the origin, looking at it
+    front = torch.eye(4)
+    front[2, 3] = -4.
+    side = torch.tensor([[0., 0., -1., 4.], [0., 1., 0., 0.], [1., 0., 0., 0.], [0., 0., 0., 1.]])
+    return dataset, torch.stack([front, side])
+
+
+def counting_renderer(calls):
+    def renderer(*args, **kwargs):
+        calls.append(1)
+        return chunkify_render(*args, **kwargs)
+    return renderer
+
+
+@torch.no_grad()
+def test_cache_hit_matches_fresh_render(tmp_path):
+    tensorf = small_model()
+    dataset, c2ws = small_camera()
+    palettes = torch.rand((2, 4, 3), generator=torch.Generator().manual_seed(1))
+    kwargs = dict(white_bg=True, device='cpu')
+
+    calls = []
+    cache = DecompCache(tmp_path, tensorf, dataset.img_wh)
+    miss = evaluation_path_palettes(dataset, tensorf, c2ws, counting_renderer(calls), palettes, decomp_cache=cache, **kwargs)
+    assert len(calls) == len(c2ws)
+    hit = evaluation_path_palettes(dataset, tensorf, c2ws, counting_renderer(calls), palettes, decomp_cache=cache, **kwargs)
+    assert len(calls) == len(c2ws), 'cached cameras were rendered again'
+    fresh = evaluation_path_palettes(dataset, tensorf, c2ws, chunkify_render, palettes, **kwargs)
+
+    for k in range(palettes.shape[0]):
+        for miss_frame, hit_frame, fresh_frame in zip(miss[k], hit[k], fresh[k]):
+            assert np.array_equal(miss_frame, hit_frame)
+            # the cache keeps float16 maps, one step of uint8 at most
+            assert np.abs(hit_frame.astype(int) - fresh_frame.astype(int)).max() <= 1
+
+
+def test_cache_invalidation(tmp_path):
+    tensorf = small_model()
+    dataset, c2ws = small_camera()
+    cache = DecompCache(tmp_path, tensorf, dataset.img_wh)
+    assert cache.view_path(c2ws[0]) != cache.view_path(c2ws[1])
+    assert DecompCache(tmp_path, tensorf, dataset.img_wh).view_path(c2ws[0]) == cache.view_path(c2ws[0])
+    assert DecompCache(tmp_path, tensorf, (16, 12)).view_path(c2ws[0]) != cache.view_path(c2ws[0])
+    assert DecompCache(tmp_path, tensorf, dataset.img_wh, ndc_ray=True).view_path(c2ws[0]) != cache.view_path(c2ws[0])
+
+    tensorf.ray_term_thres = 1e-3
+    assert DecompCache(tmp_path, tensorf, dataset.img_wh).view_path(c2ws[0]) != cache.view_path(c2ws[0])
+
+    fingerprint = model_fingerprint(tensorf)
+    with torch.no_grad():
+        tensorf.density_line[0][0, 0, 0, 0] += 1.
+    assert model_fingerprint(tensorf) != fingerprint
+    fingerprint = model_fingerprint(tensorf)
+    tensorf.updateAlphaMask(gridSize=(24, 24, 24))
+    assert model_fingerprint(tensorf) != fingerprint
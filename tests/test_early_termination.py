@@ -0,0 +1,57 @@
+import pytest
+import torch
+
+
+def small_model(seed=0):
+    from models.tensoRF import TensorVMSplit
+
+    torch.manual_seed(seed)
+    aabb = torch.tensor([[-1.5, -1.2, -1.], [1.5, 1.2, 1.]])
+    tensorf = TensorVMSplit(aabb, [24, 20, 28], 'cpu', density_n_comp=[4] * 3, appearance_n_comp=[4] * 3, app_dim=3,
+                            shadingMode='RGB', pos_pe=2, view_pe=2, fea_pe=2, featureC=16, density_shift=-2)
+    with torch.no_grad():
+        for p in tensorf.density_plane:
+            p.normal_(0, 1.)
+    tensorf.updateAlphaMask(gridSize=(24, 20, 28))
+    return tensorf
+
+
+def random_rays(n=256, seed=1):
+    g = torch.Generator().manual_seed(seed)
+    rays_o = torch.randn((n, 3), generator=g)
+    rays_o = rays_o / rays_o.norm(dim=-1, keepdim=True) * 4.
+    rays_d = torch.nn.functional.normalize(torch.rand((n, 3), generator=g) - 0.5 - rays_o, dim=-1)
+    return torch.cat((rays_o, rays_d), -1)
+
+
+@pytest.mark.parametrize('skip_empty_space', [False, True])
+@torch.no_grad()
+def test_early_termination_matches_full_render(skip_empty_space):
+    tensorf = small_model()
+    tensorf.skip_empty_space = skip_empty_space
+    rays = random_rays()
+    kwargs = dict(is_train=False, white_bg=True, ndc_ray=False, N_samples=-1, ret_acc_map=True)
+
+    full = tensorf(rays, **kwargs)
+    assert (full['acc_map'] > 1 - 1e-3).any(), 'no opaque ray, nothing to terminate'
+
+    tensorf.ray_term_thres = 1e-4
+    tensorf.ray_term_segment = 8
+    early = tensorf(rays, **kwargs)
+    assert early.keys() == full.keys()
+    # a terminated ray only misses what lies behind a transmittance below ray_term_thres
+    torch.testing.assert_close(early['acc_map'], full['acc_map'], rtol=0, atol=2e-4)
+    torch.testing.assert_close(early['rgb_map'], full['rgb_map'], rtol=0, atol=3e-4)
+    torch.testing.assert_close(early['depth_map'], full['depth_map'], rtol=0, atol=2e-3)
+
+
+def test_early_termination_off_in_training():
+    tensorf = small_model()
+    tensorf.ray_term_thres = 0.5
+    rays = random_rays(64)
+    torch.manual_seed(0)
+    train = tensorf(rays, is_train=True, white_bg=True, ndc_ray=False, N_samples=-1)
+    tensorf.ray_term_thres = 0.
+    torch.manual_seed(0)
+    ref = tensorf(rays, is_train=True, white_bg=True, ndc_ray=False, N_samples=-1)
+    torch.testing.assert_close(train['rgb_map'], ref['rgb_map'])
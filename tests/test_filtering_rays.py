@@ -0,0 +1,81 @@
+from functools import partial
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from engine.trainer import SimpleSampler_2
+
+
+def small_model():
+    from models.tensoRF import TensorVMSplit
+    from models.tensorBase import AlphaGridMask, pack_bits
+
+    aabb = torch.tensor([[-1.5, -1.2, -1.], [1.5, 1.2, 1.]])
+    tensorf = TensorVMSplit(aabb, [24, 20, 28], 'cpu', density_n_comp=[4] * 3, appearance_n_comp=[4] * 3, app_dim=3,
+                            shadingMode='RGB', pos_pe=2, view_pe=2, fea_pe=2, featureC=16)
+    # D x H x W nodes, one occupied clump and a few isolated nodes
+    bits = torch.rand((28, 20, 24), generator=torch.Generator().manual_seed(0)) < 0.001
+    bits[4:10, 3:9, 12:18] = True
+    tensorf.alphaMask = AlphaGridMask.from_packed('cpu', aabb, pack_bits(bits), bits.shape)
+    return tensorf
+
+
+def random_rays(n=3000, seed=1):
+    # rays from a sphere around the box, aimed around it so that some miss the bbox
+    g = torch.Generator().manual_seed(seed)
+    rays_o = torch.randn((n, 3), generator=g)
+    rays_o = rays_o / rays_o.norm(dim=-1, keepdim=True) * 4.
+    rays_d = torch.nn.functional.normalize((torch.rand((n, 3), generator=g) * 2 - 1) * 2.5 - rays_o, dim=-1)
+    return torch.cat((rays_o, rays_d), -1)
+
+
+@pytest.mark.parametrize('resident', [False, True])
+def test_incremental_filters_match_one_full_filter(resident):
+    tensorf = small_model()
+    rays = random_rays()
+    # rays carry their index in the rgbs, the surviving rows show which rays were kept
+    dataset = SimpleNamespace(all_rays=rays.clone(), all_rgbs=torch.arange(rays.shape[0]).float()[:, None].repeat(1, 3))
+    sampler = SimpleSampler_2(dataset, 256)
+    if resident:
+        sampler.to_device('cpu')
+
+    full = tensorf.filtering_rays(rays, None, return_mask=True)
+    in_bbox = tensorf.filtering_rays(rays, None, bbox_only=True, return_mask=True)
+    assert 0 < full.sum() < in_bbox.sum() < rays.shape[0], 'the rays should exercise both filters'
+    assert not (full & ~in_bbox).any()
+
+    # the trainer first drops the rays outside the bbox, then tests only the survivors against the alpha mask
+    sampler.apply_filter(partial(tensorf.filtering_rays, chunk=37), bbox_only=True)
+    sampler.apply_filter(partial(tensorf.filtering_rays, chunk=37))
+    kept = torch.nonzero(full).squeeze(-1)
+    if resident:
+        assert torch.equal(sampler.all_rgbs[:, 0].long(), kept)
+        assert torch.equal(sampler.all_rays, rays[kept])
+    else:
+        assert torch.equal(sampler.ray_ids, kept)
+    assert sampler.total == kept.shape[0]
+
+
+def test_filtered_rows_with_ray_ids():
+    tensorf = small_model()
+    rays = random_rays(500)
+    rgbs = torch.rand((500, 3))
+    ray_ids = torch.arange(0, 500, 3)
+    mask = tensorf.filtering_rays(rays, None, return_mask=True, ray_ids=ray_ids)
+    assert mask.shape == ray_ids.shape
+    torch.testing.assert_close(mask, tensorf.filtering_rays(rays, None, return_mask=True)[ray_ids])
+
+    kept_rays, kept_rgbs = tensorf.filtering_rays(rays, rgbs, ray_ids=ray_ids)
+    assert torch.equal(kept_rays, rays[ray_ids[mask]]) and torch.equal(kept_rgbs, rgbs[ray_ids[mask]])
+
+
+def test_grid_traversal_keeps_every_sampled_hit():
+    # the rays the sample based filter of TensoRF keeps (some sample_ray point in the mask) are kept by the traversal
+    tensorf = small_model()
+    rays = random_rays(1000)
+    xyz, _, valid = tensorf.sample_ray(rays[:, :3], rays[:, 3:6], is_train=False, N_samples=4 * tensorf.nSamples)
+    sampled_hit = (valid & tensorf.alphaMask.occupied(xyz.view(-1, 3)).view(valid.shape)).any(-1)
+    kept = tensorf.filtering_rays(rays, None, return_mask=True)
+    assert sampled_hit.any()
+    assert not (sampled_hit & ~kept).any()
@@ -0,0 +1,57 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from models.palette_tensoRF import PaletteTensorVM
+
+DEVICES = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+
+
+def small_model(device, n_palette=4, seed=0):
+    torch.manual_seed(seed)
+    aabb = torch.tensor([[-1.5, -1.5, -1.5], [1.5, 1.5, 1.5]], device=device)
+    tensorf = PaletteTensorVM(aabb, [24, 24, 24], device, density_n_comp=[4] * 3, appearance_n_comp=[4] * 3,
+                              app_dim=27, shadingMode='PLT_AlphaBlend', pos_pe=2, view_pe=2, fea_pe=2, featureC=16,
+                              near_far=(2., 6.), density_shift=-5, palette=torch.rand(n_palette, 3))
+    tensorf.eval()
+    return tensorf
+
+
+def rays_towards_center(device, n_rays=128, seed=1):
+    g = torch.Generator().manual_seed(seed)
+    rays_o = torch.randn((n_rays, 3), generator=g)
+    rays_o = rays_o / rays_o.norm(dim=-1, keepdim=True) * 4.
+    rays_d = (torch.rand((n_rays, 3), generator=g) * 2 - 1) * 0.5 - rays_o
+    return torch.cat([rays_o, rays_d / rays_d.norm(dim=-1, keepdim=True)], -1).to(device)
+
+
+def skip_without_half(device):
+    try:
+        F.grid_sample(torch.zeros((1, 1, 2, 2), dtype=torch.float16, device=device),
+                      torch.zeros((1, 1, 1, 2), dtype=torch.float16, device=device), align_corners=True)
+        torch.nn.Linear(2, 2).to(device).half()(torch.zeros((1, 2), dtype=torch.float16, device=device))
+    except RuntimeError:
+        pytest.skip(f'float16 grid_sample / linear not available on {device}')
+
+
+@pytest.mark.parametrize('device', DEVICES)
+@torch.no_grad()
+def test_half_inference_matches_fp32(device):
+    skip_without_half(device)
+    tensorf = small_model(device)
+    rays = rays_towards_center(device)
+    kwargs = dict(is_train=False, white_bg=True, ndc_ray=False, N_samples=-1, ret_opaque_map=True)
+    ref = tensorf(rays, **kwargs)
+
+    tensorf.half_inference()
+    assert all(p.dtype == torch.float16 for p in list(tensorf.density_plane) + list(tensorf.app_line))
+    assert tensorf.renderModule.mlp[0].weight.dtype == torch.float16
+    # the palette is edited in place, it stays fp32
+    assert tensorf.get_palette_array().dtype == torch.float32
+
+    res = tensorf(rays, **kwargs)
+    for k in ('rgb_map', 'opaque_map', 'depth_map'):
+        assert res[k].dtype == torch.float32
+    assert (res['rgb_map'] - ref['rgb_map']).abs().max() < 1e-2
+    assert (res['opaque_map'] - ref['opaque_map']).abs().max() < 1e-2
+    assert (res['depth_map'] - ref['depth_map']).abs().mean() < 1e-2
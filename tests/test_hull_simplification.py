@@ -0,0 +1,67 @@
+import glob
+import os
+
+import imageio
+import numpy as np
+import pytest
+
+from utils.color import quantized_color_statistics
+from utils.palette_utils.Additive_mixing_layers_extraction import Hull_Simplification_determined_version
+from utils.palette_utils.Hull_simplification_fast import Hull_Simplification_fast_version
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ERROR_THRES = 2. / 256.  # Trainer.build_palette
+
+
+def sorted_vertices(vertices):
+    # both versions return the hull vertices in their own order
+    vertices = np.asarray(vertices)
+    return vertices[np.lexsort(np.round(vertices, 6).T[::-1])]
+
+
+def assert_same_palette(fast, determined):
+    fast, determined = sorted_vertices(fast), sorted_vertices(determined)
+    assert fast.shape == determined.shape
+    np.testing.assert_allclose(fast, determined, atol=1e-6)
+
+
+def palette_mixture_colors(n_pixels=20000, seed=0):
+    # pixels mixed from the 5 colors of palette_rgb_11.npy with a little noise, like a recolorable scene
+    rng = np.random.default_rng(seed)
+    palette = np.load(os.path.join(ROOT, 'palette_rgb_11.npy')).astype(np.float64)
+    weights = rng.dirichlet(np.full(len(palette), 0.3), size=n_pixels)
+    return (weights @ palette + rng.normal(0., 0.02, (n_pixels, 3))).clip(0., 1.)
+
+
+def scene_colors(config='lego.txt', n_images=5, stride=4):
+    # training images of a scene from configs/, composited on white like the blender loader
+    datadir = None
+    with open(os.path.join(ROOT, 'configs', config)) as f:
+        for line in f:
+            key, _, value = line.partition('=')
+            if key.strip() == 'datadir':
+                datadir = value.split('#')[0].strip()
+    paths = sorted(glob.glob(os.path.join(datadir or '', 'train', '*.png')))[:n_images]
+    if not paths:
+        pytest.skip(f'no training images for {config} in {datadir}')
+    colors = []
+    for path in paths:
+        img = imageio.imread(path)[::stride, ::stride].astype(np.float64) / 255.
+        if img.shape[-1] == 4:
+            img = img[..., :3] * img[..., 3:] + (1. - img[..., 3:])
+        colors.append(img.reshape(-1, 3))
+    return np.concatenate(colors)
+
+
+@pytest.mark.parametrize('colors', [palette_mixture_colors, scene_colors], ids=['palette_mixture', 'lego'])
+def test_fast_version_matches_determined_version(colors):
+    data = colors()
+    determined = Hull_Simplification_determined_version(data, "", error_thres=ERROR_THRES)
+    fast = Hull_Simplification_fast_version(data, "", error_thres=ERROR_THRES)
+    assert_same_palette(fast, determined)
+
+    # Trainer.build_palette only passes the hull vertices and the streamed color histogram
+    unique_data, pixel_counts, hull_vertices = quantized_color_statistics(data)
+    fast = Hull_Simplification_fast_version(hull_vertices, "", error_thres=ERROR_THRES,
+                                            unique_data=unique_data, pixel_counts=pixel_counts)
+    assert_same_palette(fast, determined)
@@ -0,0 +1,72 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from engine.trainer import ImportanceSampler, SimpleSampler_2
+
+
+def make_sampler(n_rays=1000, block_size=64, batch=4096, floor=0.1, momentum=0.1, resident=False):
+    # rays carry their own index, so the gathered rows show which rays were drawn
+    rays = torch.arange(n_rays, dtype=torch.float32)[:, None].repeat(1, 6)
+    dataset = SimpleNamespace(all_rays=rays, all_rgbs=torch.rand((n_rays, 3)))
+    sampler = SimpleSampler_2(dataset, batch)
+    if resident:
+        sampler.to_device('cpu')
+    return ImportanceSampler(sampler, batch, block_size, floor, momentum)
+
+
+def test_block_probs_floor():
+    sampler = make_sampler()
+    n_blocks = sampler.loss_ema.shape[0]
+    assert n_blocks == 16
+    sampler.loss_ema[:] = 0.
+    sampler.loss_ema[3] = 1.
+    probs = sampler.block_probs()
+    torch.testing.assert_close(probs.sum(), torch.tensor(1.))
+    assert (probs >= sampler.floor / n_blocks - 1e-6).all()
+    torch.testing.assert_close(probs[3], torch.tensor(sampler.floor / n_blocks + 1 - sampler.floor))
+
+
+@pytest.mark.parametrize('resident', [False, True])
+def test_ids_and_weights(resident):
+    torch.manual_seed(0)
+    sampler = make_sampler(resident=resident)
+    assert sampler.sampler.resident == resident
+    sampler.loss_ema[:] = torch.linspace(0.01, 1., sampler.loss_ema.shape[0])
+    probs = sampler.block_probs()
+
+    rays, rgbs = sampler.getbatch('cpu')
+    ids = rays[:, 0].long()
+    blocks = sampler.block_ids
+    # every ray lies in its block, the last block holds the 1000 - 15 * 64 leftover rays
+    assert torch.equal(ids // sampler.block_size, blocks)
+    assert torch.equal(rgbs, sampler.sampler.all_rgbs[ids])
+    block_len = torch.where(blocks == 15, 1000 - 15 * 64, 64).float()
+    # weight = 1 / (N p(ray)), p(ray) = p(block) / rays in the block
+    torch.testing.assert_close(sampler.batch_weight, 1. / (1000 * probs[blocks] / block_len))
+
+
+def test_weighted_mean_is_unbiased(n_draws=50):
+    # the weighted mean of a per ray value over the drawn rays estimates its plain mean over all rays
+    torch.manual_seed(0)
+    sampler = make_sampler()
+    sampler.loss_ema[:] = torch.rand(sampler.loss_ema.shape[0]) ** 4
+    values = torch.rand(1000)
+    estimates = []
+    for _ in range(n_draws):
+        rays, _ = sampler.getbatch('cpu')
+        estimates.append((sampler.batch_weight * values[rays[:, 0].long()]).mean())
+    torch.testing.assert_close(torch.stack(estimates).mean(), values.mean(), rtol=0.03, atol=0.)
+
+
+def test_update_ema():
+    sampler = make_sampler(batch=4, momentum=0.25)
+    sampler.block_ids = torch.tensor([2, 2, 5, 7])
+    sampler.update(torch.tensor([0.2, 0.4, 0.8, 0.1]))
+    # first visit takes the mean error of the block, unvisited blocks stay NaN
+    torch.testing.assert_close(sampler.loss_ema[[2, 5, 7]].float(), torch.tensor([0.3, 0.8, 0.1]), rtol=1e-3, atol=0.)
+    assert torch.isnan(sampler.loss_ema[0])
+    sampler.block_ids = torch.tensor([2])
+    sampler.update(torch.tensor([0.7]))
+    torch.testing.assert_close(sampler.loss_ema[2].float(), torch.tensor(0.75 * 0.3 + 0.25 * 0.7), rtol=1e-3, atol=0.)
@@ -0,0 +1,116 @@
+import json
+import os
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from data.blender import BlenderDataset
+from data.llff import LLFFDataset
+from data.nsvf import NSVF
+from data.tankstemple import TanksTempleDataset
+from data.your_own_data import YourOwnDataset
+from engine.trainer import LazyRaySampler
+
+
+def random_c2w(rng, radius=4.):
+    # camera on a sphere around the origin, random orientation
+    rot, _ = np.linalg.qr(rng.normal(size=(3, 3)))
+    c2w = np.eye(4)
+    c2w[:3, :3] = rot
+    c2w[:3, 3] = rot[:, 2] * -radius
+    return c2w
+
+
+def write_image(path, w, h, rng, alpha=True):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    img = rng.integers(0, 256, size=(h, w, 4 if alpha else 3), dtype=np.uint8)
+    Image.fromarray(img).save(path)
+
+
+def blender_scene(root, rng, n=3):
+    frames = []
+    for i in range(n):
+        write_image(os.path.join(root, 'train', f'r_{i}.png'), 16, 16, rng)
+        frames.append({'file_path': f'./train/r_{i}', 'transform_matrix': random_c2w(rng).tolist()})
+    with open(os.path.join(root, 'transforms_train.json'), 'w') as f:
+        json.dump({'camera_angle_x': 0.69, 'frames': frames}, f)
+    return BlenderDataset, {'downsample': 100.}  # 8 x 8
+
+
+def own_scene(root, rng, n=3):
+    frames = []
+    for i in range(n):
+        write_image(os.path.join(root, 'train', f'r_{i}.png'), 8, 6, rng)
+        frames.append({'file_path': f'./train/r_{i}', 'transform_matrix': random_c2w(rng).tolist()})
+    with open(os.path.join(root, 'transforms_train.json'), 'w') as f:
+        json.dump({'w': 8, 'h': 6, 'camera_angle_x': 0.8, 'camera_angle_y': 0.6, 'cx': 4.2, 'cy': 2.9,
+                   'frames': frames}, f)
+    return YourOwnDataset, {}
+
+
+def nsvf_scene(root, rng, n=3, intrinsics='40. 400. 400. 0.\n'):
+    np.savetxt(os.path.join(root, 'bbox.txt'), [[-1., -1., -1., 1., 1., 1., 0.1]])
+    with open(os.path.join(root, 'intrinsics.txt'), 'w') as f:
+        f.write(intrinsics)
+    os.makedirs(os.path.join(root, 'pose'))
+    for i in range(n):
+        write_image(os.path.join(root, 'rgb', f'0_{i:03d}.png'), 16, 16, rng)
+        np.savetxt(os.path.join(root, 'pose', f'0_{i:03d}.txt'), random_c2w(rng))
+    return NSVF, {'downsample': 100.}  # 8 x 8
+
+
+def tankstemple_scene(root, rng, n=3):
+    np.savetxt(os.path.join(root, 'bbox.txt'), [[-1., -1., -1., 1., 1., 1., 0.1]])
+    np.savetxt(os.path.join(root, 'intrinsics.txt'), [[1100., 0., 960., 0.], [0., 1100., 540., 0.], [0., 0., 1., 0.],
+                                                      [0., 0., 0., 1.]])
+    os.makedirs(os.path.join(root, 'pose'))
+    for i in range(n):
+        write_image(os.path.join(root, 'rgb', f'0_{i:03d}.png'), 32, 18, rng, alpha=False)
+        np.savetxt(os.path.join(root, 'pose', f'0_{i:03d}.txt'), random_c2w(rng))
+    return TanksTempleDataset, {'downsample': 120.}  # 16 x 9
+
+
+def llff_scene(root, rng, n=5, spheric_poses=True):
+    # forward facing cameras, poses_bounds rows are [R | t | (H, W, focal)] (3 x 5) and near, far
+    rows = []
+    for i in range(n):
+        rot, _ = np.linalg.qr(np.eye(3) + 0.05 * rng.normal(size=(3, 3)))
+        rot *= np.sign(np.diag(rot))
+        pose = np.concatenate([rot, rng.normal(scale=0.2, size=(3, 1)), [[32.], [48.], [40.]]], -1)
+        rows.append(np.concatenate([pose.reshape(-1), [2., 6.]]))
+        write_image(os.path.join(root, 'images', f'{i:03d}.png'), 48, 32, rng, alpha=False)
+    np.save(os.path.join(root, 'poses_bounds.npy'), np.stack(rows))
+    return LLFFDataset, {'downsample': 4, 'spheric_poses': spheric_poses}  # 12 x 8
+
+
+SCENES = {
+    'blender': blender_scene,
+    'own_data': own_scene,
+    'nsvf': nsvf_scene,
+    'tankstemple': tankstemple_scene,
+    'llff': llff_scene,
+    'llff_ndc': lambda root, rng: llff_scene(root, rng, spheric_poses=False),
+}
+
+
+@pytest.mark.parametrize('scene', list(SCENES))
+def test_lazy_rays_match_eager_rays(scene, tmp_path):
+    dataset, kwargs = SCENES[scene](os.fspath(tmp_path), np.random.default_rng(0))
+    eager = dataset(os.fspath(tmp_path), split='train', is_stack=False, **kwargs)
+    lazy = dataset(os.fspath(tmp_path), split='train', is_stack=False, lazy_rays=True, **kwargs)
+    assert lazy.all_rays is None and lazy.all_rgbs.dtype == torch.uint8
+
+    sampler = LazyRaySampler(lazy, 64, 'cpu')
+    n_rays = eager.all_rays.shape[0]
+    assert sampler.total == n_rays
+
+    ids = torch.randperm(n_rays, generator=torch.Generator().manual_seed(0))[:256]
+    torch.testing.assert_close(sampler.build_rays(ids), eager.all_rays[ids], rtol=1e-5, atol=1e-5)
+    # rays ids in ascending order (filtering_rays) take the per image path
+    ids = ids.sort().values
+    torch.testing.assert_close(sampler.build_rays(ids, sorted_ids=True), eager.all_rays[ids], rtol=1e-5, atol=1e-5)
+
+    rgbs = lazy.all_rgbs.view(-1, 3)[ids].float() / 255.
+    assert (rgbs - eager.all_rgbs[ids]).abs().max() <= 0.5 / 255 + 1e-6
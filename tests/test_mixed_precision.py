@@ -0,0 +1,64 @@
+import torch
+
+from models.palette_tensoRF import PaletteTensorVM
+from models.tensorBase import raw2alpha, raw2alpha_packed
+
+
+def small_model(n_palette=4, seed=0):
+    torch.manual_seed(seed)
+    aabb = torch.tensor([[-1.5, -1.5, -1.5], [1.5, 1.5, 1.5]])
+    return PaletteTensorVM(aabb, [24, 24, 24], 'cpu', density_n_comp=[4] * 3, appearance_n_comp=[4] * 3, app_dim=27,
+                           shadingMode='PLT_AlphaBlend', pos_pe=2, view_pe=2, fea_pe=2, featureC=16,
+                           near_far=(2., 6.), density_shift=-5, palette=torch.rand(n_palette, 3))
+
+
+def rays_towards_center(n_rays=128, seed=1):
+    g = torch.Generator().manual_seed(seed)
+    rays_o = torch.randn((n_rays, 3), generator=g)
+    rays_o = rays_o / rays_o.norm(dim=-1, keepdim=True) * 4.
+    rays_d = (torch.rand((n_rays, 3), generator=g) * 2 - 1) * 0.5 - rays_o
+    return torch.cat([rays_o, rays_d / rays_d.norm(dim=-1, keepdim=True)], -1)
+
+
+def render_and_grads(tensorf, rays, amp_dtype=None):
+    kwargs = dict(is_train=False, white_bg=True, ndc_ray=False, N_samples=-1, ret_opaque_map=True,
+                  ret_sparsity_norm_map=True)
+    tensorf.zero_grad(set_to_none=True)
+    # as Trainer.train_one_batch: only the render under autocast, the loss in fp32
+    with torch.autocast('cpu', dtype=amp_dtype, enabled=amp_dtype is not None):
+        res = tensorf(rays, **kwargs)
+    loss = res['rgb_map'].square().mean() + res['sparsity_norm_map'].mean()
+    loss.backward()
+    return res, {n: p.grad for n, p in tensorf.named_parameters() if p.grad is not None}
+
+
+def test_bf16_render_matches_fp32():
+    tensorf = small_model()
+    rays = rays_towards_center()
+    ref, ref_grads = render_and_grads(tensorf, rays)
+    res, grads = render_and_grads(tensorf, rays, torch.bfloat16)
+
+    # the render buffers stay fp32, only the matmuls run in bfloat16
+    for k in ('rgb_map', 'opaque_map', 'sparsity_norm_map', 'depth_map'):
+        assert res[k].dtype == torch.float32
+    assert (res['rgb_map'] - ref['rgb_map']).abs().max() < 2e-2
+    assert (res['opaque_map'] - ref['opaque_map']).abs().max() < 2e-2
+
+    assert grads.keys() == ref_grads.keys()
+    for name, grad in grads.items():
+        assert grad.dtype == torch.float32 and torch.isfinite(grad).all(), name
+
+
+def test_transmittance_in_fp32():
+    sigma = torch.rand((8, 64), dtype=torch.bfloat16) * 4
+    dist = torch.full((8, 64), 0.05, dtype=torch.bfloat16)
+    alpha, weights, T = raw2alpha(sigma, dist)
+    assert weights.dtype == torch.float32 and T.dtype == torch.float32
+    ref_alpha, ref_weights, ref_T = raw2alpha(sigma.float(), dist.float())
+    torch.testing.assert_close(weights, ref_weights)
+
+    ray_ids = torch.arange(8).repeat_interleave(64)
+    _, packed_weights, packed_T = raw2alpha_packed(sigma.view(-1), dist.view(-1), ray_ids, 8)
+    assert packed_weights.dtype == torch.float32
+    torch.testing.assert_close(packed_weights.view(8, 64), ref_weights, rtol=1e-4, atol=1e-6)
+    torch.testing.assert_close(packed_T, ref_T.view(-1), rtol=1e-4, atol=1e-6)
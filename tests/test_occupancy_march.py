@@ -0,0 +1,115 @@
+import pytest
+import torch
+
+from models.tensorBase import AlphaGridMask, pack_bits
+
+SHAPE = (17, 19, 23)  # D, H, W nodes, blocks of 8 cells: block faces fall on the nodes 7 and 15
+
+
+def random_mask(density=0.003, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    aabb = torch.tensor([[-1.5, -1.5, -1.5], [1.5, 1.5, 1.5]])
+    bits = torch.rand(SHAPE, generator=g) < density
+    bits[4:7, 9:12, 14:18] = True  # one solid clump next to the block faces
+    return AlphaGridMask.from_packed('cpu', aabb, pack_bits(bits), SHAPE)
+
+
+def node_coord(mask, axis, i):
+    # position of node i along axis (x y z)
+    spacing = mask.aabbSize[axis] / (mask.gridSize[axis] - 1)
+    return mask.aabb[0, axis] + i * spacing
+
+
+def make_rays(mask, n_random=512, seed=1):
+    '''
+    Random rays through the box, plus rays that graze the lattice: axis aligned rays on node planes (cell faces)
+    and on block faces, and diagonal rays through block corners.
+    '''
+    g = torch.Generator().manual_seed(seed)
+    rays_o = torch.randn((n_random, 3), generator=g)
+    rays_o = rays_o / rays_o.norm(dim=-1, keepdim=True) * 4.
+    rays_d = (torch.rand((n_random, 3), generator=g) * 2 - 1) * 1.2 - rays_o
+    origins, dirs = [rays_o], [rays_d]
+
+    for axis in range(3):
+        u, v = [a for a in range(3) if a != axis]
+        for i in (4, 5, 6, 7, 8, 15):
+            for j in (9, 10, 11, 12, 15):
+                o = torch.zeros(3)
+                o[axis] = -4.
+                o[u], o[v] = node_coord(mask, u, i), node_coord(mask, v, j)
+                d = torch.zeros(3)
+                d[axis] = 1.
+                origins.append(o[None])
+                dirs.append(d[None])
+    for i in (7, 8, 15):
+        corner = torch.stack([node_coord(mask, a, i) for a in range(3)])
+        for d in ([1., 1., 1.], [1., -1., 1.], [-1., 1., 1.], [1., 1., 0.]):
+            d = torch.tensor(d)
+            origins.append((corner - 4. * d)[None])
+            dirs.append(d[None])
+    rays_d = torch.cat(dirs)
+    return torch.cat(origins), rays_d / rays_d.norm(dim=-1, keepdim=True)
+
+
+def bbox_span(mask, rays_o, rays_d):
+    vec = torch.where(rays_d == 0, torch.full_like(rays_d, 1e-6), rays_d)
+    rate_a = (mask.aabb[1] - rays_o) / vec
+    rate_b = (mask.aabb[0] - rays_o) / vec
+    return torch.minimum(rate_a, rate_b).amax(-1), torch.maximum(rate_a, rate_b).amin(-1)
+
+
+def dense_occupancy(mask, rays_o, rays_d, t_min, t_max, n_samples=4000):
+    frac = torch.linspace(0, 1, n_samples)
+    t = t_min[:, None] + (t_max - t_min).clamp(min=0)[:, None] * frac
+    xyz = rays_o[:, None] + rays_d[:, None] * t[..., None]
+    return t, mask.occupied(xyz.view(-1, 3)).view(t.shape) & (t_max > t_min)[:, None]
+
+
+def test_segments_cover_dense_occupancy():
+    mask = random_mask()
+    rays_o, rays_d = make_rays(mask)
+    t_min, t_max = bbox_span(mask, rays_o, rays_d)
+    t, occupied = dense_occupancy(mask, rays_o, rays_d, t_min, t_max)
+    assert occupied.any(-1).sum() > 50
+
+    seg_rays, seg_start, seg_end = mask.occupied_segments(rays_o, rays_d, t_min, t_max)
+    assert ((seg_start >= t_min[seg_rays] - 1e-6) & (seg_end <= t_max[seg_rays] + 1e-6)).all()
+    covered = torch.zeros_like(occupied)
+    for r, s, e in zip(seg_rays.tolist(), seg_start.tolist(), seg_end.tolist()):
+        covered[r] |= (t[r] >= s) & (t[r] <= e)
+    missed = torch.nonzero(occupied & ~covered)
+    assert missed.shape[0] == 0, f'{missed.shape[0]} occupied samples outside the segments, rays {missed[:, 0].unique().tolist()}'
+
+
+def test_ray_occupied_matches_dense_occupancy():
+    mask = random_mask(seed=2)
+    rays_o, rays_d = make_rays(mask, seed=3)
+    t_min, t_max = bbox_span(mask, rays_o, rays_d)
+    _, occupied = dense_occupancy(mask, rays_o, rays_d, t_min, t_max)
+    hit = mask.ray_occupied(rays_o, rays_d, t_min, t_max)
+    # every ray with an occupied sample is kept; a kept ray without one may only clip a corner between samples
+    assert not (occupied.any(-1) & ~hit).any()
+    assert (hit & ~occupied.any(-1)).sum() <= 0.02 * hit.sum()
+
+
+@pytest.mark.parametrize('seed', [0, 4])
+def test_sample_ray_occupied_matches_sample_ray(seed):
+    from models.tensoRF import TensorVMSplit
+
+    mask = random_mask(seed=seed)
+    tensorf = TensorVMSplit(mask.aabb.clone(), list(SHAPE[::-1]), 'cpu', density_n_comp=[2] * 3,
+                            appearance_n_comp=[2] * 3, app_dim=3, shadingMode='RGB', pos_pe=2, view_pe=2, fea_pe=2,
+                            featureC=16)
+    tensorf.alphaMask = mask
+    rays_o, rays_d = make_rays(mask, seed=seed + 1)
+
+    xyz, z_vals, valid = tensorf.sample_ray(rays_o, rays_d, is_train=False)
+    valid &= mask.occupied(xyz.view(-1, 3)).view(valid.shape)
+    ref_rays, ref_samples = torch.nonzero(valid, as_tuple=True)
+
+    ray_ids, sample_ids, xyz_packed, z_packed, _ = tensorf.sample_ray_occupied(rays_o, rays_d, is_train=False)
+    assert torch.equal(ray_ids, ref_rays)
+    assert torch.equal(sample_ids, ref_samples)
+    torch.testing.assert_close(z_packed, z_vals[ref_rays, ref_samples])
+    torch.testing.assert_close(xyz_packed, xyz[ref_rays, ref_samples])
@@ -0,0 +1,82 @@
+import pytest
+import torch
+
+from models.tensorBase import raw2alpha
+
+
+def small_model(seed=0):
+    from models.tensoRF import TensorVMSplit
+
+    torch.manual_seed(seed)
+    aabb = torch.tensor([[-1.5, -1.2, -1.], [1.5, 1.2, 1.]])
+    tensorf = TensorVMSplit(aabb, [24, 20, 28], 'cpu', density_n_comp=[4] * 3, appearance_n_comp=[4] * 3, app_dim=3,
+                            shadingMode='RGB', pos_pe=2, view_pe=2, fea_pe=2, featureC=16, density_shift=-3)
+    with torch.no_grad():
+        for p in tensorf.density_plane:
+            p.normal_(0, 1.)
+    tensorf.updateAlphaMask(gridSize=(24, 20, 28))
+    return tensorf
+
+
+def random_rays(n=256, seed=1):
+    g = torch.Generator().manual_seed(seed)
+    rays_o = torch.randn((n, 3), generator=g)
+    rays_o = rays_o / rays_o.norm(dim=-1, keepdim=True) * 4.
+    rays_d = torch.nn.functional.normalize((torch.rand((n, 3), generator=g) * 2 - 1) * 1.5 - rays_o, dim=-1)
+    return torch.cat((rays_o, rays_d), -1)
+
+
+def dense_render(tensorf, rays, white_bg=True):
+    # forward of TensoRF: every sample in the dense (bs, nsample) layout, sigma and app scattered into full tensors
+    rays_o, viewdirs = rays[:, :3], rays[:, 3:6]
+    xyz, z_vals, valid = tensorf.sample_ray(rays_o, viewdirs, is_train=False)
+    dists = torch.cat((z_vals[:, 1:] - z_vals[:, :-1], torch.zeros_like(z_vals[:, :1])), dim=-1)
+    valid = valid & tensorf.alphaMask.occupied(xyz.view(-1, 3)).view(valid.shape)
+
+    sigma = torch.zeros(valid.shape)
+    sigma[valid] = tensorf.feature2density(tensorf.compute_densityfeature(tensorf.normalize_coord(xyz[valid])))
+    _, weight, _ = raw2alpha(sigma, dists * tensorf.distance_scale)
+
+    app_mask = weight > tensorf.rayMarch_weight_thres
+    rgb = torch.zeros((*valid.shape, 3))
+    app_xyz = tensorf.normalize_coord(xyz[app_mask])
+    app_dirs = viewdirs[:, None].expand(xyz.shape)[app_mask]
+    rgb[app_mask] = tensorf.renderModule(app_xyz, app_dirs, tensorf.compute_appfeature(app_xyz), False).float()
+
+    acc_map = weight.sum(-1)
+    rgb_map = (weight[..., None] * rgb).sum(-2)
+    if white_bg:
+        rgb_map = rgb_map + (1. - acc_map[..., None])
+    depth_map = (weight * z_vals).sum(-1) + (1. - acc_map) * rays[..., -1]
+    return {'rgb_map': rgb_map.clamp(0, 1), 'depth_map': depth_map, 'acc_map': acc_map, 'weight': weight}
+
+
+@pytest.mark.parametrize('skip_empty_space', [False, True])
+@torch.no_grad()
+def test_packed_forward_matches_dense_render(skip_empty_space):
+    tensorf = small_model()
+    tensorf.skip_empty_space = skip_empty_space
+    rays = random_rays()
+    ref = dense_render(tensorf, rays)
+    assert (ref['acc_map'] > 0.5).any() and (ref['acc_map'] < 1e-3).any()
+
+    res = tensorf(rays, is_train=False, white_bg=True, ndc_ray=False, N_samples=-1, ret_acc_map=True, ret_weight=True)
+    for k in ('rgb_map', 'depth_map', 'acc_map', 'weight'):
+        torch.testing.assert_close(res[k], ref[k], rtol=1e-4, atol=1e-5)
+
+
+def test_packed_forward_gradients():
+    # the packed render reaches the same parameters with the same gradients as the dense one
+    tensorf = small_model()
+    rays = random_rays(64)
+    res = tensorf(rays, is_train=False, white_bg=True, ndc_ray=False, N_samples=-1)
+    res['rgb_map'].square().sum().backward()
+    grads = {n: p.grad.clone() for n, p in tensorf.named_parameters() if p.grad is not None}
+
+    tensorf.zero_grad(set_to_none=True)
+    ref = dense_render(tensorf, rays)
+    ref['rgb_map'].square().sum().backward()
+    ref_grads = {n: p.grad for n, p in tensorf.named_parameters() if p.grad is not None}
+    assert grads.keys() == ref_grads.keys() and len(grads) > 0
+    for n in grads:
+        torch.testing.assert_close(grads[n], ref_grads[n], rtol=1e-3, atol=1e-5)
@@ -0,0 +1,41 @@
+import pytest
+import torch
+
+from engine.eval import recolor_maps, render_palettes
+from models.palette_tensoRF import PaletteTensorVM
+from utils.render import chunkify_render
+
+
+def small_model(n_palette=4, seed=0):
+    torch.manual_seed(seed)
+    aabb = torch.tensor([[-1.5, -1.5, -1.5], [1.5, 1.5, 1.5]])
+    tensorf = PaletteTensorVM(aabb, [24, 24, 24], 'cpu', density_n_comp=[4] * 3, appearance_n_comp=[4] * 3, app_dim=27,
+                              shadingMode='PLT_AlphaBlend', pos_pe=2, view_pe=2, fea_pe=2, featureC=16,
+                              near_far=(2., 6.), density_shift=-5, palette=torch.rand(n_palette, 3))
+    tensorf.eval()
+    return tensorf
+
+
+def rays_towards_center(n_rays=96, seed=1):
+    g = torch.Generator().manual_seed(seed)
+    rays_o = torch.randn((n_rays, 3), generator=g)
+    rays_o = rays_o / rays_o.norm(dim=-1, keepdim=True) * 4.
+    rays_d = (torch.rand((n_rays, 3), generator=g) * 2 - 1) * 0.5 - rays_o
+    return torch.cat([rays_o, rays_d / rays_d.norm(dim=-1, keepdim=True)], -1)
+
+
+@pytest.mark.parametrize('white_bg', [True, False])
+@torch.no_grad()
+def test_batched_palettes_match_one_render_per_palette(white_bg):
+    tensorf = small_model()
+    rays = rays_towards_center()
+    palettes = torch.rand((3, 4, 3), generator=torch.Generator().manual_seed(2))
+    palettes[0] = tensorf.get_palette_array().detach()
+
+    rgb_maps, res = render_palettes(rays, tensorf, chunkify_render, palettes, chunk=32, white_bg=white_bg, device='cpu')
+    assert rgb_maps.shape == (3, rays.shape[0], 3)
+    for palette, rgb_map in zip(palettes, rgb_maps):
+        ref = tensorf(rays, is_train=False, white_bg=white_bg, palette=palette, ret_color_correction_map=True)
+        # evaluation adds the color correction to the clamped render
+        torch.testing.assert_close(rgb_map, ref['rgb_map'] + ref['color_correction_map'], rtol=1e-5, atol=1e-5)
+    torch.testing.assert_close(recolor_maps(res, palettes[:1], white_bg)[0], rgb_maps[0])
@@ -0,0 +1,68 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+
+from engine.prefetch import BatchPrefetcher, fits_on_device
+from engine.trainer import SimpleSampler_2
+
+
+def make_sampler(n_rays=1000, batch=64):
+    # rays carry their own index, so the gathered rows show which rays were drawn
+    rays = torch.arange(n_rays, dtype=torch.float32)[:, None].repeat(1, 6)
+    return SimpleSampler_2(SimpleNamespace(all_rays=rays, all_rgbs=rays[:, :3] / n_rays), batch)
+
+
+def keep_even(all_rays, all_rgbs, return_mask=True, ray_ids=None):
+    # filtering_rays stand-in, the mask is over ray_ids (the survivors so far)
+    rows = all_rays if ray_ids is None else all_rays[ray_ids]
+    return rows[:, 0].long() % 2 == 0
+
+
+def test_prefetched_batches_match_the_sampler():
+    np.random.seed(0)
+    sampler = make_sampler()
+    ref = [sampler.getbatch('cpu') for _ in range(40)]
+
+    np.random.seed(0)
+    prefetcher = BatchPrefetcher(make_sampler(), 'cpu', n_batches=3)
+    try:
+        # the worker draws ahead, in the order of the sampler
+        for rays, rgbs in ref:
+            got_rays, got_rgbs = prefetcher.getbatch()
+            assert torch.equal(got_rays, rays) and torch.equal(got_rgbs, rgbs)
+    finally:
+        prefetcher.stop()
+    assert not prefetcher.thread.is_alive()
+
+
+def test_filter_drops_queued_batches():
+    prefetcher = BatchPrefetcher(make_sampler(), 'cpu', n_batches=4)
+    try:
+        prefetcher.getbatch()
+        prefetcher.apply_filter(keep_even)
+        assert prefetcher.sampler.total == 500
+        # one epoch of 500 // 64 batches draws every surviving ray at most once
+        ids = torch.cat([prefetcher.getbatch()[0][:, 0].long() for _ in range(500 // 64)])
+        assert (ids % 2 == 0).all()
+        assert ids.unique().numel() == ids.numel() == 500 // 64 * 64
+    finally:
+        prefetcher.stop()
+
+
+def test_worker_errors_reach_getbatch():
+    sampler = make_sampler()
+
+    def gather(ids):
+        raise ValueError('broken sampler')
+
+    sampler.gather = gather
+    prefetcher = BatchPrefetcher(sampler, 'cpu')
+    with pytest.raises(ValueError, match='broken sampler'):
+        prefetcher.getbatch()
+    prefetcher.stop()
+
+
+def test_fits_on_device_needs_cuda():
+    assert not fits_on_device([torch.zeros(10, 6)], 'cpu')
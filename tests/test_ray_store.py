@@ -0,0 +1,50 @@
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+import data.ray_store as ray_store
+from data.ray_store import RayStore, gather_rows, pack_ray_store, ray_store_matches
+
+
+def small_dataset(n=1000, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    return SimpleNamespace(all_rays=torch.randn((n, 6), generator=g), all_rgbs=torch.rand((n, 3), generator=g),
+                           img_wh=(40, 25), white_bg=True, near_far=[2.0, 6.0],
+                           scene_bbox=torch.tensor([[-1.5, -1.5, -1.5], [1.5, 1.5, 1.5]]), poses=np.eye(4)[None, :3])
+
+
+def test_round_trip(tmp_path):
+    dataset = small_dataset()
+    # chunks smaller than the set, the last one partial
+    pack_ray_store(tmp_path, dataset, chunk=300, datadir='scene', downsample=1.0)
+    assert ray_store_matches(tmp_path, datadir='scene', downsample=1.0)
+
+    store = RayStore(tmp_path)
+    assert len(store) == 1000
+    assert isinstance(store.all_rays, np.memmap)
+    assert list(store.img_wh) == [40, 25] and store.white_bg and store.near_far == [2.0, 6.0]
+    assert torch.equal(store.scene_bbox, dataset.scene_bbox)
+    assert torch.equal(torch.from_numpy(np.array(store.all_rays)), dataset.all_rays)
+
+    ids = torch.randperm(1000)[:64]
+    batch = store[ids]
+    assert torch.equal(batch['rays'], dataset.all_rays[ids])
+    assert torch.equal(batch['rgbs'], dataset.all_rgbs[ids])
+    assert torch.equal(gather_rows(store.all_rgbs, slice(10, 20)), dataset.all_rgbs[10:20])
+
+
+def test_invalidation(tmp_path, monkeypatch):
+    dataset = small_dataset()
+    pack_ray_store(tmp_path, dataset, datadir='scene', downsample=1.0)
+
+    assert not ray_store_matches(tmp_path, datadir='scene', downsample=2.0)
+    assert not ray_store_matches(tmp_path, datadir='other', downsample=1.0)
+    # packed without depth, a run with depth supervision has to repack
+    assert not ray_store_matches(tmp_path, with_depth=True, datadir='scene', downsample=1.0)
+    assert not ray_store_matches(tmp_path / 'missing', datadir='scene', downsample=1.0)
+
+    monkeypatch.setattr(ray_store, 'RAY_STORE_VERSION', ray_store.RAY_STORE_VERSION + 1)
+    assert not ray_store_matches(tmp_path, datadir='scene', downsample=1.0)
+    pack_ray_store(tmp_path, dataset, datadir='scene', downsample=1.0)
+    assert ray_store_matches(tmp_path, datadir='scene', downsample=1.0)
@@ -0,0 +1,63 @@
+import torch
+import torch.nn.functional as F
+
+
+def small_model(seed=0):
+    from models.tensoRF import TensorVMSplit
+
+    torch.manual_seed(seed)
+    aabb = torch.tensor([[-1.5, -1.2, -1.], [1.5, 1.2, 1.]])
+    tensorf = TensorVMSplit(aabb, [12, 10, 14], 'cpu', density_n_comp=[4] * 3, appearance_n_comp=[4] * 3, app_dim=3,
+                            shadingMode='RGB', pos_pe=2, view_pe=2, fea_pe=2, featureC=16)
+    with torch.no_grad():
+        for p in list(tensorf.density_plane) + list(tensorf.app_plane):
+            p.normal_(0, 1.)
+    return tensorf
+
+
+def reference_features(tensorf, xyz):
+    # one grid_sample coordinate set per query, as compute_densityfeature / compute_appfeature of TensoRF
+    plane = torch.stack([xyz[..., m] for m in tensorf.matMode]).view(3, -1, 1, 2)
+    line = torch.stack([xyz[..., m] for m in tensorf.vecMode])
+    line = torch.stack((torch.zeros_like(line), line), dim=-1).view(3, -1, 1, 2)
+
+    def sample(grids, coords, i):
+        return F.grid_sample(grids[i], coords[[i]], align_corners=True).view(-1, xyz.shape[0])
+
+    sigma = sum((sample(tensorf.density_plane, plane, i) * sample(tensorf.density_line, line, i)).sum(0)
+                for i in range(3))
+    app = torch.cat([sample(tensorf.app_plane, plane, i) * sample(tensorf.app_line, line, i) for i in range(3)])
+    return sigma, tensorf.basis_mat(app.T)
+
+
+def test_shared_coordinates_match_separate_queries():
+    tensorf = small_model()
+    xyz = torch.rand((500, 3), generator=torch.Generator().manual_seed(1)) * 2 - 1
+    mask = torch.rand(500, generator=torch.Generator().manual_seed(2)) < 0.3
+
+    coords = tensorf.get_coordinates(xyz)
+    sigma = tensorf.compute_densityfeature_from_coords(coords)
+    # appearance only on a subset of the density samples, as in forward
+    app = tensorf.compute_appfeature_from_coords(tensorf.select_coordinates(coords, mask))
+    ref_sigma, ref_app = reference_features(tensorf, xyz)
+    torch.testing.assert_close(sigma, ref_sigma)
+    torch.testing.assert_close(app, ref_app[mask])
+
+    # the gradients reach the planes and lines as with separate queries
+    (sigma.sum() + app.square().sum()).backward()
+    grads = [p.grad.clone() for p in tensorf.parameters() if p.grad is not None]
+    tensorf.zero_grad(set_to_none=True)
+    (ref_sigma.sum() + ref_app[mask].square().sum()).backward()
+    ref_grads = [p.grad for p in tensorf.parameters() if p.grad is not None]
+    assert len(grads) == len(ref_grads) > 0
+    for g, ref in zip(grads, ref_grads):
+        torch.testing.assert_close(g, ref)
+
+
+def test_compute_features():
+    tensorf = small_model()
+    xyz = torch.rand((200, 3), generator=torch.Generator().manual_seed(3)) * 2 - 1
+    sigma, app = tensorf.compute_features(xyz)
+    ref_sigma, ref_app = reference_features(tensorf, xyz)
+    torch.testing.assert_close(sigma, ref_sigma)
+    torch.testing.assert_close(app, ref_app)
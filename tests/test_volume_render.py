@@ -0,0 +1,97 @@
+import pytest
+import torch
+
+from models.volume_render import PackedVolumeRender, volume_render_packed, volume_render_packed_reference
+
+
+def packed_samples(layout, n_rays=64, n_samples=32, seed=0):
+    '''
+    Packed samples sorted by ray, tau = sigma * dist.
+    dense: a random subset of the samples of every ray is valid (alpha mask), some rays have none
+    ndc: every ray keeps all samples of one shared z_vals row, as sample_ray_ndc
+    '''
+    g = torch.Generator().manual_seed(seed)
+    if layout == 'dense':
+        valid = torch.rand((n_rays, n_samples), generator=g) < 0.3
+        valid[::5] = False
+        dists = torch.rand((n_rays, n_samples), generator=g) * 0.1
+    else:
+        valid = torch.ones((n_rays, n_samples), dtype=torch.bool)
+        z_vals = torch.linspace(0., 1., n_samples)
+        dists = torch.cat([z_vals[1:] - z_vals[:-1], torch.zeros(1)])[None].expand(n_rays, -1)
+    ray_ids = torch.nonzero(valid)[:, 0]
+    sigma = torch.rand((n_rays, n_samples), generator=g) * 20.
+    return (sigma * dists)[valid], ray_ids, n_rays
+
+
+@pytest.mark.parametrize('layout', ['dense', 'ndc'])
+def test_gradcheck(layout):
+    tau, ray_ids, n_rays = packed_samples(layout, n_rays=6, n_samples=8)
+    tau = tau.double().requires_grad_()
+    values = torch.rand((tau.shape[0], 4), dtype=torch.float64, requires_grad=True)
+    tau_grad = torch.ones(4, dtype=torch.bool)
+    assert torch.autograd.gradcheck(lambda t, v: PackedVolumeRender.apply(t, v, ray_ids, n_rays, tau_grad)[0],
+                                    (tau, values))
+
+
+@pytest.mark.parametrize('layout', ['dense', 'ndc'])
+def test_matches_reference(layout, channels=20):
+    tau, ray_ids, n_rays = packed_samples(layout)
+    values = torch.rand((tau.shape[0], channels), generator=torch.Generator().manual_seed(1))
+    # the channels without tau gradient have detached weights, as in the render buffer layout
+    tau_grad = torch.arange(channels) % 3 != 0
+    scale = torch.linspace(0, 1, channels)
+
+    results = []
+    for fn in (volume_render_packed_reference, volume_render_packed):
+        t, v = tau.clone().requires_grad_(), values.clone().requires_grad_()
+        maps, weights = fn(t, v, ray_ids, n_rays, tau_grad)
+        (maps * scale).sum().backward()
+        results.append((maps.detach(), weights, t.grad, v.grad))
+    for ref, fused in zip(*results):
+        torch.testing.assert_close(fused, ref, rtol=1e-4, atol=1e-5)
+
+
+def test_empty():
+    tau = torch.zeros(0, requires_grad=True)
+    values = torch.zeros((0, 3), requires_grad=True)
+    maps, weights = volume_render_packed(tau, values, torch.zeros(0, dtype=torch.long), 5)
+    maps.sum().backward()
+    assert maps.shape == (5, 3) and not maps.any() and weights.shape == (0,)
+    assert tau.grad.shape == (0,) and values.grad.shape == (0, 3)
+
+
+def test_packed_ndc_render(n_rays=256):
+    # packed rendering of NDC rays in the model (one z_vals row shared by all rays)
+    from models.palette_tensoRF import PaletteTensorVM
+
+    torch.manual_seed(0)
+    device = 'cpu'
+    aabb = torch.tensor([[-1.5, -1.67, -1.], [1.5, 1.67, 1.]])
+    tensorf = PaletteTensorVM(aabb, [32, 32, 32], device, density_n_comp=[4] * 3, appearance_n_comp=[4] * 3, app_dim=27,
+                              shadingMode='PLT_AlphaBlend', pos_pe=2, view_pe=2, fea_pe=2, featureC=16, near_far=(0., 1.),
+                              density_shift=-5, palette=torch.rand(4, 3))
+    with torch.no_grad():
+        for p in tensorf.density_plane:
+            p.normal_(0, 1.)
+    rays_o = torch.cat([torch.rand((n_rays, 2)) * 2 - 1, -torch.ones((n_rays, 1))], -1)
+    rays_d = torch.cat([torch.randn((n_rays, 2)) * 0.1, 2 * torch.ones((n_rays, 1))], -1)
+    rays = torch.cat([rays_o, rays_d], -1)
+
+    res = tensorf(rays, is_train=True, ndc_ray=True, white_bg=True, ret_weight=True, ret_acc_map=True)
+    res['rgb_map'].sum().backward()
+    assert torch.isfinite(tensorf.density_plane[0].grad).all()
+
+    with torch.no_grad():
+        res = tensorf(rays, is_train=False, ndc_ray=True, white_bg=True, ret_weight=True, ret_acc_map=True)
+        # without jitter the samples sit on linspace(near, far), depth = sum(weight * z) + (1 - acc) * rays[-1]
+        z_vals = torch.linspace(0., 1., res['weight'].shape[-1])
+        depth = (res['weight'] * z_vals).sum(-1) + (1. - res['acc_map']) * rays[:, -1]
+        torch.testing.assert_close(res['depth_map'], depth, rtol=1e-4, atol=1e-5)
+
+        # early ray termination marches the same shared z_vals segment by segment
+        tensorf.ray_term_thres = 1e-6
+        term = tensorf(rays, is_train=False, ndc_ray=True, white_bg=True, ret_acc_map=True)
+        tensorf.ray_term_thres = 0.
+    torch.testing.assert_close(term['rgb_map'], res['rgb_map'], rtol=1e-4, atol=1e-4)
+    torch.testing.assert_close(term['depth_map'], res['depth_map'], rtol=1e-4, atol=1e-4)
@@ -1,6 +1,8 @@
 import numpy as np
+import torch
 from einops import rearrange
 from matplotlib.colors import rgb2hex as mpl_rgb2hex
+from scipy.spatial import ConvexHull, QhullError
 
 
 def sort_palette(rgbs, palette_rgb):
@@ -17,6 +19,62 @@ def sort_palette(rgbs, palette_rgb):
     return np.array(palette_rgb)
 
 
+def sort_palette_counts(colors, counts, palette_rgb):
+    # sort_palette on a color histogram: each bin votes for its nearest palette color with its pixel count
+    dist = rearrange(colors, 'N C -> N 1 C') - rearrange(palette_rgb, 'P C -> 1 P C')
+    nearest = np.argmin(np.linalg.norm(dist, axis=-1), axis=-1)
+    order = np.argsort(np.bincount(nearest, weights=counts, minlength=len(palette_rgb)), kind='stable')
+    return np.asarray(palette_rgb)[order]
+
+
+QUANT_LEVELS = 32  # use_quantitized_colors binning of Hull_Simplification_determined_version: uint8 // 8
+
+
+def quantized_color_statistics(rgbs, white_bg=False, chunk=1 << 20):
+    '''
+    Streams over the training colors once (torch tensor, uint8 images or numpy memmap, any leading shape),
+    memory depends on the number of bins, not on the number of pixels.
+    Returns
+        colors (B, 3): centers of the non-empty bins, ((q * 8) + 4) / 255
+        counts (B,):   pixels per bin
+        hull_vertices (V, 3): exact convex hull vertices of all (foreground) colors
+    '''
+    is_uint8 = rgbs.dtype in (torch.uint8, np.uint8)
+    rgbs = rgbs.reshape(-1, 3)
+    hist = np.zeros(QUANT_LEVELS ** 3, dtype=np.int64)
+    candidates = np.zeros((0, 3))
+    for start in range(0, rgbs.shape[0], chunk):
+        rows = rgbs[start:start + chunk]
+        rows = rows.cpu().numpy() if torch.is_tensor(rows) else np.asarray(rows)
+        rows = rows.astype(np.float64) / 255. if is_uint8 else rows.astype(np.float64)
+        if white_bg:
+            rows = rows[(rows < 1.).any(axis=-1)]  # 把白色像素剔除
+        if rows.shape[0] == 0:
+            continue
+
+        q = (rows * 255).round().astype(np.uint8) // 8
+        hist += np.bincount((q[:, 0].astype(np.int64) * QUANT_LEVELS + q[:, 1]) * QUANT_LEVELS + q[:, 2],
+                            minlength=QUANT_LEVELS ** 3)
+        # the hull of all colors is the hull of the per chunk hull vertices
+        candidates = np.concatenate([candidates, _hull_points(rows)])
+        if candidates.shape[0] > chunk:
+            candidates = _hull_points(candidates)
+
+    bins = np.nonzero(hist)[0]
+    q = np.stack([bins // QUANT_LEVELS ** 2, bins // QUANT_LEVELS % QUANT_LEVELS, bins % QUANT_LEVELS], -1)
+    colors = (q * 8 + 4) / 255.0
+    return colors, hist[bins], _hull_points(candidates)
+
+
+def _hull_points(points):
+    try:
+        hull = ConvexHull(points)
+    except QhullError:
+        # flat or too few points, keep them all
+        return np.unique(points, axis=0)
+    return hull.points[hull.vertices]
+
+
 def hex2rgb(hex):
     if hex.startswith('#'):
         hex = hex[1:]
@@ -18,16 +18,42 @@ def config_parser():
     parser.add_argument("--render_train", type=int, default=0)
     parser.add_argument("--render_path", type=int, default=0)
     parser.add_argument("--export_mesh", type=int, default=0)
+    parser.add_argument("--export_baked", type=int, default=0, help='bake --ckpt into a sparse palette voxel grid')
+    parser.add_argument("--render_baked", type=int, default=0,
+                        help='render_only / render_color.py: render with the grid baked from --ckpt (<ckpt>_baked.th) instead of the model')
+    parser.add_argument("--decomp_cache", type=int, default=1,
+                        help='render_color.py: keep the palette decomposition of every camera in <run_dir>/decomp_cache '
+                             'and only recolor on later edits; 0 renders every camera again')
 
     # dataset options
     parser.add_argument("--datadir", type=str, required=True, help='input data directory')
     parser.add_argument('--downsample_train', type=float, default=1.0)
     parser.add_argument('--downsample_test', type=float, default=1.0)
     parser.add_argument('--dataset_name', type=str, default='blender', choices=dataset_dict.keys())
+    parser.add_argument('--ray_store', type=str, default='',
+                        help='directory of the packed training rays; packed on first use and memory-mapped afterwards')
+    parser.add_argument('--lazy_rays', type=int, default=0,
+                        help='keep uint8 training images only and generate the rays of each batch on the fly')
 
     # training options
     parser.add_argument("--batch_size", type=int, default=4096)
     parser.add_argument("--n_iters", type=int, default=30000)
+    parser.add_argument('--prefetch_batches', type=int, default=0,
+                        help='gather and upload this many batches ahead in a background thread, 0 disables')
+    parser.add_argument('--importance_block', type=int, default=0,
+                        help='sample training rays in proportion to a running loss estimate per block of this many '
+                             'consecutive rays, with unbiasing weights; 0 samples uniformly')
+    parser.add_argument('--importance_floor', type=float, default=0.1,
+                        help='share of the batch drawn uniformly over the blocks when importance sampling')
+    parser.add_argument('--importance_momentum', type=float, default=0.1,
+                        help='weight of the newest batch in the running loss estimate of a block when importance sampling')
+    parser.add_argument('--resident_rays_budget', type=float, default=0,
+                        help='keep the filtered training rays on the device and shuffle them there when they take less '
+                             'than this fraction of the free device memory, otherwise sample on the host; 0 disables')
+    parser.add_argument('--dist_backend', type=str, default='',
+                        help='process group backend when launched with torchrun, nccl on GPU and gloo on CPU by default')
+    parser.add_argument('--amp', type=str, default='', choices=['', 'fp16', 'bf16'],
+                        help='mixed precision training: autocast to float16 (with gradient scaling) or bfloat16, empty for fp32')
     # learning rate
     parser.add_argument("--lr_init", type=float, default=0.02, help='learning rate')
     parser.add_argument("--lr_basis", type=float, default=1e-3, help='learning rate')
@@ -86,6 +112,19 @@ def config_parser():
     parser.add_argument('--ndc_ray', type=int, default=0)
     parser.add_argument('--nSamples', type=int, default=int(1e6), help='sample point each ray, pass 1e6 if automatic adjust')
     parser.add_argument('--step_ratio', type=float, default=0.5)
+    parser.add_argument('--skip_empty_space', type=int, default=0,
+                        help='march the alpha mask occupancy grid and generate only the samples in occupied space, '
+                             'instead of sampling the whole bbox and masking (training and rendering, not with ndc_ray)')
+    parser.add_argument('--ray_term_thres', type=float, default=0.,
+                        help='inference only: stop marching a ray once its transmittance drops below this value, 0 disables')
+    parser.add_argument('--ray_term_segment', type=int, default=32,
+                        help='number of samples evaluated per ray between two early termination checks')
+    parser.add_argument('--half_inference', type=int, default=0,
+                        help='render with float16 feature grids and MLPs, the psnr against fp32 is reported on N_vis test views')
+    parser.add_argument('--render_mem_budget', type=float, default=0.,
+                        help='GB of memory one render chunk may use, the chunk size adapts to the measured peak memory; 0 keeps the fixed chunk sizes')
+    parser.add_argument('--render_to_host', type=int, default=0,
+                        help='gather rendered images in pinned host memory chunk by chunk instead of on the device (eval only)')
     ## blender flags
     parser.add_argument("--white_bkgd", action='store_true', help='set to render synthetic data on a white bkgd (always use for dvoxels)')
 
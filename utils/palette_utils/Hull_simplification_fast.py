@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+'''
+Vectorized rewrite of Hull_Simplification_determined_version (Additive_mixing_layers_extraction.py).
+Same progressive hull algorithm ("Progressive Hulls for Intersection Applications"), but
+    - no OBJ strings / TriMesh rebuild per loop, the hull is kept as vertex ids into one growing point array
+    - the LP result of an edge collapse only depends on the faces around the edge, it is cached and only
+      the edges whose neighbourhood changed are solved again
+    - the outside hull distance is computed for all points and faces at once in numpy
+'''
+from __future__ import print_function, division
+
+import numpy as np
+import cvxopt
+from scipy.spatial import ConvexHull, Delaunay
+
+
+def closest_point_on_triangles(p, tri):
+    '''
+    Batched closest point on triangles (Ericson, Real-Time Collision Detection 5.1.5), numpy version of
+    models.loss.closest_point_on_triangles. p: (..., 3), tri: (..., 3, 3) broadcastable, returns (..., 3)
+    '''
+    a, b, c = tri[..., 0, :], tri[..., 1, :], tri[..., 2, :]
+    ab, ac = b - a, c - a
+    ap, bp, cp = p - a, p - b, p - c
+    d1, d2 = (ab * ap).sum(-1), (ac * ap).sum(-1)
+    d3, d4 = (ab * bp).sum(-1), (ac * bp).sum(-1)
+    d5, d6 = (ab * cp).sum(-1), (ac * cp).sum(-1)
+    va, vb, vc = d3 * d6 - d5 * d4, d5 * d2 - d1 * d6, d1 * d4 - d3 * d2
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        denom = va + vb + vc
+        closest = a + ab * (vb / denom)[..., None] + ac * (vc / denom)[..., None]
+        w = (d4 - d3) / ((d4 - d3) + (d5 - d6))
+        closest = np.where(((va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0))[..., None], b + (c - b) * w[..., None], closest)
+        closest = np.where(((vb <= 0) & (d2 >= 0) & (d6 <= 0))[..., None], a + ac * (d2 / (d2 - d6))[..., None], closest)
+        closest = np.where(((d6 >= 0) & (d5 <= d6))[..., None], c, closest)
+        closest = np.where(((vc <= 0) & (d1 >= 0) & (d3 <= 0))[..., None], a + ab * (d1 / (d1 - d3))[..., None], closest)
+        closest = np.where(((d3 >= 0) & (d4 <= d3))[..., None], b, closest)
+        closest = np.where(((d1 <= 0) & (d2 <= 0))[..., None], a, closest)
+    return closest
+
+
+def outsidehull_points_distance_batched(hull_vertices, points, counts, chunk=65536):
+    '''Same value as outsidehull_points_distance_unique_data_version, without the per point / per face loops'''
+    hull = ConvexHull(hull_vertices)
+    de = Delaunay(hull_vertices)
+    outside = de.find_simplex(points, tol=1e-8) < 0
+    faces = hull.points[hull.simplices]  # F,3,3
+
+    out_points, out_counts = points[outside], counts[outside]
+    total = 0.
+    for start in range(0, out_points.shape[0], chunk):
+        p = out_points[start:start + chunk, None]  # M,1,3
+        dist2 = ((closest_point_on_triangles(p, faces[None]) - p) ** 2).sum(-1).min(-1)
+        total += (dist2 * out_counts[start:start + chunk]).sum()
+    return (total / counts.sum()) ** 0.5
+
+
+def hull_faces(points, ids):
+    '''
+    Convex hull of points[ids], returns
+        vertex ids (V,), faces as ids (F,3), outward unit normals (F,3), doubled face areas (F,)
+    '''
+    hull = ConvexHull(points[ids])
+    faces = ids[hull.simplices]
+    tri = points[faces]
+    normals = hull.equations[:, :3]
+    area2 = np.linalg.norm(np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0]), axis=-1)
+    return ids[hull.vertices], faces, normals, area2
+
+
+def solve_edge_collapse(points, faces, normals, area2):
+    '''
+    LP of remove_one_edge_by_finding_smallest_adding_volume_with_test_conditions for one edge:
+    the new vertex lies outside of every face touching the edge and minimizes the summed distance to them.
+    Returns (added volume, new point) or None when the LP is not optimal.
+    '''
+    p0 = points[faces[:, 0]]
+    A = -normals
+    b = -(normals * p0).sum(-1)
+    c = normals.sum(0)
+    res = cvxopt.solvers.lp(cvxopt.matrix(c), cvxopt.matrix(A), cvxopt.matrix(b), solver='glpk')
+    if res['status'] != 'optimal':
+        return None
+    newpoint = np.asarray(res['x'], dtype=np.float64).squeeze()
+    # sum of the tetrahedron volumes |cross . (x - p0)| / 6
+    volume = (np.abs((normals * (newpoint - p0)).sum(-1)) * area2).sum() / 6.
+    return volume, newpoint
+
+
+def collapse_min_edge(points, ids, faces, normals, area2, cache):
+    '''
+    One step of the progressive hull. cache maps an edge and the faces around it to its LP result,
+    so only the edges next to the last collapse are solved.
+    Returns (new points, new vertex ids), the same ids if every LP failed.
+    '''
+    face_keys = [tuple(sorted(f)) for f in faces.tolist()]
+    vertex_faces = {}
+    for fi, f in enumerate(faces.tolist()):
+        for v in f:
+            vertex_faces.setdefault(v, []).append(fi)
+    edges = sorted({(min(f[i], f[(i + 1) % 3]), max(f[i], f[(i + 1) % 3])) for f in faces.tolist() for i in range(3)})
+
+    best = None
+    for v1, v2 in edges:
+        related = sorted(set(vertex_faces[v1]) | set(vertex_faces[v2]))
+        key = (v1, v2, tuple(face_keys[fi] for fi in related))
+        if key not in cache:
+            cache[key] = solve_edge_collapse(points, faces[related], normals[related], area2[related])
+        if cache[key] is not None and (best is None or cache[key][0] < best[0]):
+            best = (cache[key][0], v1, v2, related)
+
+    if best is None:
+        return points, ids
+    volume, v1, v2, related = best
+    newpoint = cache[(v1, v2, tuple(face_keys[fi] for fi in related))][1]
+
+    # TriMesh.remove_vertex_indices also drops the vertices left without faces
+    removed = {v1, v2}
+    alive = set(range(len(faces))) - set(related)
+    for v in ids.tolist():
+        if v not in removed and not any(fi in alive for fi in vertex_faces.get(v, [])):
+            removed.add(v)
+
+    points = np.vstack((points, newpoint[None]))
+    ids = np.array([v for v in ids.tolist() if v not in removed] + [len(points) - 1])
+    return points, ids
+
+
+### assume data is in range(0,1)
+def Hull_Simplification_fast_version(data, output_prefix="", num_thres=0.1, error_thres=10.0/255.0, option="use_quantitized_colors", slient=True, unique_data=None, pixel_counts=None):
+    '''
+    Drop-in replacement of Hull_Simplification_determined_version ("use_quantitized_colors" / "unique_pixel_colors").
+    unique_data, pixel_counts: precomputed colors and counts for the reconstruction error (utils.color.quantized_color_statistics),
+    data is then only used for its convex hull and can be just the hull vertices.
+    '''
+    cvxopt.solvers.options['show_progress'] = False
+    cvxopt.solvers.options['glpk'] = dict(msg_lev='GLP_MSG_OFF')
+
+    data = data.reshape((-1, 3))
+    hull = ConvexHull(data)
+    points = hull.points[hull.vertices].astype(np.float64)
+    ids = np.arange(len(points))
+    if not slient:
+        print("original hull vertices number: ", len(ids))
+
+    if unique_data is not None:
+        pass
+    elif option == "unique_pixel_colors":
+        unique_data, pixel_counts = np.unique(data, axis=0, return_counts=True)
+    elif option == "use_quantitized_colors":
+        new_data = (((data * 255).round().astype(np.uint8) // 8) * 8 + 4) / 255.0
+        unique_data, pixel_counts = np.unique(new_data, axis=0, return_counts=True)
+    else:
+        raise ValueError(f'[Hull_Simplification_fast_version] unsupported option {option}')
+    if not slient:
+        print(len(unique_data))
+
+    cache = {}
+    ids, faces, normals, area2 = hull_faces(points, ids)
+    max_loop = 5000
+    for i in range(max_loop):
+        if not slient and i % 10 == 0:
+            print("loop: ", i)
+        old_ids = ids
+        points, new_ids = collapse_min_edge(points, ids, faces, normals, area2, cache)
+        ids, faces, normals, area2 = hull_faces(points, new_ids)
+
+        if len(ids) <= 10:
+            reconstruction_errors = outsidehull_points_distance_batched(points[ids].clip(0.0, 1.0), unique_data, pixel_counts)
+            if reconstruction_errors > error_thres:
+                return points[old_ids].clip(0.0, 1.0)
+
+        if len(ids) == len(old_ids) or len(ids) == 4:
+            return points[ids].clip(0.0, 1.0)
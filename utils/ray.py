@@ -85,6 +85,50 @@ def get_rays(directions, c2w):
     return rays_o, rays_d
 
 
+def get_rays_batched(directions, c2ws, img_ids, pix_ids):
+    """
+    Get rays for arbitrary pixels of arbitrary images, the batched counterpart of get_rays.
+    Inputs:
+        directions: (H*W, 3) precomputed ray directions in camera coordinate
+        c2ws: (N_images, 3 or 4, 4) transformation matrices from camera coordinate to world coordinate
+        img_ids, pix_ids: (N_rays,) image index and flattened pixel index of every ray
+    Outputs:
+        rays_o: (N_rays, 3), the origin of the rays in world coordinate
+        rays_d: (N_rays, 3), the direction of the rays in world coordinate
+    """
+    c2w = c2ws[img_ids]  # (N_rays, 3 or 4, 4)
+    rays_d = torch.sum(directions[pix_ids].unsqueeze(1) * c2w[:, :3, :3], -1)  # (N_rays, 3)
+    rays_o = c2w[:, :3, 3]
+    return rays_o, rays_d
+
+
+def get_rays_by_image(directions, c2ws, img_ids, pix_ids):
+    """
+    get_rays_batched for rays sorted by image (e.g. runs of consecutive ray ids): get_rays with the c2w of every image
+    on the directions of its rays, the poses are never gathered per ray.
+    Inputs / Outputs: as get_rays_batched, img_ids sorted
+    """
+    imgs, counts = torch.unique_consecutive(img_ids, return_counts=True)
+    rays_o, rays_d = [], []
+    for img, pix in zip(imgs.tolist(), torch.split(pix_ids, counts.tolist())):
+        o, d = get_rays(directions[pix], c2ws[img])
+        rays_o.append(o)
+        rays_d.append(d)
+    return torch.cat(rays_o), torch.cat(rays_d)
+
+
+def lazy_rgbs(img):
+    """
+    Colors of one training image as the loaders keep them with lazy_rays: the rays are rebuilt per batch from
+    (image, pixel) ids with get_rays_batched / get_rays_by_image, so only uint8 colors stay in memory.
+    Inputs:
+        img: (H*W, 3) float colors in [0, 1]
+    Outputs:
+        (H*W, 3) uint8
+    """
+    return (img * 255).round().to(torch.uint8)
+
+
 #光线采样
 def ndc_rays_blender(H, W, focal, near, rays_o, rays_d):
     # Shift ray origins to near plane
@@ -21,47 +21,197 @@ def cal_n_samples(reso, step_ratio=0.5):
 ###渲染位置
 
 
-def chunkify_render(rays, tensorf, chunk=4096, N_samples=-1, ndc_ray=False, white_bg=True, is_train=False, device='cuda', **kwargs):
-    # rend_maps, alphas, depth_maps, weights, render_bufs = [], [], [], [], []
-    ret = {}
+# torch.cuda.OutOfMemoryError exists from torch 1.13 on, older versions raise a plain RuntimeError with the message
+OutOfMemoryError = getattr(torch.cuda, 'OutOfMemoryError', RuntimeError)
+
+
+def is_out_of_memory(e):
+    if OutOfMemoryError is RuntimeError:
+        return 'out of memory' in str(e)
+    return isinstance(e, OutOfMemoryError)
+
+
+def estimate_bytes_per_ray(tensorf, N_samples=-1):
+    # rough working set of one ray (samples x per sample channels, float32, with the intermediate copies), used where
+    # the peak memory cannot be measured
+    n_samples = N_samples if N_samples > 0 else getattr(tensorf, 'nSamples', 1024)
+    channels = getattr(tensorf, 'app_dim', 27) + sum(getattr(tensorf, 'app_n_comp', [])) + 16
+    channels += sum(p.len for p in getattr(tensorf, 'render_buf_layout', []))
+    return n_samples * channels * 4 * 4
+
+
+class ChunkSizer:
+    '''
+    Chunk size of chunkify_render under a memory budget (bytes).
+    On CUDA the bytes per ray are measured from the peak allocation of every chunk and the next chunk fills the budget
+    (capped by the free device memory) with them; on CPU they are estimated from the model once
+    (estimate_bytes_per_ray) and the chunk is sized from the estimate, smaller or larger than the one asked for.
+    An out of memory halves the chunk, the halved size stays the upper bound of this sizer.
+    '''
+    def __init__(self, budget, bytes_per_ray=None, min_chunk=256, max_chunk=1 << 20, safety=0.8):
+        self.budget = budget
+        self.bytes_per_ray = bytes_per_ray
+        self.min_chunk = min_chunk
+        self.max_chunk = max_chunk
+        self.safety = safety
+        self._base = 0
+
+    def size(self, chunk, device):
+        if self.bytes_per_ray is None:
+            return max(min(chunk, self.max_chunk), self.min_chunk)
+        budget = self.budget
+        if device.type == 'cuda':
+            free, _ = torch.cuda.mem_get_info(device)
+            cached = torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+            budget = min(budget, free + cached)
+        size = int(budget * self.safety / self.bytes_per_ray) // self.min_chunk * self.min_chunk
+        return max(min(size, self.max_chunk), self.min_chunk)
+
+    def begin(self, device):
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+            self._base = torch.cuda.memory_allocated(device)
+
+    def observe(self, size, device):
+        if device.type != 'cuda' or size == 0:
+            return
+        per_ray = (torch.cuda.max_memory_allocated(device) - self._base) / size
+        # follow increases at once, decreases slowly (ray cost depends on how much of the scene a chunk crosses)
+        if self.bytes_per_ray is None or per_ray > self.bytes_per_ray:
+            self.bytes_per_ray = per_ray
+        else:
+            self.bytes_per_ray = 0.8 * self.bytes_per_ray + 0.2 * per_ray
+
+    def out_of_memory(self, size):
+        if size <= self.min_chunk:
+            return False
+        self.max_chunk = max(size // 2, self.min_chunk)
+        return True
+
+
+def make_chunk_sizer(tensorf, mem_budget, device, N_samples=-1):
+    # on CUDA the bytes per ray are measured from the first chunk, elsewhere estimated from the model
+    bytes_per_ray = None if device.type == 'cuda' else estimate_bytes_per_ray(tensorf, N_samples)
+    return ChunkSizer(mem_budget * 2 ** 30, bytes_per_ray)
+
+
+def render_out_shapes(tensorf, N_samples=-1, **kwargs):
+    '''
+    Trailing shape of every output map of tensorf.forward for the given ret_* flags: the rgb map and the requested
+    buffers of render_buf_layout, depth_map, and acc_map / weight / raw_render_buf when asked for.
+    '''
+    shapes = {f'{p.name}_map': (p.len,) for p in tensorf.render_buf_layout
+              if p.name == 'rgb' or kwargs.get(f'ret_{p.name}_map', False)}
+    shapes['depth_map'] = ()
+    if kwargs.get('ret_acc_map', False):
+        shapes['acc_map'] = ()
+    n_samples = N_samples if N_samples > 0 else tensorf.nSamples
+    if kwargs.get('ret_weight', False):
+        shapes['weight'] = (n_samples,)
+    if kwargs.get('ret_raw_render_buf', False):
+        shapes['raw_render_buf'] = (n_samples, tensorf.n_dim)
+    return shapes
+
+
+class ChunkOutputs:
+    '''
+    Output maps of chunkify_render. Without grad every map of shapes (render_out_shapes) is allocated once for all
+    rays when the first chunk is written, whatever that chunk returns, and each chunk is written in place; a map the
+    model returns outside of shapes is allocated from the first chunk that returns it. With grad (shapes=None) the
+    maps are kept per chunk and concatenated, so the autograd history of every chunk stays attached.
+    With out_device='cpu' and a CUDA render the maps live in pinned host memory and the chunks are copied without
+    blocking, the device only holds the chunk being rendered.
+    '''
+    def __init__(self, n_rays, shapes=None, out_device=None, render_device=None):
+        self.n_rays = n_rays
+        self.render_device = None if render_device is None else torch.device(render_device)
+        self.out_device = None if out_device is None else torch.device(out_device)
+        self.pinned = self.out_device is not None and self.out_device.type == 'cpu' and \
+            self.render_device is not None and self.render_device.type == 'cuda'
+        self.shapes = shapes
+        self.maps = None
+        self.written = set()
+        self.parts = {}
+
+    def _alloc(self, shape, dtype, device):
+        device = device if self.out_device is None else self.out_device
+        # pinned at allocation, pin_memory() afterwards would copy the map once more
+        return torch.zeros((self.n_rays,) + tuple(shape), dtype=dtype, device=device, pin_memory=self.pinned)
+
+    def write(self, start, res_dict):
+        if self.maps is None:
+            shapes = self.shapes or {}
+            self.maps = {k: self._alloc(shape, torch.float32, self.render_device) for k, shape in shapes.items()}
+        for k, v in res_dict.items():
+            if self.shapes is None:
+                self.parts.setdefault(k, []).append(v)
+                continue
+            if k not in self.maps:
+                self.maps[k] = self._alloc(v.shape[1:], v.dtype, v.device)
+            self.maps[k][start:start + v.shape[0]].copy_(v, non_blocking=self.pinned)
+            self.written.add(k)
+
+    def result(self):
+        if self.pinned:
+            torch.cuda.synchronize()
+        # a flag the model does not answer (e.g. ret_weight of the baked grid) leaves its map unwritten
+        ret = {k: v for k, v in (self.maps or {}).items() if k in self.written}
+        for k, parts in self.parts.items():
+            ret[k] = torch.cat(parts)
+        return ret
+
+
+def chunkify_render(rays, tensorf, chunk=4096, N_samples=-1, ndc_ray=False, white_bg=True, is_train=False, device='cuda',
+                    mem_budget=0, out_device=None, sizer=None, **kwargs):
+    '''
+    mem_budget: GB one chunk may use, > 0 lets the chunk size adapt to it (chunk is then only the first size tried),
+    0 keeps chunk fixed. In both cases a chunk that runs out of device memory is halved and rendered again.
+    sizer: ChunkSizer to reuse across calls of the same render configuration (e.g. the frames of one evaluation),
+    by default every call with mem_budget > 0 sizes its chunks with a new one.
+    out_device: where the output maps are gathered, the render device by default; only used without grad.
+    '''
     N_rays_all = rays.shape[0]  #光线数量
-    for chunk_idx in range(N_rays_all // chunk + int(N_rays_all % chunk > 0)):  #批量渲染
-        rays_chunk = rays[chunk_idx * chunk:(chunk_idx + 1) * chunk].to(device)
-
-        res_dict = tensorf(rays_chunk, is_train=is_train, white_bg=white_bg, ndc_ray=ndc_ray, N_samples=N_samples, **kwargs)
-        # loss = tensorf.loss
-        for k in res_dict:
-            if not k in ret:
-                ret[k] = []
-            ret[k].append(res_dict[k]) #res_dict['rgb_map']  res_dict['depth_map'] 存放rgb图或深度图等
-        # rend_maps.append(rend_map)
-        # depth_maps.append(depth_map)
-        # if 'acc_map' in extras:
-        #     alphas.append(extras['acc_map'])
-        # if 'weight' in extras:
-        #     weights.append(extras['weight'])
-        # if 'render_buf' in extras:
-        #     render_bufs.append(extras['render_buf'])
-
-    # rend_maps = torch.cat(rend_maps)
-    # depth_maps = torch.cat(depth_maps)
-
-    for k in ret:
-        ret[k] = torch.cat(ret[k])
-
-    # if len(alphas) > 0:
-    #     alphas = torch.cat(alphas)
-    # else:
-    #     alphas = None
-
-    # if len(weights) > 0:
-    #     weights = torch.cat(weights)
-    # else:
-    #     weights = None
-
-    # if len(render_bufs) > 0:
-    #     render_bufs = torch.cat(render_bufs)
-    # else:
-    #     render_bufs = None
-    
-    return ret
\ No newline at end of file
+    device = torch.device(device)
+    grad = torch.is_grad_enabled()
+    if grad:
+        out_device = None
+    shapes = None if grad else render_out_shapes(tensorf, N_samples, **kwargs)
+    ret = ChunkOutputs(N_rays_all, shapes, out_device, device)
+    if sizer is None and mem_budget > 0:
+        sizer = make_chunk_sizer(tensorf, mem_budget, device, N_samples)
+    start = 0
+    while start < N_rays_all:  #批量渲染
+        size = chunk if sizer is None else sizer.size(chunk, device)
+        rays_chunk = rays[start:start + size].to(device)
+
+        oom = False
+        try:
+            if sizer is not None:
+                sizer.begin(device)
+            res_dict = tensorf(rays_chunk, is_train=is_train, white_bg=white_bg, ndc_ray=ndc_ray, N_samples=N_samples, **kwargs)
+        except OutOfMemoryError as e:
+            if not is_out_of_memory(e):
+                raise
+            oom = True
+        if oom:
+            # outside the except block, the traceback no longer holds the chunk's tensors
+            res_dict = None
+            size = rays_chunk.shape[0]
+            torch.cuda.empty_cache()
+            if sizer is not None and sizer.out_of_memory(size):
+                size = sizer.size(chunk, device)
+            elif sizer is None and size > 1:
+                chunk = size = max(size // 2, 1)
+            else:
+                raise RuntimeError(f'[chunkify_render] out of memory with a chunk of {size} rays')
+            print(f'[chunkify_render] out of memory, retrying with chunks of {size} rays')
+            continue
+        if sizer is not None:
+            sizer.observe(rays_chunk.shape[0], device)
+        if start == 0 and rays_chunk.shape[0] == N_rays_all and out_device is None:
+            # one chunk, nothing to gather
+            return res_dict
+        ret.write(start, res_dict)  #res_dict['rgb_map']  res_dict['depth_map'] 存放rgb图或深度图等
+        start += rays_chunk.shape[0]
+
+    return ret.result()